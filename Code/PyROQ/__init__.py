@@ -1,2 +1,2 @@
 from . import pyroq
-
+from . import weights
@@ -0,0 +1,247 @@
+"""
+Benchmarks of the ROQ build pipeline on the analytic TaylorF2 waveforms, which need neither LAL nor TEOBResumS.
+
+    python -m PyROQ.benchmark --durations 4 16 --nbases 20 40 --output results.json
+    python -m PyROQ.benchmark --baseline results.json
+
+Each configuration (signal duration, i.e. frequency-grid size, and number of bases) runs the stages
+waveforms (training set generation), greedy (basis selection on that training set), empnodes, surros, roqs and weights,
+with a fixed random seed. For every stage the wall time, the peak memory of this process during the stage
+(see PeakMemory) and the number of waveforms generated per second are recorded. With --baseline, the wall times are compared to those
+of a previous output and the run fails if a stage is slower by more than --threshold.
+
+With --mpi 1 the greedy search and the validation are distributed over the MPI ranks (needs mpi4py),
+
+    mpirun -n 4 python -m PyROQ.benchmark --mpi 1
+
+the ranks share the working directory of rank 0, so they must run on the same file system, and rank 0 reports.
+"""
+import numpy
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from . import pyroq
+from . import weights
+
+stages = ['waveforms', 'greedy', 'empnodes', 'surros', 'roqs', 'weights']
+
+# Analytic generator counting the waveforms it generates, registered in front of the default one
+class CountingGenerator(pyroq.AnalyticGenerator):
+    count = 0
+
+    def generate_one(self, *args, **kwargs):
+        self.count += 1
+        return pyroq.AnalyticGenerator.generate_one(self, *args, **kwargs)
+
+    def generate(self, paramspoints, *args, **kwargs):
+        self.count += len(paramspoints)
+        return pyroq.AnalyticGenerator.generate(self, paramspoints, *args, **kwargs)
+
+class PeakMemory(object):
+    """
+    Peak memory in MB of this process since start(). On Linux it is the peak RSS, reset by start() through
+    /proc/self/clear_refs; elsewhere the peak of the allocations traced by tracemalloc, numpy arrays included.
+    Pool workers are not counted.
+    """
+    def start(self):
+        try:
+            with open('/proc/self/clear_refs', 'w') as f: f.write('5')
+            self.source = 'rss'
+        except OSError:
+            if not tracemalloc.is_tracing(): tracemalloc.start()
+            tracemalloc.reset_peak()
+            self.source = 'tracemalloc'
+
+    def peak_mb(self):
+        if self.source == 'tracemalloc': return tracemalloc.get_traced_memory()[1]/2**20
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'): return int(line.split()[1])/2**10
+        return None
+
+class StageTimer(object):
+    """
+    Times the stages of one configuration, silencing their output unless verbose.
+    """
+    def __init__(self, generator, verbose=0, comm=None):
+        self.generator = generator
+        self.verbose = verbose
+        self.comm = comm
+        self.results = {}
+        self.memory = PeakMemory()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        count = self.generator.count
+        output = contextlib.ExitStack() if self.verbose else contextlib.redirect_stdout(io.StringIO())
+        with output:
+            self.memory.start()
+            start = time.perf_counter()
+            yield
+            if self.comm is not None: self.comm.Barrier() # the stage ends with its slowest rank
+            wall_time = time.perf_counter() - start
+        waveforms = self.generator.count - count
+        self.results[name] = {'wall_time': wall_time, 'peak_memory_mb': self.memory.peak_mb(), 'waveforms': waveforms,
+                              'waveforms_per_s': waveforms/wall_time if waveforms else None}
+
+# Parameter space of the benchmarks: a narrow binary neutron star chunk with aligned spins
+def parameter_space(approximant):
+    nparams, params_low, params_high, params_start, hp1 = pyroq.initial_basis(
+        1.2, 1.25, 1, 1.5, [0, 0, 0], [0.05, 0, 0], [0, 0, 0], [0.05, 0, 0], 0, 0, 0, 1000, 0, 1000,
+        0, numpy.pi, 0, 2*numpy.pi, 1, 1, 20, 1024, {}, approximant)
+    return nparams, params_low, params_high
+
+def run_configuration(duration, nbases, npts=400, nts=200, f_min=20, f_max=1024, approximant='analytic-TaylorF2-tidal', parallel=0, nprocesses=1, seed=0, verbose=0, comm=None):
+    """
+    Runs all stages for a signal of duration seconds (deltaF = 1/duration) and nbases linear bases,
+    in a temporary directory. Returns {stage: measurements}.
+    With an MPI communicator comm, every rank generates its shard of the training and validation waveforms.
+    """
+    generator = CountingGenerator(approximant, pyroq.waveform_generator(approximant).extra_params)
+    pyroq.register_waveform_generator(generator)
+    directory = tempfile.mkdtemp(prefix='pyroq_benchmark_') if pyroq.mpi_root(comm) else None
+    if comm is not None: directory = comm.bcast(directory, root=0)
+    cwd = os.getcwd()
+    try:
+        os.chdir(directory)
+        numpy.random.seed(seed)
+        deltaF = 1./duration
+        freq = numpy.arange(f_min, f_max, deltaF)
+        distance = 100*pyroq.LAL_PC_SI*1e6
+        nparams, params_low, params_high = parameter_space(approximant)
+        timer = StageTimer(generator, verbose, comm)
+
+        training_points = pyroq.generate_params_points(npts, nparams, params_low, params_high)
+        hp1 = pyroq.generate_a_waveform_from_paramspoint(training_points[0], distance, deltaF, f_min, f_max, approximant)
+        known_bases_start = numpy.array([hp1/numpy.sqrt(numpy.vdot(hp1, hp1))])
+        with timer.stage('waveforms'):
+            training = pyroq.build_training_set(parallel, nprocesses, training_points, known_bases_start, distance, deltaF, f_min, f_max, approximant, comm=comm)
+
+        # the greedy selection alone, on the training set of the waveforms stage
+        store = pyroq.BasisStore(known_bases_start, training_points[:1], numpy.array([0.0]), capacity=nbases)
+        try:
+            with timer.stage('greedy'):
+                for k in pyroq.greedy_iterations(nbases):
+                    basis_new, params_new, rm_new = pyroq.least_match_training_set(training, store.bases)
+                    store.append(basis_new, params_new, rm_new)
+            known_bases = store.bases
+        finally:
+            store.close()
+            training.close()
+
+        with timer.stage('empnodes'):
+            ndim, inverse_V, emp_nodes = pyroq.empnodes(len(known_bases), known_bases)
+
+        validation_set = pyroq.generate_validation_set(nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, approximant, parallel=parallel, nprocesses=nprocesses, comm=comm)
+        curve = {}
+        with timer.stage('surros'):
+            pyroq.surros(numpy.inf, ndim, inverse_V, emp_nodes, known_bases, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, {}, approximant, validation_set=validation_set, curve=curve, comm=comm)
+
+        # the tolerance is met at the full basis size, so the linear search validates all candidates from nbases/2 on
+        tolerance = 1.01*curve[ndim]
+        with timer.stage('roqs'):
+            pyroq.roqs(tolerance, freq, max(2, ndim//2), ndim+1, 1, known_bases, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, {}, approximant, validation_set=validation_set, comm=comm)
+        if comm is not None: comm.Barrier() # B_linear.npy is written by rank 0
+
+        # the weights of B_linear over all time shifts of the FFT grid; |B_linear|^2 stands in for a quadratic B of the same size
+        B_linear = numpy.load('B_linear.npy', mmap_mode='r')
+        data = validation_set[1][0]
+        psd = numpy.ones(len(freq))
+        with timer.stage('weights'):
+            weights.linear_weights(B_linear, data, psd, deltaF, f_min)
+            weights.quadratic_weights(numpy.absolute(B_linear)**2, psd, deltaF)
+        return timer.results
+    finally:
+        os.chdir(cwd)
+        if comm is not None: comm.Barrier()
+        if pyroq.mpi_root(comm): shutil.rmtree(directory, ignore_errors=True)
+        pyroq.waveform_generators.remove(generator)
+
+def run_benchmark(durations=[4, 16], nbases_list=[20, 40], repeat=1, verbose=0, **kwargs):
+    """
+    Runs run_configuration for every duration and number of bases, keeping the fastest of repeat runs of each stage.
+    Returns one record per configuration and stage.
+    """
+    records = []
+    for duration in durations:
+        for nbases in nbases_list:
+            best = {}
+            for r in range(repeat):
+                results = run_configuration(duration, nbases, verbose=verbose, **kwargs)
+                for name, result in results.items():
+                    if name not in best or result['wall_time'] < best[name]['wall_time']: best[name] = result
+            for name in stages:
+                record = {'stage': name, 'duration': duration, 'nfreqs': int(round((kwargs.get('f_max', 1024) - kwargs.get('f_min', 20))*duration)), 'nbases': nbases}
+                record.update(best[name])
+                records.append(record)
+                if pyroq.mpi_root(kwargs.get('comm')): print("{stage:>10} duration {duration:>5} s  nbases {nbases:>4}  {wall_time:10.4f} s".format(**record))
+    return records
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': numpy.__version__, 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpu_count': os.cpu_count()}
+
+def record_key(record):
+    return (record['stage'], record['duration'], record['nbases'])
+
+# Wall times relative to the baseline records, and the stages slower than the baseline by more than threshold
+def compare_to_baseline(records, baseline, threshold=0.2):
+    baseline = {record_key(record): record for record in baseline}
+    comparison, regressions = [], []
+    for record in records:
+        if record_key(record) not in baseline: continue
+        ratio = record['wall_time']/baseline[record_key(record)]['wall_time']
+        comparison.append((record_key(record), ratio))
+        if ratio > 1 + threshold: regressions.append((record_key(record), ratio))
+    return comparison, regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m PyROQ.benchmark', description='Benchmarks of the ROQ build pipeline on analytic waveforms.')
+    parser.add_argument('--durations', type=float, nargs='+', default=[4, 16], help='signal durations in s, the frequency grid has (f_max-f_min)*duration points')
+    parser.add_argument('--nbases', type=int, nargs='+', default=[20, 40], help='numbers of linear bases')
+    parser.add_argument('--npts', type=int, default=400, help='training set size')
+    parser.add_argument('--nts', type=int, default=200, help='validation set size')
+    parser.add_argument('--approximant', default='analytic-TaylorF2-tidal')
+    parser.add_argument('--parallel', type=int, default=0)
+    parser.add_argument('--nprocesses', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1, help='runs per configuration, the fastest is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file for the results')
+    parser.add_argument('--baseline', help='JSON output of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative slowdown reported as a regression')
+    parser.add_argument('--verbose', type=int, default=0, help='1 shows the output of the stages')
+    parser.add_argument('--mpi', type=int, default=0, help='1 distributes the greedy search and the validation over the MPI ranks')
+    args = parser.parse_args(argv)
+
+    comm = None
+    if args.mpi:
+        if pyroq.MPI is None: parser.error('--mpi needs mpi4py')
+        comm = pyroq.MPI.COMM_WORLD
+    records = run_benchmark(args.durations, args.nbases, repeat=args.repeat, verbose=args.verbose, npts=args.npts, nts=args.nts,
+                            approximant=args.approximant, parallel=args.parallel, nprocesses=args.nprocesses, seed=args.seed, comm=comm)
+    if not pyroq.mpi_root(comm): return 0
+    results = {'environment': environment(), 'arguments': vars(args), 'results': records}
+    if comm is not None: results['environment']['mpi_ranks'] = comm.Get_size()
+    if args.output is not None:
+        with open(args.output, 'w') as f: json.dump(results, f, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline) as f: baseline = json.load(f)['results']
+        comparison, regressions = compare_to_baseline(records, baseline, args.threshold)
+        for (name, duration, nbases), ratio in comparison:
+            print("{:>10} duration {:>5} s  nbases {:>4}  {:6.2f} x baseline".format(name, duration, nbases, ratio))
+        if regressions:
+            print(len(regressions), "stages slower than the baseline by more than", args.threshold)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,24 +1,63 @@
 import numpy
 import numpy as np
 import scipy
+import scipy.linalg
 import matplotlib
 matplotlib.use('Agg') 
 import matplotlib.pyplot as plt
-import lal
-import lalsimulation
-from lal.lal import PC_SI as LAL_PC_SI
 import h5py
 import warnings
 import random
 import multiprocessing as mp
+import multiprocessing.pool
+import pickle
 import traceback
+import functools
+import collections
+import hashlib
+import os
+import sys
+import tempfile
+import weakref
+import time
+import json
+import contextlib
+import threading
+import queue
+import zlib
 
-import EOBRun_module
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# LAL and TEOBResumS are only needed by their approximants, the analytic ones run on numpy alone
+try:
+    import lal
+    import lalsimulation
+    from lal.lal import PC_SI as LAL_PC_SI
+    from lal.lal import MSUN_SI
+except ImportError:
+    warnings.warn('Skipping import of lal and lalsimulation')
+    lal = lalsimulation = None
+    LAL_PC_SI = 3.085677581491367e+16 # m
+    MSUN_SI = 1.988409870698051e+30 # kg
+
+try:
+    import EOBRun_module
+except ImportError:
+    warnings.warn('Skipping import of EOBRun_module')
 
 try: 
     from mlgw_bns import ParametersWithExtrinsic, Model
-except:
-    warning.warn('Skipping import of mlgw_bns')
+except ImportError:
+    warnings.warn('Skipping import of mlgw_bns')
+
+# mpi4py is only needed by the distributed construction
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
 
 # EOB helpers ###
 TEOBResumS_version = [
@@ -54,11 +93,13 @@ def JBJF(hp,hc,dt):
     hctilde = np.fft.rfft(-hc) * dt 
     return hptilde, hctilde
 
-def generate_a_waveform_EOB(m1, m2, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant):
+def generate_a_waveform_EOB(m1, m2, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant, frequencies=None):
     """
     TEOBResumS wrapper
     waveFlags is used for EOB parameters
     spin{1,2} have 3 entries x,y,z
+    If frequencies is given the waveform is returned at these frequencies only: mlgw-bns and FD TEOBResumS
+    evaluate it there, TD TEOBResumS samples the full-band waveform.
     """
 
     # eccentric binaries are not supported
@@ -73,9 +114,9 @@ def generate_a_waveform_EOB(m1, m2, spin1, spin2, ecc, lambda1, lambda2, iota, p
         lambda1,lambda2 = lambda2,lambda1
 
     # Bring back the quantities to units compatible with TEOB
-    m1 = m1/lal.MSUN_SI
-    m2 = m2/lal.MSUN_SI
-    distance = distance/(lal.PC_SI*1e6)
+    m1 = m1/MSUN_SI
+    m2 = m2/MSUN_SI
+    distance = distance/(LAL_PC_SI*1e6)
 
     if(approximant == 'mlgw-bns'):
     
@@ -87,9 +128,9 @@ def generate_a_waveform_EOB(m1, m2, spin1, spin2, ecc, lambda1, lambda2, iota, p
         if((abs(spin1[0]) > 1e-6) or (abs(spin1[1]) > 1e-6)): raise ValueError("Precession is not supported, but (spin1x, spin1y)=({},{}) were passed.".format(spin1[0], spin1[1]))
         if((abs(spin2[0]) > 1e-6) or (abs(spin2[1]) > 1e-6)): raise ValueError("Precession is not supported, but (spin2x, spin2y)=({},{}) were passed.".format(spin2[0], spin2[1]))
 
-        model       = Model.default()
-        frequencies = np.arange(f_min, f_max, step=deltaF)
-        params      = ParametersWithExtrinsic(q, lambda1, lambda2, spin1[2], spin1[2], distance, iota, m1+m2, reference_phase=phiRef)
+        model       = mlgw_model()
+        if frequencies is None: frequencies = np.arange(f_min, f_max, step=deltaF)
+        params      = ParametersWithExtrinsic(q, lambda1, lambda2, spin1[2], spin2[2], distance, iota, m1+m2, reference_phase=phiRef)
         hp, hc      = model.predict(frequencies, params)
 
     else:
@@ -118,19 +159,325 @@ def generate_a_waveform_EOB(m1, m2, spin1, spin2, ecc, lambda1, lambda2, iota, p
         waveFlags['df'                 ] = deltaF
         waveFlags['distance'           ] = distance
         waveFlags['inclination'        ] = iota
+        waveFlags.pop('interp_freqs', None)
+        waveFlags.pop('freqs', None)
 
         if domain == 'TD':
             T, Hp, Hc = EOBRun_module.EOBRunPy(waveFlags)
             Hptilde, Hctilde = JBJF(Hp,Hc,T[1]-T[0])
+        elif frequencies is not None:
+            waveFlags['interp_freqs'       ] = 1  # Interpolate the FD waveform on the frequencies in 'freqs'
+            waveFlags['freqs'              ] = list(frequencies)
+            F, hp, hc, hlm, dyn = EOBRun_module.EOBRunPy(waveFlags)
+            return hp, hc
         else:
             F, Hptilde, Hctilde, hlm, dyn = EOBRun_module.EOBRunPy(waveFlags)
 
         # Adapt len to PyROQ frequency axis conventions
         hp, hc = Hptilde[:-1], Hctilde[:-1]
+        if frequencies is not None:
+            index = frequency_indices(frequencies, deltaF, f_min)
+            hp, hc = hp[index], hc[index]
 
     return hp, hc
 
+# Indices of frequencies on the grid f_min + k deltaF of the full-band waveforms
+def frequency_indices(frequencies, deltaF, f_min):
+    return numpy.round((numpy.asarray(frequencies)-f_min)/deltaF).astype(int)
+
+# mlgw-bns model, loaded once per process (see WaveformGenerator.load)
+mlgw_bns_model = None
+
+def mlgw_model():
+    global mlgw_bns_model
+    if mlgw_bns_model is None: mlgw_bns_model = Model.default()
+    return mlgw_bns_model
+
 # end EOB helpers ###
+
+# Waveform cache ###
+
+# Entries that generate_a_waveform_EOB overwrites for every waveform, they do not identify the waveform model
+EOB_per_waveform_flags = ['M', 'q', 'Lambda1', 'Lambda2', 'chi1', 'chi2', 'chi1x', 'chi1y', 'chi1z', 'chi2x', 'chi2y', 'chi2z', 
+                          'domain', 'srate_interp', 'initial_frequency', 'df', 'distance', 'inclination', 'interp_freqs', 'freqs']
+# Entries that LALGenerator inserts into the LAL dictionary for every waveform
+LAL_per_waveform_flags = ['lambda1', 'lambda2']
+# Type codes of LAL values and the names of their getters
+LAL_value_getters = [('I2', 'INT2'), ('I4', 'INT4'), ('I8', 'INT8'), ('U2', 'UINT2'), ('U4', 'UINT4'), ('U8', 'UINT8'),
+                     ('S', 'REAL4'), ('D', 'REAL8'), ('C', 'COMPLEX8'), ('Z', 'COMPLEX16'), ('CHAR', 'String')]
+
+# Sorted (key, value) entries of a LAL dictionary, without the per-waveform ones.
+# Raises AttributeError, KeyError, TypeError or RuntimeError for a dictionary that cannot be read.
+def lal_dict_entries(waveFlags):
+    getters = dict((getattr(lal, code+'_TYPE_CODE'), getattr(lal, 'ValueGet'+name)) for code, name in LAL_value_getters)
+    entries = []
+    iterator = lal.DictIter()
+    lal.DictIterInit(iterator, waveFlags)
+    entry = lal.DictIterNext(iterator)
+    while entry is not None:
+        key = lal.DictEntryGetKey(entry)
+        if key not in LAL_per_waveform_flags:
+            value = lal.DictEntryGetValue(entry)
+            entries.append((key, getters[lal.ValueGetType(value)](value)))
+        entry = lal.DictIterNext(iterator)
+    return sorted(entries)
+
+class WaveformCache(object):
+    """
+    Content-addressed cache of generated waveforms, keyed on
+    (approximant, waveFlags, parameter vector, f_min, f_max, deltaF).
+    The most recently used waveforms are kept in memory up to max_memory bytes (LRU).
+    If directory is given, waveforms are also stored there as .npy files, shared by all
+    processes and runs using the same directory; above max_disk bytes the least
+    recently used files are removed.
+    dict waveFlags (TEOBResumS) and LAL dictionaries enter the key through their entries, without those rewritten for every
+    waveform. Waveforms whose waveFlags cannot be read are not cached (see key).
+    The cache can be shared by the threads of a thread pool, a lock guards its state.
+    """
+    def __init__(self, directory=None, max_memory=2**30, max_disk=None):
+        self.directory = directory
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.hits = 0
+        self.misses = 0
+        self._memory = collections.OrderedDict()
+        self._memory_size = 0
+        self._disk_size = 0
+        self._lock = threading.RLock()
+        if directory is not None:
+            if not os.path.exists(directory): os.makedirs(directory, exist_ok=True)
+            self._disk_size = sum(size for mtime, size, path in self._disk_entries())
+
+    def __getstate__(self):
+        # workers get an empty memory tier and share the disk one
+        state = self.__dict__.copy()
+        state['_memory'] = collections.OrderedDict()
+        state['_memory_size'] = 0
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    # None if waveFlags is neither None, a dict nor a readable LAL dictionary
+    @staticmethod
+    def key(approximant, waveFlags, params, f_min, f_max, deltaF):
+        flags = ''
+        if isinstance(waveFlags, dict):
+            flags = repr(sorted((k, v) for k, v in waveFlags.items() if k not in EOB_per_waveform_flags))
+        elif waveFlags is not None:
+            try:
+                flags = repr(lal_dict_entries(waveFlags))
+            except (AttributeError, KeyError, TypeError, RuntimeError):
+                return None
+        digest = hashlib.sha1()
+        digest.update(repr(approximant).encode())
+        digest.update(flags.encode())
+        digest.update(numpy.asarray(params, dtype=numpy.float64).tobytes())
+        digest.update(numpy.array([f_min, f_max, deltaF], dtype=numpy.float64).tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key+'.npy')
+
+    def _remember(self, key, waveform):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = waveform
+        self._memory_size += waveform.nbytes
+        while self._memory_size > self.max_memory and len(self._memory) > 1:
+            old_key, old_waveform = self._memory.popitem(last=False)
+            self._memory_size -= old_waveform.nbytes
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+        if self.directory is not None:
+            try:
+                waveform = numpy.load(self._path(key))
+                os.utime(self._path(key))
+            except (IOError, OSError, ValueError):
+                waveform = None
+            if waveform is not None:
+                waveform.flags.writeable = False
+                with self._lock:
+                    self._remember(key, waveform)
+                    self.hits += 1
+                return waveform
+        with self._lock: self.misses += 1
+        return None
+
+    def put(self, key, waveform):
+        waveform = numpy.array(waveform)
+        waveform.flags.writeable = False
+        with self._lock: self._remember(key, waveform)
+        if self.directory is not None:
+            # written under a unique temporary name and renamed, so other writers never read partial files
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f: numpy.save(f, waveform)
+            size = os.path.getsize(tmp_path)
+            try:
+                size -= os.path.getsize(self._path(key)) # overwritten file
+            except OSError:
+                pass
+            os.replace(tmp_path, self._path(key))
+            with self._lock:
+                self._disk_size += size
+                if self.max_disk is not None and self._disk_size > self.max_disk: self._evict_disk()
+        return waveform
+
+    # (mtime, size, path) of the cached files, other processes may remove them at any time
+    def _disk_entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.npy'): continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _evict_disk(self):
+        entries = sorted(self._disk_entries())
+        self._disk_size = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if self._disk_size <= self.max_disk: break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._disk_size -= size
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+
+waveform_cache = None
+
+def set_waveform_cache(cache):
+    """
+    Use cache (a WaveformCache, or None to disable caching) for all waveforms generated from now on.
+    Set it before starting worker pools, they receive it at startup.
+    """
+    global waveform_cache
+    waveform_cache = cache
+
+# end waveform cache ###
+
+# Instrumentation ###
+# The hot paths are timed (see instrumented) and counted while an Instrumentation is set, and the greedy
+# searches report every iteration to it. Without one, the only cost is a check of the global.
+
+# Peak resident set size of the process in MB, None where the resource module is missing
+def peak_rss_mb():
+    if resource is None: return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': return maxrss/2**20
+    return maxrss/2**10
+
+class Instrumentation(object):
+    """
+    Timings, counters and events of a run.
+    timings holds calls, total and max seconds of every instrumented function, counters the waveforms
+    generated, the waveform cache hits and the vectors projected on the bases.
+    Events (greedy iterations, and every timed call if log_calls=1) are dicts passed to the callbacks
+    and appended as JSON lines to the file log if given; each carries the time since the start, the pid
+    and the peak RSS.
+    Pool workers get a copy without the callbacks: their calls only reach the log, their timings and
+    counters stay in the workers. The parent times the whole parallel evaluations.
+    """
+    def __init__(self, log=None, callbacks=[], log_calls=0):
+        self.log = log
+        self.callbacks = list(callbacks)
+        self.log_calls = log_calls
+        self.timings = {}
+        self.counters = collections.Counter()
+        self.start = time.perf_counter()
+        self._file = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['callbacks'] = []
+        state['timings'] = {}
+        state['counters'] = collections.Counter()
+        state['_file'] = None
+        return state
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            timing = self.timings.setdefault(name, {'calls': 0, 'total': 0., 'max': 0.})
+            timing['calls'] += 1
+            timing['total'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+            if self.log_calls: self.event('call', name=name, seconds=seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def event(self, kind, **data):
+        record = {'event': kind, 'time': time.perf_counter() - self.start, 'pid': os.getpid(), 'peak_rss_mb': peak_rss_mb()}
+        record.update(data)
+        for callback in self.callbacks: callback(record)
+        if self.log is not None:
+            if self._file is None: self._file = open(self.log, 'a')
+            self._file.write(json.dumps(record, default=lambda x: x.tolist())+'\n')
+            self._file.flush()
+        return record
+
+    def summary(self):
+        return {'timings': self.timings, 'counters': dict(self.counters), 'peak_rss_mb': peak_rss_mb()}
+
+    # logs the summary and closes the log
+    def close(self):
+        summary = self.event('summary', **self.summary())
+        if self._file is not None: self._file.close()
+        self._file = None
+        return summary
+
+instrumentation = None
+
+def set_instrumentation(instr):
+    """
+    Use instr (an Instrumentation, or None to disable it) from now on.
+    Set it before starting worker pools, they receive it at startup.
+    """
+    global instrumentation
+    instrumentation = instr
+
+def record_count(name, n=1):
+    if instrumentation is not None: instrumentation.count(name, n)
+
+def record_event(kind, **data):
+    if instrumentation is not None: instrumentation.event(kind, **data)
+
+# Decorator timing every call of a function under name (its own name by default) while an Instrumentation is set
+def instrumented(name=None):
+    def decorator(function):
+        label = function.__name__ if name is None else name
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if instrumentation is None: return function(*args, **kwargs)
+            with instrumentation.timer(label):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# end instrumentation ###
     
 def howmany_within_range(row, minimum, maximum):
     """Returns how many numbers lie within `maximum` and `minimum` in a given `row`"""
@@ -143,12 +490,24 @@ def howmany_within_range(row, minimum, maximum):
 # Calculating the projection of complex vector v on complex vector u
 def proj(u, v):
     # notice: this algrithm assume denominator isn't zero
-    return u * numpy.vdot(v,u) / numpy.vdot(u,u) 
+    return u * numpy.vdot(u,v) / numpy.vdot(u,u) 
+
+# Calculating the component of a vector (or of every row of a block of vectors) orthogonal to the known orthonormal bases.
+# Each pass projects the whole block on all bases with two matrix products; a second pass
+# ("twice is enough") removes what rounding left over from the first, keeping the bases orthogonal to working precision.
+@instrumented()
+def project_out(bases, vecs, passes=2):
+    residuals = numpy.atleast_2d(vecs)
+    record_count('projections', len(residuals))
+    for i in range(passes):
+        coefficients = numpy.dot(residuals, numpy.conj(numpy.transpose(bases)))
+        residuals = residuals - numpy.dot(coefficients, bases)
+    if numpy.ndim(vecs) == 1: return residuals[0]
+    return residuals
 
 # Calculating the normalized residual (= a new basis) of a vector vec from known bases
 def gram_schmidt(bases, vec):
-    for i in numpy.arange(0,len(bases)):
-        vec = vec - proj(bases[i], vec)
+    vec = project_out(bases, vec)
     return vec/numpy.sqrt(numpy.vdot(vec,vec)) # normalized new basis
 
 # Calculating overlap of two waveforms
@@ -172,411 +531,1302 @@ def get_m1m2_from_mcq(mc, q):
     m1 = m2 * q
     return numpy.array([m1,m2])
 
-def generate_a_waveform(m1, m2, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant):
-    test_mass1 = m1 * lal.lal.MSUN_SI
-    test_mass2 = m2 * lal.lal.MSUN_SI
+# Waveform generators ###
+# Every approximant is served by a registered WaveformGenerator. The greedy searches, the validation and the
+# likelihood only call the generator, so an approximant is added by registering a generator for it.
+
+class WaveformGenerator(object):
+    """
+    Generator of the h+ waveforms of a family of approximants.
+    extra_params names the parameters that follow Mc, q, s1, s2 (spherical), iota and phiRef in a
+    point of the sampled parameter space: [], ['ecc'] or ['lambda1', 'lambda2'] (see paramspoint_to_parameters).
+    supports_nodes: waveforms are evaluated directly at arbitrary frequencies, not sampled from the full band.
+    supports_batch: generate() evaluates a batch of points in one call rather than point by point.
+    thread_safe: waveforms can be generated by several threads at once (see start_pool).
+    """
+    extra_params = []
+    supports_nodes = False
+    supports_batch = False
+    thread_safe = False
+
+    def matches(self, approximant):
+        return False
 
-    if approximant in TEOBResumS_version:
-        hp, hc = generate_a_waveform_EOB(test_mass1, test_mass2, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant)
+    # loads what the approximant needs once per process, called by the pool workers at startup
+    def load(self, approximant):
+        pass
+
+    # default waveFlags of the approximant
+    def waveflags(self, approximant):
+        return {}
+
+    # h+ of one waveform with masses m1, m2 in kg, on the grid f_min + k deltaF or at the given frequencies
+    def generate_one(self, m1, m2, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant, frequencies=None):
+        raise NotImplementedError
+
+    def generate(self, paramspoints, distance, deltaF, f_min, f_max, approximant, waveFlags=None, frequencies=None):
+        """
+        h+ of a batch of points of the sampled parameter space, one per row. distance is one value or one per point.
+        """
+        if waveFlags is None: waveFlags = self.waveflags(approximant)
+        distances = numpy.broadcast_to(distance, (len(paramspoints),))
+        hps = []
+        for paramspoint, distance in zip(paramspoints, distances):
+            mc, q, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef = paramspoint_to_parameters(paramspoint)
+            m1, m2 = get_m1m2_from_mcq(mc, q)*MSUN_SI
+            hps.append(self.generate_one(m1, m2, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant, frequencies=frequencies))
+        return numpy.array(hps)
+
+class LALGenerator(WaveformGenerator):
+    """
+    LAL frequency-domain approximants, given by their names in lalsimulation (all integer approximants if names is None).
+    Node frequencies are evaluated with SimInspiralChooseFDWaveformSequence, except for eccentric waveforms.
+    """
+    supports_nodes = True
+
+    def __init__(self, names=None, extra_params=[]):
+        self.names = names
+        self.extra_params = extra_params
+
+    def matches(self, approximant):
+        if lalsimulation is None: return False
+        if self.names is None: return isinstance(approximant, (int, numpy.integer))
+        return any(approximant == getattr(lalsimulation, name, None) for name in self.names)
+
+    def waveflags(self, approximant):
+        return lal.CreateDict()
+
+    def generate_one(self, m1, m2, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant, frequencies=None):
+        lalsimulation.SimInspiralWaveformParamsInsertTidalLambda1(waveFlags, lambda1)
+        lalsimulation.SimInspiralWaveformParamsInsertTidalLambda2(waveFlags, lambda2)
+        if frequencies is not None and ecc == 0:
+            # reference frequency f_min, as for the full-band waveforms
+            sequence = lal.CreateREAL8Vector(len(frequencies))
+            sequence.data = numpy.asarray(frequencies, dtype=numpy.float64)
+            [plus_test, cross_test] = lalsimulation.SimInspiralChooseFDWaveformSequence(phiRef, m1, m2, spin1[0], spin1[1], spin1[2], spin2[0], spin2[1], spin2[2], f_min, distance, iota, waveFlags, approximant, sequence)
+            return plus_test.data.data
+        [plus_test, cross_test]=lalsimulation.SimInspiralChooseFDWaveform(m1, m2, spin1[0], spin1[1], spin1[2], spin2[0], spin2[1], spin2[2], distance, iota, phiRef, 0, ecc, 0, deltaF, f_min, f_max, 0, waveFlags, approximant)
+        hp = plus_test.data.data
+        hp_test = hp[int(f_min/deltaF):int(f_max/deltaF)]
+        if frequencies is not None: hp_test = hp_test[frequency_indices(frequencies, deltaF, f_min)]
+        return hp_test
+
+class EOBGenerator(WaveformGenerator):
+    """
+    TEOBResumS (TD and FD) and mlgw-bns, through generate_a_waveform_EOB.
+    """
+    extra_params = ['lambda1', 'lambda2']
+
+    def __init__(self, approximants, supports_nodes=False):
+        self.approximants = approximants
+        self.supports_nodes = supports_nodes
+
+    def matches(self, approximant):
+        return approximant in self.approximants
+
+    def load(self, approximant):
+        if approximant == 'mlgw-bns': mlgw_model()
+
+    def waveflags(self, approximant):
+        if approximant in TEOBResumS_version: return eob_parameters()
+        return {}
+
+    def generate_one(self, m1, m2, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant, frequencies=None):
+        hp, hc = generate_a_waveform_EOB(m1, m2, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant, frequencies=frequencies)
         return hp
-    
-    lalsimulation.SimInspiralWaveformParamsInsertTidalLambda1(waveFlags, lambda1)
-    lalsimulation.SimInspiralWaveformParamsInsertTidalLambda2(waveFlags, lambda2)     
-    [plus_test, cross_test]=lalsimulation.SimInspiralChooseFDWaveform(test_mass1, test_mass2, spin1[0], spin1[1], spin1[2], spin2[0], spin2[1], spin2[2], distance, iota, phiRef, 0, ecc, 0, deltaF, f_min, f_max, 0, waveFlags, approximant)
-    hp = plus_test.data.data
-    hp_test = hp[numpy.int(f_min/deltaF):numpy.int(f_max/deltaF)]
-    return hp_test
+
+# Analytic TaylorF2 ###
+# Pure numpy inspiral waveforms, for benchmarking and testing without LAL or TEOBResumS.
+# Phase: 3.5PN point-particle, 1.5PN spin-orbit and 2PN spin-spin terms of the aligned spin components,
+# and the 5PN and 6PN tidal terms (Wade et al. 2014) if the approximant takes lambda1, lambda2.
+# Amplitude: leading order, |h+| = sqrt(5/24) pi^(-2/3) c Mc^(5/6) f^(-7/6) (1+cos^2 iota)/(2 D), Mc in seconds.
+# Coalescence at t=0, no cut at the ISCO.
+MTSUN_SI = 4.925490947641267e-06 # G MSUN_SI/c^3, s
+C_SI = 299792458. # m/s
+
+def taylorf2_strain(m1, m2, chi1, chi2, lambda1, lambda2, iota, phiRef, distance, frequencies):
+    """
+    h+ of TaylorF2 at frequencies, masses in solar masses, distance in m.
+    The parameters can be arrays of shape (n, 1), the result is then (n x len(frequencies)).
+    """
+    # heavier body first
+    swap = m1 < m2
+    m1, m2 = numpy.where(swap, m2, m1), numpy.where(swap, m1, m2)
+    chi1, chi2 = numpy.where(swap, chi2, chi1), numpy.where(swap, chi1, chi2)
+    lambda1, lambda2 = numpy.where(swap, lambda2, lambda1), numpy.where(swap, lambda1, lambda2)
+    f = numpy.asarray(frequencies, dtype=numpy.float64)
+    M = (m1+m2)*MTSUN_SI
+    eta = m1*m2/(m1+m2)**2
+    x1, x2 = m1/(m1+m2), m2/(m1+m2)
+    delta = numpy.sqrt(numpy.maximum(1-4*eta, 0))
+    v = numpy.cbrt(numpy.pi*M*f)
+    v2 = v*v
+    beta = (113*(x1**2*chi1 + x2**2*chi2) + 75*eta*(chi1 + chi2))/12
+    sigma = 79/8.*eta*chi1*chi2
+    a2 = 3715/756. + 55/9.*eta
+    a3 = -16*numpy.pi + 4*beta
+    a4 = 15293365/508032. + 27145/504.*eta + 3085/72.*eta**2 - 10*sigma
+    a5 = numpy.pi*(38645/756. - 65/9.*eta)*(1 + 3*numpy.log(v*numpy.sqrt(6)))
+    a6 = (11583231236531/4694215680. - 640/3.*numpy.pi**2 - 6848/21.*(numpy.euler_gamma + numpy.log(4*v))
+          + (-15737765635/3048192. + 2255/12.*numpy.pi**2)*eta + 76055/1728.*eta**2 - 127825/1296.*eta**3)
+    a7 = numpy.pi*(77096675/254016. + 378515/1512.*eta - 74045/756.*eta**2)
+    series = 1 + v2*(a2 + v*(a3 + v*(a4 + v*(a5 + v*(a6 + v*a7)))))
+    lambda_tilde = 8/13.*((1 + 7*eta - 31*eta**2)*(lambda1 + lambda2) + delta*(1 + 9*eta - 11*eta**2)*(lambda1 - lambda2))
+    delta_lambda_tilde = 0.5*(delta*(1 - 13272/1319.*eta + 8944/1319.*eta**2)*(lambda1 + lambda2)
+                              + (1 - 15910/1319.*eta + 32850/1319.*eta**2 + 3380/1319.*eta**3)*(lambda1 - lambda2))
+    series = series + v2**5*(-39/2.*lambda_tilde + (-3115/64.*lambda_tilde + 6595/364.*delta*delta_lambda_tilde)*v2)
+    psi = 3/(128*eta*v**5)*series - 2*phiRef - numpy.pi/4
+    Mc = eta**0.6*M
+    amplitude = numpy.sqrt(5/24.)*numpy.pi**(-2/3.)*C_SI*Mc**(5/6.)/distance*f**(-7/6.)
+    return amplitude*(1 + numpy.cos(iota)**2)/2*numpy.exp(-1j*psi)
+
+class AnalyticGenerator(WaveformGenerator):
+    """
+    taylorf2_strain, point-particle for approximant 'analytic-TaylorF2', tidal for 'analytic-TaylorF2-tidal'.
+    A batch of points is evaluated with array operations in one call.
+    """
+    supports_nodes = True
+    supports_batch = True
+    thread_safe = True
+
+    def __init__(self, name, extra_params=[]):
+        self.name = name
+        self.extra_params = extra_params
+
+    def matches(self, approximant):
+        return approximant == self.name
+
+    # frequencies of the LAL grid, k deltaF for int(f_min/deltaF) <= k < int(f_max/deltaF)
+    def frequencies(self, deltaF, f_min, f_max, frequencies=None):
+        if frequencies is None: return numpy.arange(int(f_min/deltaF), int(f_max/deltaF))*deltaF
+        return numpy.asarray(frequencies, dtype=numpy.float64)
+
+    def generate_one(self, m1, m2, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant, frequencies=None):
+        return taylorf2_strain(m1/MSUN_SI, m2/MSUN_SI, spin1[2], spin2[2], lambda1, lambda2, iota, phiRef, distance, self.frequencies(deltaF, f_min, f_max, frequencies))
+
+    def generate(self, paramspoints, distance, deltaF, f_min, f_max, approximant, waveFlags=None, frequencies=None):
+        parameters = [paramspoint_to_parameters(paramspoint) for paramspoint in paramspoints]
+        mc, q, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef = [numpy.array([p[i] for p in parameters], dtype=numpy.float64) for i in range(9)]
+        m1, m2 = get_m1m2_from_mcq(mc, q)
+        column = lambda x: numpy.reshape(x, (-1, 1))
+        distance = column(numpy.broadcast_to(distance, (len(parameters),)))
+        return taylorf2_strain(column(m1), column(m2), column(spin1[:, 2]), column(spin2[:, 2]), column(lambda1), column(lambda2), column(iota), column(phiRef), distance, self.frequencies(deltaF, f_min, f_max, frequencies))
+
+# end analytic TaylorF2 ###
+
+# Registered generators, the most recently registered first
+waveform_generators = []
+
+def register_waveform_generator(generator):
+    waveform_generators.insert(0, generator)
+
+def waveform_generator(approximant):
+    for generator in waveform_generators:
+        if generator.matches(approximant): return generator
+    raise ValueError("No waveform generator is registered for approximant {}.".format(approximant))
+
+register_waveform_generator(LALGenerator())
+register_waveform_generator(LALGenerator(['TaylorF2Ecc'], ['ecc']))
+register_waveform_generator(LALGenerator(['IMRPhenomPv2_NRTidal', 'IMRPhenomNSBH'], ['lambda1', 'lambda2']))
+register_waveform_generator(EOBGenerator(['teobresums-giotto-TD']))
+register_waveform_generator(EOBGenerator(['teobresums-giotto-FD', 'mlgw-bns'], supports_nodes=True))
+register_waveform_generator(AnalyticGenerator('analytic-TaylorF2'))
+register_waveform_generator(AnalyticGenerator('analytic-TaylorF2-tidal', ['lambda1', 'lambda2']))
+
+# end waveform generators ###
+
+def generate_a_waveform(m1, m2, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant):
+    test_mass1 = m1 * MSUN_SI
+    test_mass2 = m2 * MSUN_SI
+    return waveform_generator(approximant).generate_one(test_mass1, test_mass2, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant)
 
 def generate_a_waveform_from_mcq(mc, q, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant):
-    m1,m2 = get_m1m2_from_mcq(mc,q)
-    test_mass1 = m1 * lal.lal.MSUN_SI
-    test_mass2 = m2 * lal.lal.MSUN_SI
-    
-    if approximant in TEOBResumS_version:
-        hp, hc = generate_a_waveform_EOB(test_mass1, test_mass2, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant)
+    key = None
+    if waveform_cache is not None: key = waveform_cache.key(approximant, waveFlags, [mc, q]+list(spin1)+list(spin2)+[ecc, lambda1, lambda2, iota, phiRef, distance], f_min, f_max, deltaF)
+    if key is not None:
+        hp = waveform_cache.get(key)
+        if hp is not None: record_count('cache_hits')
+        else:
+            hp = waveform_cache.put(key, generate_a_waveform_from_mcq_uncached(mc, q, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant))
         return hp
+    return generate_a_waveform_from_mcq_uncached(mc, q, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant)
 
-    lalsimulation.SimInspiralWaveformParamsInsertTidalLambda1(waveFlags, lambda1)
-    lalsimulation.SimInspiralWaveformParamsInsertTidalLambda2(waveFlags, lambda2) 
-    [plus_test, cross_test]=lalsimulation.SimInspiralChooseFDWaveform(test_mass1, test_mass2, spin1[0], spin1[1], spin1[2], spin2[0], spin2[1], spin2[2], distance, iota, phiRef, 0, ecc, 0, deltaF, f_min, f_max, 0, waveFlags, approximant)
-    hp = plus_test.data.data
-    hp_test = hp[numpy.int(f_min/deltaF):numpy.int(f_max/deltaF)]
-    return hp_test
+@instrumented('generate_waveform')
+def generate_a_waveform_from_mcq_uncached(mc, q, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant):
+    record_count('waveforms')
+    m1,m2 = get_m1m2_from_mcq(mc,q)
+    return generate_a_waveform(m1, m2, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant)
 
 def generate_params_points(npts, nparams, params_low, params_high):
     paramspoints = numpy.random.uniform(params_low, params_high, size=(npts,nparams))
     paramspoints = paramspoints.round(decimals=6)
     return paramspoints
 
-def compute_modulus(paramspoint, known_bases, distance, deltaF, f_min, f_max, approximant):
-    if approximant not in TEOBResumS_version:
-        waveFlags = lal.CreateDict() 
-    else:
-        waveFlags = eob_parameters()
-
-    m1, m2 = get_m1m2_from_mcq(paramspoint[0],paramspoint[1])
-    s1x, s1y, s1z = spherical_to_cartesian(paramspoint[2:5]) 
-    s2x, s2y, s2z = spherical_to_cartesian(paramspoint[5:8]) 
+# Mc, q, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef of a point of the sampled parameter space
+# (Mc, q, s1, s2 in spherical coordinates, iota, phiRef, then ecc or lambda1, lambda2)
+def paramspoint_to_parameters(paramspoint):
+    spin1 = spherical_to_cartesian(paramspoint[2:5]) 
+    spin2 = spherical_to_cartesian(paramspoint[5:8]) 
     iota = paramspoint[8]  
     phiRef = paramspoint[9]
     ecc = 0
+    lambda1 = 0
+    lambda2 = 0
     if len(paramspoint)==11:
         ecc = paramspoint[10]
     if len(paramspoint)==12:
         lambda1 = paramspoint[10]
         lambda2 = paramspoint[11]
-        if approximant not in TEOBResumS_version:
-            lalsimulation.SimInspiralWaveformParamsInsertTidalLambda1(waveFlags, lambda1)
-            lalsimulation.SimInspiralWaveformParamsInsertTidalLambda2(waveFlags, lambda2) 
-    f_ref=0 
-    RA=0    
-    DEC=0   
-    psi=0   
-    phi=0   
-    m1 *= lal.lal.MSUN_SI
-    m2 *= lal.lal.MSUN_SI
-
-    if approximant in TEOBResumS_version:
-        [plus, cross] = generate_a_waveform_EOB(m1, m2, [s1x, s1y, s1z], [s2x, s2y, s2z], ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant)
-        hp_tmp = plus
-    else:
-        [plus,cross]=lalsimulation.SimInspiralChooseFDWaveform(m1, m2, s1x, s1y, s1z, s2x, s2y, s2z, distance, iota, phiRef, 0, ecc, 0, deltaF, f_min, f_max, f_ref, waveFlags, approximant)
-        hp_tmp = plus.data.data[numpy.int(f_min/deltaF):numpy.int(f_max/deltaF)] # data_tmp is hplus and is a complex vector 
+    return paramspoint[0], paramspoint[1], spin1, spin2, ecc, lambda1, lambda2, iota, phiRef
 
-    residual = hp_tmp
-    for k in numpy.arange(0,len(known_bases)):
-        residual -= proj(known_bases[k],hp_tmp)
-    modulus = numpy.sqrt(numpy.vdot(residual, residual))
+# Waveform (h+) at a point of the sampled parameter space, see paramspoint_to_parameters.
+# Default waveFlags are used if none are given.
+def generate_a_waveform_from_paramspoint(paramspoint, distance, deltaF, f_min, f_max, approximant, waveFlags=None):
+    if waveFlags is None: waveFlags = waveform_generator(approximant).waveflags(approximant)
+    mc, q, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef = paramspoint_to_parameters(paramspoint)
+    return generate_a_waveform_from_mcq(mc, q, spin1, spin2, ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant)
+
+@instrumented()
+def compute_modulus(paramspoint, known_bases, distance, deltaF, f_min, f_max, approximant, waveFlags=None):
+    hp_tmp = generate_a_waveform_from_paramspoint(paramspoint, distance, deltaF, f_min, f_max, approximant, waveFlags=waveFlags)
+    residual = project_out(known_bases, hp_tmp)
+    modulus = numpy.linalg.norm(residual)
     return modulus
 
-def compute_modulus_quad(paramspoint, known_quad_bases, distance, deltaF, f_min, f_max, approximant):
-    if approximant not in TEOBResumS_version:
-        waveFlags = lal.CreateDict() 
-    else:
-        waveFlags = eob_parameters()
+@instrumented()
+def compute_modulus_quad(paramspoint, known_quad_bases, distance, deltaF, f_min, f_max, approximant, waveFlags=None):
+    hp_tmp = generate_a_waveform_from_paramspoint(paramspoint, distance, deltaF, f_min, f_max, approximant, waveFlags=waveFlags)
+    hp_quad_tmp = (numpy.absolute(hp_tmp))**2
+    residual = project_out(known_quad_bases, hp_quad_tmp)
+    modulus = numpy.linalg.norm(residual)
+    return modulus
 
-    m1, m2 = get_m1m2_from_mcq(paramspoint[0],paramspoint[1])
-    s1x, s1y, s1z = spherical_to_cartesian(paramspoint[2:5]) 
-    s2x, s2y, s2z = spherical_to_cartesian(paramspoint[5:8]) 
-    iota=paramspoint[8]  
-    phiRef=paramspoint[9]
-    ecc = 0
-    if len(paramspoint)==11:
-        ecc = paramspoint[10]
-    if len(paramspoint)==12:
-        lambda1 = paramspoint[10]
-        lambda2 = paramspoint[11]
-        if approximant not in TEOBResumS_version:
-            lalsimulation.SimInspiralWaveformParamsInsertTidalLambda1(waveFlags, lambda1)
-            lalsimulation.SimInspiralWaveformParamsInsertTidalLambda2(waveFlags, lambda2) 
-    f_ref = 0 
-    RA=0    
-    DEC=0   
-    psi=0   
-    phi=0   
-    m1 *= lal.lal.MSUN_SI
-    m2 *= lal.lal.MSUN_SI
-    
-    if approximant in TEOBResumS_version:
-        [plus, cross]  = generate_a_waveform_EOB(m1, m2, [s1x, s1y, s1z], [s2x, s2y, s2z], ecc, lambda1, lambda2, iota, phiRef, distance, deltaF, f_min, f_max, waveFlags, approximant)
-        hp_tmp = plus
+def start_pool(nprocesses, approximant=None, threads=0):
+    """
+    Worker pool kept alive for a whole basis build.
+    The workers get the waveform cache and the instrumentation, and load the waveform model of approximant at startup.
+    With threads=1 the workers are threads sharing the cache, the instrumentation, the model and the waveFlags of this process.
+    Generators that are not thread_safe, such as those writing the parameters of each waveform into waveFlags,
+    get process workers instead.
+    """
+    if threads and approximant is not None and not waveform_generator(approximant).thread_safe:
+        warnings.warn("The waveforms of "+str(approximant)+" cannot be generated by several threads at once, using processes instead.")
+        threads = 0
+    if threads:
+        if approximant is not None: waveform_generator(approximant).load(approximant)
+        return multiprocessing.pool.ThreadPool(processes=nprocesses)
+    return mp.Pool(processes=nprocesses, initializer=init_worker, initargs=(waveform_cache, approximant, instrumentation))
+
+def init_worker(cache, approximant, instr=None):
+    set_waveform_cache(cache)
+    set_instrumentation(instr)
+    if approximant is not None: waveform_generator(approximant).load(approximant)
+
+def stop_pool(pool):
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+def pool_chunksize(npts, nprocesses):
+    """
+    Number of points shipped to a worker per task,
+    same heuristic as multiprocessing.Pool.map
+    """
+    if nprocesses is None: nprocesses = available_cores()
+    chunksize, extra = divmod(npts, nprocesses*4)
+    if extra: chunksize += 1
+    return max(chunksize, 1)
+
+# Automatic execution ###
+# parallel=0 runs serially, parallel=1 on a process pool and parallel=2 on a thread pool.
+# parallel='auto' chooses among them from the measured cost of a pilot batch of waveforms (see execution_plan).
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'): return len(os.sched_getaffinity(0))
+    return mp.cpu_count()
+
+# Points of the sampled parameter space for the pilot batch, drawn without touching numpy's random generator
+def pilot_points(nparams, params_low, params_high, npilot=5):
+    return numpy.random.RandomState(0).uniform(params_low, params_high, size=(npilot, nparams)).round(decimals=6)
+
+# Seconds per call of function, averaged over repeat calls after a first one
+def _time_calls(function, repeat):
+    function()
+    start = time.perf_counter()
+    for i in range(repeat): function()
+    return (time.perf_counter() - start)/repeat
+
+def execution_plan(points, npts, distance, deltaF, f_min, f_max, approximant, nbases=None, quad=0, nprocesses=None, chunksize=None, evaluations=1, shared_bases=0, frequencies=None):
+    """
+    Chooses how to evaluate npts points, evaluations times on the same pool: returns parallel (0, 1 or 2), the number
+    of workers and the chunksize. The waveforms of the pilot points are timed, and the serial time is compared with,
+    for 2, 4, 8... workers up to nprocesses cores (all available ones if None),
+    - a process pool, which pays for pickling in this process the results (the waveforms if nbases is None, else a
+      residual modulus) and, once per chunk, the nbases bases shipped with the task (|h+|^2 bases if quad=1),
+      or only their handle if shared_bases=1 (see SharedBases), and for the startup of its workers, timed on one worker,
+    - a thread pool, whose speedup is measured on the pilot batch, if the waveform generator is thread-safe.
+    A pool is only chosen if it is estimated at least 20% faster than the serial evaluation.
+    The waveforms are timed at frequencies if given (see generate_a_waveform_at_frequencies), else on the full band.
+    """
+    if npts < 2 or len(points) < 2: return 0, 1, chunksize
+    generator = waveform_generator(approximant)
+    max_workers = available_cores() if nprocesses is None else min(nprocesses, available_cores())
+    worker_counts = sorted(set([2**k for k in range(1, int(numpy.log2(max(max_workers, 1)))+1)] + [max_workers]) - set([1]))
+    waveform = lambda paramspoint: generate_a_waveform_from_mcq_uncached(*paramspoint_to_parameters(paramspoint), distance, deltaF, f_min, f_max, generator.waveflags(approximant), approximant)
+    if frequencies is not None: waveform = lambda paramspoint: generate_a_waveform_at_frequencies(paramspoint, frequencies, distance, deltaF, f_min, f_max, approximant)
+    # the first waveform also loads the model
+    hps = [waveform(points[0])]
+    start = time.perf_counter()
+    hps += [waveform(paramspoint) for paramspoint in points[1:]]
+    waveform_time = (time.perf_counter() - start)/(len(points) - 1)
+    roundtrip = lambda payload: pickle.loads(pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL))
+    if nbases is None:
+        result_time, task_time = _time_calls(lambda: roundtrip((0, hps[0])), 3), 0.
+    elif shared_bases:
+        handle = SharedBases(os.path.join(tempfile.gettempdir(), 'pyroq_bases.dat'), (int(numpy.ceil(nbases)), len(hps[0])), numpy.float64 if quad else numpy.complex128, int(nbases))
+        result_time, task_time = _time_calls(lambda: roundtrip((0, 0.)), 3), _time_calls(lambda: roundtrip(handle), 3)
     else:
-        [plus,cross]=lalsimulation.SimInspiralChooseFDWaveform(m1, m2, s1x, s1y, s1z, s2x, s2y, s2z, distance, iota, phiRef, 0, ecc, 0, deltaF, f_min, f_max, f_ref, waveFlags, approximant)
-        hp_tmp = plus.data.data[numpy.int(f_min/deltaF):numpy.int(f_max/deltaF)] # data_tmp is hplus and is a complex vector 
+        # the pickling time of the pilot waveforms, scaled to nbases bases
+        pilot = numpy.array(hps, dtype=numpy.float64 if quad else numpy.complex128)
+        result_time, task_time = _time_calls(lambda: roundtrip((0, 0.)), 3), _time_calls(lambda: roundtrip(pilot), 3)*nbases/len(pilot)
+    serial = npts*waveform_time
+    # (mode, workers) -> (estimated time, chunksize)
+    estimates = {('serial', 1): (serial, chunksize)}
+    if worker_counts: startup_one = _time_calls(lambda: stop_pool(start_pool(1, approximant)), 1)
+    for nworkers in worker_counts:
+        nchunksize = chunksize
+        if nchunksize is None:
+            nchunksize = max(pool_chunksize(npts, nworkers), int(numpy.ceil(10*task_time/waveform_time)))
+            nchunksize = min(nchunksize, int(numpy.ceil(npts/float(nworkers))))
+        ipc = int(numpy.ceil(npts/float(nchunksize)))*task_time + npts*result_time
+        estimates[('processes', nworkers)] = (max(serial/nworkers, ipc) + nworkers*startup_one/evaluations, nchunksize)
+        if generator.thread_safe:
+            pool = start_pool(nworkers, approximant, threads=1)
+            try:
+                batch = [points[i % len(points)] for i in range(max(2*nworkers, len(points)))]
+                estimates[('threads', nworkers)] = (npts*_time_calls(lambda: pool.map(waveform, batch), 1)/len(batch), nchunksize)
+            finally:
+                stop_pool(pool)
+    best = min(estimates, key=lambda plan: estimates[plan][0])
+    if estimates[best][0] > 0.8*serial: best = ('serial', 1)
+    (execution, nworkers), chunksize = best, estimates[best][1]
+    parallel = {'serial': 0, 'processes': 1, 'threads': 2}[execution]
+    times = {"{} {}".format(*plan): estimate[0] for plan, estimate in estimates.items()}
+    print("Automatic execution:", execution, "with", nworkers, "workers, {:.3g} s per waveform,".format(waveform_time), "estimated", ", ".join("{} {:.3g} s".format(k, v) for k, v in times.items()), "for", npts, "points")
+    record_event('execution_plan', execution=execution, nprocesses=nworkers, chunksize=chunksize, waveform_time=waveform_time, task_time=task_time, result_time=result_time, estimates=times)
+    return parallel, nworkers, chunksize
 
-    hp_quad_tmp = (numpy.absolute(hp_tmp))**2
-    residual = hp_quad_tmp
-    for k in numpy.arange(0,len(known_quad_bases)):
-        residual -= proj(known_quad_bases[k],hp_quad_tmp)
-    modulus = numpy.sqrt(numpy.vdot(residual, residual))
-    return modulus
+# execution_plan for a basis build: with training_set=1 the waveforms are generated once and sent back to this process,
+# the other searches send the handle of the bases in shared memory (see BasisStore) to the workers at each of the
+# nbases-1 iterations (taken as 10 if nbases is None)
+def build_execution_plan(training_set, npts, nparams, params_low, params_high, known_bases, nbases, distance, deltaF, f_min, f_max, approximant, quad=0, nprocesses=None, chunksize=None):
+    if training_set == 1: return execution_plan(pilot_points(nparams, params_low, params_high), npts, distance, deltaF, f_min, f_max, approximant, nprocesses=nprocesses, chunksize=chunksize)
+    average_bases = (len(known_bases) + (greedy_capacity(known_bases, nbases) or len(known_bases)))/2.
+    evaluations = 10 if nbases is None else max(nbases-1, 1)
+    return execution_plan(pilot_points(nparams, params_low, params_high), npts, distance, deltaF, f_min, f_max, approximant, nbases=average_bases, quad=quad, nprocesses=nprocesses, chunksize=chunksize, evaluations=evaluations, shared_bases=1)
+
+# end automatic execution ###
+
+# waveFlags sent to the workers of pool. LAL dictionaries cannot be pickled, process workers then use the default flags of the approximant.
+def pool_waveflags(pool, waveFlags):
+    if waveFlags is None or isinstance(pool, multiprocessing.pool.ThreadPool): return waveFlags
+    try:
+        pickle.dumps(waveFlags)
+    except (TypeError, AttributeError, pickle.PicklingError):
+        warnings.warn("waveFlags cannot be sent to worker processes, they use the default flags of the approximant.")
+        return None
+    return waveFlags
+
+def _indexed_modulus(item, modulus_function, known_bases, distance, deltaF, f_min, f_max, approximant, waveFlags=None):
+    # runs in the workers; the index travels with the result since imap_unordered does not keep the order
+    i, paramspoint = item
+    if isinstance(known_bases, SharedBases): known_bases = known_bases.array()
+    return i, modulus_function(paramspoint, known_bases, distance, deltaF, f_min, f_max, approximant, waveFlags=waveFlags)
+
+@instrumented()
+def parallel_modula(pool, nprocesses, modulus_function, paramspoints, known_bases, distance, deltaF, f_min, f_max, approximant, chunksize=None, shared_bases=None, waveFlags=None):
+    """
+    Residual modula of all paramspoints, evaluated asynchronously on the workers of pool.
+    Points are dispatched in chunks of chunksize and collected as they complete.
+    If shared_bases (see BasisStore.shared_bases) is given, it is sent to the workers instead of known_bases.
+    """
+    npts = len(paramspoints)
+    if chunksize is None: chunksize = pool_chunksize(npts, nprocesses)
+    if shared_bases is not None: known_bases = shared_bases
+    task = functools.partial(_indexed_modulus, modulus_function=modulus_function, known_bases=known_bases, distance=distance, deltaF=deltaF, f_min=f_min, f_max=f_max, approximant=approximant, waveFlags=pool_waveflags(pool, waveFlags))
+    modula = numpy.zeros(npts)
+    for i, modulus in pool.imap_unordered(task, enumerate(paramspoints.tolist()), chunksize=chunksize):
+        modula[i] = modulus
+    return modula
+
+def _indexed_waveform(item, distance, deltaF, f_min, f_max, approximant, quad, waveFlags=None):
+    i, paramspoint = item
+    hp = generate_a_waveform_from_paramspoint(paramspoint, distance, deltaF, f_min, f_max, approximant, waveFlags=waveFlags)
+    if quad: hp = (numpy.absolute(hp))**2
+    return i, hp
+
+@instrumented()
+def generate_training_waveforms(parallel, nprocesses, paramspoints, distance, deltaF, f_min, f_max, approximant, quad=0, pool=None, chunksize=None, storage=None, dtype=None, waveFlags=None):
+    """
+    Training matrix with one waveform per row, |h+|^2 instead of h+ if quad=1.
+    Every waveform of the training set is generated only once here, with waveFlags (the defaults of approximant if None).
+    If storage is a file name the matrix is written there row by row (see open_training_matrix).
+    dtype is the storage precision of the matrix, that of the waveforms if None.
+    """
+    if parallel == 'auto': parallel, nprocesses, chunksize = execution_plan(paramspoints[:5], len(paramspoints), distance, deltaF, f_min, f_max, approximant, nprocesses=nprocesses, chunksize=chunksize)
+    task = functools.partial(_indexed_waveform, distance=distance, deltaF=deltaF, f_min=f_min, f_max=f_max, approximant=approximant, quad=quad, waveFlags=waveFlags)
+    items = enumerate(paramspoints.tolist())
+    if parallel in (1, 2):
+        own_pool = pool is None
+        if own_pool: pool = start_pool(nprocesses, approximant, parallel == 2)
+        if chunksize is None: chunksize = pool_chunksize(len(paramspoints), nprocesses)
+        task = functools.partial(task, waveFlags=pool_waveflags(pool, waveFlags))
+        try:
+            return collect_training_waveforms(pool.imap_unordered(task, items, chunksize=chunksize), len(paramspoints), storage, dtype)
+        finally:
+            if own_pool: stop_pool(pool)
+    return collect_training_waveforms(map(task, items), len(paramspoints), storage, dtype)
+
+def collect_training_waveforms(results, npts, storage, dtype=None):
+    if storage is None:
+        results = sorted(results, key=lambda result: result[0])
+        return numpy.array([hp for i, hp in results], dtype=dtype)
+    matrix = None
+    for i, hp in results:
+        if matrix is None: matrix = open_training_matrix(storage, (npts, len(hp)), hp.dtype if dtype is None else dtype)
+        matrix[i] = hp
+    flush_training_matrix(matrix)
+    return matrix
+
+# Out-of-core training sets ###
+# For long signals the (npts x L) training matrix does not fit in memory. It can then live in a file,
+# a numpy.memmap (.npy) or an HDF5 dataset (.h5/.hdf5), which is only ever read and written in blocks of rows.
+
+# Opens the (npts x L) training matrix in the file storage, a new one if mode='w', an existing one if mode='r+'.
+# The matrix is a plain array in memory if storage is None.
+def open_training_matrix(storage, shape=None, dtype=None, mode='w'):
+    if storage is None: return numpy.empty(shape, dtype=dtype)
+    if os.path.splitext(storage)[1] in ('.h5', '.hdf5'):
+        if mode == 'r+': return h5py.File(storage, 'r+')['training']
+        return h5py.File(storage, 'w').create_dataset('training', shape=shape, dtype=dtype, chunks=(1, shape[1]))
+    return numpy.lib.format.open_memmap(storage, mode='w+' if mode == 'w' else 'r+', dtype=dtype, shape=shape)
+
+def flush_training_matrix(matrix):
+    if isinstance(matrix, numpy.memmap): matrix.flush()
+    if isinstance(matrix, h5py.Dataset) and matrix.id.valid: matrix.file.flush()
+
+# Closes the HDF5 file of a training matrix, so that it can be opened again (e.g. in mode 'w' by a new build)
+def close_training_matrix(matrix):
+    flush_training_matrix(matrix)
+    if isinstance(matrix, h5py.Dataset) and matrix.id.valid: matrix.file.close()
+
+# File of a training matrix, None if it is in memory
+def training_storage_name(matrix):
+    if isinstance(matrix, numpy.memmap): return matrix.filename
+    if isinstance(matrix, h5py.Dataset): return matrix.file.filename
+    return None
+
+# File of the |h+|^2 matrix next to the file of the h+ one
+def quad_storage_name(storage):
+    if storage is None: return None
+    root, ext = os.path.splitext(storage)
+    return root+'_quad'+ext
+
+# Number of rows of a block of matrix within memory_budget bytes, leaving room for the temporaries of the block operations
+def block_rows(matrix, memory_budget):
+    row_nbytes = matrix.shape[1]*numpy.dtype(matrix.dtype).itemsize
+    return max(1, int(memory_budget//(4*row_nbytes)))
+
+# |h+|^2 matrix of a training matrix, computed block by block
+def squared_training_matrix(training_waveforms, storage=None, memory_budget=2**30, dtype=numpy.float64):
+    squared = open_training_matrix(storage, training_waveforms.shape, dtype)
+    rows = block_rows(training_waveforms, memory_budget)
+    for start in range(0, len(training_waveforms), rows):
+        stop = min(start+rows, len(training_waveforms))
+        squared[start:stop] = (numpy.absolute(training_waveforms[start:stop]))**2
+    flush_training_matrix(squared)
+    return squared
+
+class TrainingSet(object):
+    """
+    Fixed training set: its points and the residuals of their waveforms from the bases found so far.
+    The residual matrix is in memory or on disk (see open_training_matrix) and is processed in blocks of rows
+    within memory_budget bytes, in double precision whatever the storage precision of the matrix.
+    New bases are first kept pending: they are projected out of every block that
+    is read, and out of the stored matrix in a single pass by flush(). flush() is called once max_pending
+    bases are pending (never if max_pending is None), so an on-disk matrix is not rewritten at every iteration.
+    """
+    def __init__(self, points, residuals, memory_budget=2**30, max_pending=1):
+        self.points = points
+        self.residuals = residuals
+        self.memory_budget = memory_budget
+        self.max_pending = max_pending
+        self.pending = []
+
+    def __len__(self):
+        return len(self.points)
+
+    @property
+    def storage(self):
+        return training_storage_name(self.residuals)
+
+    def blocks(self):
+        rows = block_rows(self.residuals, self.memory_budget)
+        for start in range(0, len(self.residuals), rows):
+            yield slice(start, min(start+rows, len(self.residuals)))
+
+    def _read(self, rows):
+        block = self.residuals[rows]
+        return numpy.asarray(block, dtype=numpy.result_type(block.dtype, numpy.float64))
+
+    def _updated(self, block):
+        if not self.pending: return block
+        return project_out(numpy.array(self.pending), block, passes=1)
+
+    def modula(self):
+        modula = numpy.empty(len(self.residuals))
+        for rows in self.blocks():
+            modula[rows] = numpy.linalg.norm(self._updated(self._read(rows)), axis=1)
+        return modula
+
+    def residual(self, i):
+        return self._updated(self._read(slice(i, i+1)))[0]
+
+    # Index and modulus of the largest residual
+    def largest_residual(self):
+        modula = self.modula()
+        i = numpy.argmax(modula)
+        return i, modula[i]
+
+    # Removes the (orthonormal) bases from all stored residuals in one pass over the matrix
+    def project_out(self, bases, passes=2):
+        for rows in self.blocks():
+            self.residuals[rows] = project_out(bases, self._read(rows), passes=passes)
+        flush_training_matrix(self.residuals)
+
+    def add_basis(self, basis):
+        self.pending.append(basis)
+        if self.max_pending is not None and len(self.pending) >= self.max_pending: self.flush()
+
+    def flush(self):
+        if not self.pending: return
+        pending, self.pending = numpy.array(self.pending), []
+        self.project_out(pending, passes=1)
+
+    # Releases the file of the residuals, bases still pending are not written (see flush)
+    def close(self):
+        close_training_matrix(self.residuals)
+
+# Bases pending in an on-disk training set are written back every checkpoint_every iterations,
+# right after the checkpoint if there is one (see save_checkpoint). In memory they are applied at once.
+def training_max_pending(training_storage, checkpoint, checkpoint_every):
+    if training_storage is None: return 1
+    if checkpoint is not None: return None
+    return checkpoint_every
+
+# Training set at training_points, with the residuals of their waveforms (|h+|^2 if quad=1) from known_bases, stored in dtype
+# With an MPI communicator comm, only the waveforms of the shard of this rank are generated, see DistributedTrainingSet.
+@instrumented()
+def build_training_set(parallel, nprocesses, training_points, known_bases, distance, deltaF, f_min, f_max, approximant, quad=0, pool=None, chunksize=None, training_storage=None, memory_budget=2**30, max_pending=1, dtype=None, comm=None, waveFlags=None):
+    shard = slice(None) if comm is None else mpi_shard(len(training_points), comm)
+    training_waveforms = generate_training_waveforms(parallel, nprocesses, training_points[shard], distance, deltaF, f_min, f_max, approximant, quad=quad, pool=pool, chunksize=chunksize, storage=mpi_storage_name(training_storage, comm), dtype=dtype, waveFlags=waveFlags)
+    training = make_training_set(training_points, training_waveforms, memory_budget, max_pending, comm)
+    training.project_out(known_bases)
+    return training
+
+# end out-of-core training sets ###
+
+# Distributed construction ###
+# With mpi4py, the greedy searches on a fixed training set and the validation run on all the ranks of an MPI
+# communicator comm (e.g. MPI.COMM_WORLD, started with mpirun -n 4 python script.py). Every rank generates and keeps
+# a contiguous shard of the training waveforms and of the test waveforms. The largest residual is found by a reduction
+# and the new basis is broadcast from the rank that owns it, so the bases, the nodes and the results are the same on
+# all ranks and the same as those of a single process. The random points are drawn on rank 0 only, which alone writes files.
+
+# Rows of n points owned by the rank of comm
+def mpi_shard(n, comm):
+    rank, size = comm.Get_rank(), comm.Get_size()
+    return slice(n*rank//size, n*(rank+1)//size)
+
+# Rank of comm owning row i of n
+def mpi_owner(i, n, comm):
+    return next(rank for rank in range(comm.Get_size()) if i < n*(rank+1)//comm.Get_size())
+
+# True on the rank writing the files (any process without comm)
+def mpi_root(comm):
+    return comm is None or comm.Get_rank() == 0
+
+# File of the shard of this rank, next to storage
+def mpi_storage_name(storage, comm):
+    if storage is None or comm is None: return storage
+    root, ext = os.path.splitext(storage)
+    return root+'_rank'+str(comm.Get_rank())+ext
+
+# Random points drawn on rank 0 and sent to all ranks, see generate_params_points
+def broadcast_params_points(npts, nparams, params_low, params_high, comm=None):
+    if comm is None: return generate_params_points(npts, nparams, params_low, params_high)
+    paramspoints = generate_params_points(npts, nparams, params_low, params_high) if comm.Get_rank() == 0 else None
+    return comm.bcast(paramspoints, root=0)
+
+# Surrogate errors of all ranks, in the order of the test points
+def gather_errors(errors, comm=None):
+    if comm is None: return errors
+    return numpy.concatenate(comm.allgather(errors))
+
+def check_distributed(comm, training_set=1, checkpoint=None):
+    if comm is None: return
+    if MPI is None: raise ImportError("The distributed construction needs mpi4py.")
+    if training_set != 1 or checkpoint is not None:
+        raise ValueError("Distributed greedy searches need a fixed training set (training_set=1) and do not support checkpoints.")
+
+class DistributedTrainingSet(TrainingSet):
+    """
+    Training set spread over the ranks of comm: points holds all the training points, residuals only the rows of
+    the shard of this rank (see mpi_shard). The largest residual is a MAXLOC reduction over the ranks, which like
+    numpy.argmax returns the first of equal maxima, and residual(i) is broadcast from the rank owning row i.
+    """
+    def __init__(self, points, residuals, memory_budget=2**30, max_pending=1, comm=None):
+        TrainingSet.__init__(self, points, residuals, memory_budget, max_pending)
+        self.comm = comm
+        self.shard = mpi_shard(len(points), comm)
+
+    def residual(self, i):
+        owner = mpi_owner(i, len(self.points), self.comm)
+        residual = TrainingSet.residual(self, i-self.shard.start) if owner == self.comm.Get_rank() else None
+        return self.comm.bcast(residual, root=owner)
+
+    def largest_residual(self):
+        if len(self.residuals):
+            i, modulus = TrainingSet.largest_residual(self)
+            local = (float(modulus), self.shard.start+int(i))
+        else:
+            local = (-numpy.inf, len(self.points))
+        modulus, i = self.comm.allreduce(local, op=MPI.MAXLOC)
+        return i, modulus
+
+def make_training_set(points, residuals, memory_budget=2**30, max_pending=1, comm=None):
+    if comm is None: return TrainingSet(points, residuals, memory_budget, max_pending)
+    return DistributedTrainingSet(points, residuals, memory_budget, max_pending, comm)
+
+# end distributed construction ###
+
+# Greedy step on a fixed training set: the point with the largest residual becomes the new basis,
+# which is then removed from the stored residuals (rank-1 update, see TrainingSet),
+# so no waveform needs to be generated again.
+# If the largest residual is below greedy_tolerance the residuals are left untouched.
+@instrumented()
+def least_match_training_set(training, known_bases, greedy_tolerance=None):
+    arg_newbasis, rm_new = training.largest_residual()
+    if greedy_tolerance is not None and rm_new < greedy_tolerance:
+        return None, training.points[arg_newbasis], rm_new
+    basis_new = gram_schmidt(known_bases, training.residual(arg_newbasis))
+    training.add_basis(basis_new)
+    return basis_new, training.points[arg_newbasis], rm_new # elements, masses&spins, residual mod
 
 # now generating N=npts waveforms at points that are 
 # randomly uniformly distributed in parameter space
 # and calculate their inner products with the 1st waveform
 # so as to find the best waveform as the new basis
-def least_match_waveform_unnormalized(parallel, nprocesses, paramspoints, known_bases, distance, deltaF, f_min, f_max, waveFlags, approximant):
-    if parallel == 1:
-        paramspointslist = paramspoints.tolist()
-        #pool = mp.Pool(mp.cpu_count())
-        pool = mp.Pool(processes=nprocesses)
-        modula = [pool.apply(compute_modulus, args=(paramspoint, known_bases, distance, deltaF, f_min, f_max, approximant)) for paramspoint in paramspointslist]
-        pool.close()
+# pool is the persistent worker pool of the basis build, a temporary one is started if None
+# shared_bases is the shared memory handle of known_bases for the process workers, see BasisStore.shared_bases
+@instrumented()
+def least_match_waveform_unnormalized(parallel, nprocesses, paramspoints, known_bases, distance, deltaF, f_min, f_max, waveFlags, approximant, pool=None, chunksize=None, shared_bases=None):
+    if parallel == 'auto': parallel, nprocesses, chunksize = execution_plan(paramspoints[:5], len(paramspoints), distance, deltaF, f_min, f_max, approximant, nbases=len(known_bases), nprocesses=nprocesses, chunksize=chunksize)
+    if parallel in (1, 2):
+        own_pool = pool is None
+        if own_pool: pool = start_pool(nprocesses, approximant, parallel == 2)
+        try:
+            modula = parallel_modula(pool, nprocesses, compute_modulus, paramspoints, known_bases, distance, deltaF, f_min, f_max, approximant, chunksize=chunksize, shared_bases=shared_bases, waveFlags=waveFlags)
+        finally:
+            if own_pool: stop_pool(pool)
     if parallel == 0:
         npts = len(paramspoints)
         modula = numpy.zeros(npts)
         for i in numpy.arange(0,npts):
             paramspoint = paramspoints[i]
-            modula[i] = compute_modulus(paramspoint, known_bases, distance, deltaF, f_min, f_max, approximant)
+            modula[i] = compute_modulus(paramspoint, known_bases, distance, deltaF, f_min, f_max, approximant, waveFlags=waveFlags)
     arg_newbasis = numpy.argmax(modula) 
-    paramspoint = paramspoints[arg_newbasis]
-    mass1, mass2 = get_m1m2_from_mcq(paramspoints[arg_newbasis][0],paramspoints[arg_newbasis][1])
-    mass1 *= lal.lal.MSUN_SI
-    mass2 *= lal.lal.MSUN_SI
-    sp1x, sp1y, sp1z = spherical_to_cartesian(paramspoints[arg_newbasis,2:5]) 
-    sp2x, sp2y, sp2z = spherical_to_cartesian(paramspoints[arg_newbasis,5:8]) 
-    inclination = paramspoints[arg_newbasis][8]
-    phi_ref = paramspoints[arg_newbasis][9]
-    ecc = 0
-    if len(paramspoint)==11:
-        ecc = paramspoints[arg_newbasis][10]
-    if len(paramspoint)==12:
-        lambda1 = paramspoints[arg_newbasis][10]
-        lambda2 = paramspoints[arg_newbasis][11]
-        if approximant not in TEOBResumS_version:
-            lalsimulation.SimInspiralWaveformParamsInsertTidalLambda1(waveFlags, lambda1)
-            lalsimulation.SimInspiralWaveformParamsInsertTidalLambda2(waveFlags, lambda2) 
-
-    if approximant in TEOBResumS_version:
-        [plus_new, cross_new]  = generate_a_waveform_EOB(mass1, mass2, [sp1x, sp1y, sp1z], [sp2x, sp2y, sp2z], ecc, lambda1, lambda2, inclination, phi_ref, distance, deltaF, f_min, f_max, waveFlags, approximant)
-        hp_new = plus_new
-    else:
-        [plus_new, cross_new]=lalsimulation.SimInspiralChooseFDWaveform(mass1, mass2, sp1x, sp1y, sp1z, sp2x, sp2y, sp2z, distance, inclination, phi_ref, 0, ecc, 0, deltaF, f_min, f_max, 0, waveFlags, approximant)
-        hp_new = plus_new.data.data
-        hp_new = hp_new[numpy.int(f_min/deltaF):numpy.int(f_max/deltaF)]
-
+    hp_new = generate_a_waveform_from_paramspoint(paramspoints[arg_newbasis], distance, deltaF, f_min, f_max, approximant, waveFlags=waveFlags)
     basis_new = gram_schmidt(known_bases, hp_new)
-    return numpy.array([basis_new, paramspoints[arg_newbasis], modula[arg_newbasis]]) # elements, masses&spins, residual mod
+    return basis_new, paramspoints[arg_newbasis], modula[arg_newbasis] # elements, masses&spins, residual mod
 
 
-def least_match_quadratic_waveform_unnormalized(parallel, nprocesses, paramspoints, known_quad_bases, distance, deltaF, f_min, f_max, waveFlags, approximant):
-    if parallel == 1:
-        paramspointslist = paramspoints.tolist()
-        pool = mp.Pool(processes=nprocesses)
-        modula = [pool.apply(compute_modulus_quad, args=(paramspoint, known_quad_bases, distance, deltaF, f_min, f_max, approximant)) for paramspoint in paramspointslist]
-        pool.close()
+@instrumented()
+def least_match_quadratic_waveform_unnormalized(parallel, nprocesses, paramspoints, known_quad_bases, distance, deltaF, f_min, f_max, waveFlags, approximant, pool=None, chunksize=None, shared_bases=None):
+    if parallel == 'auto': parallel, nprocesses, chunksize = execution_plan(paramspoints[:5], len(paramspoints), distance, deltaF, f_min, f_max, approximant, nbases=len(known_quad_bases), quad=1, nprocesses=nprocesses, chunksize=chunksize)
+    if parallel in (1, 2):
+        own_pool = pool is None
+        if own_pool: pool = start_pool(nprocesses, approximant, parallel == 2)
+        try:
+            modula = parallel_modula(pool, nprocesses, compute_modulus_quad, paramspoints, known_quad_bases, distance, deltaF, f_min, f_max, approximant, chunksize=chunksize, shared_bases=shared_bases, waveFlags=waveFlags)
+        finally:
+            if own_pool: stop_pool(pool)
     if parallel == 0:
         npts = len(paramspoints)
         modula = numpy.zeros(npts)
         for i in numpy.arange(0,npts):
             paramspoint = paramspoints[i]
-            modula[i] = compute_modulus_quad(paramspoint, known_quad_bases, distance, deltaF, f_min, f_max, approximant)
+            modula[i] = compute_modulus_quad(paramspoint, known_quad_bases, distance, deltaF, f_min, f_max, approximant, waveFlags=waveFlags)
     arg_newbasis = numpy.argmax(modula)    
-    paramspoint = paramspoints[arg_newbasis]
-    mass1, mass2 = get_m1m2_from_mcq(paramspoints[arg_newbasis][0],paramspoints[arg_newbasis][1])
-    mass1 *= lal.lal.MSUN_SI
-    mass2 *= lal.lal.MSUN_SI
-    sp1x, sp1y, sp1z = spherical_to_cartesian(paramspoints[arg_newbasis,2:5]) 
-    sp2x, sp2y, sp2z = spherical_to_cartesian(paramspoints[arg_newbasis,5:8]) 
-    inclination = paramspoints[arg_newbasis][8]
-    phi_ref = paramspoints[arg_newbasis][9]
-    ecc = 0
-    if len(paramspoint)==11:
-        ecc = paramspoints[arg_newbasis][10]
-    if len(paramspoint)==12:
-        lambda1 = paramspoints[arg_newbasis][10]
-        lambda2 = paramspoints[arg_newbasis][11]
-        if approximant not in TEOBResumS_version:
-            lalsimulation.SimInspiralWaveformParamsInsertTidalLambda1(waveFlags, lambda1)
-            lalsimulation.SimInspiralWaveformParamsInsertTidalLambda2(waveFlags, lambda2)     
-
-    if approximant in TEOBResumS_version:
-        [plus_new, cross_new]  = generate_a_waveform_EOB(mass1, mass2, [sp1x, sp1y, sp1z], [sp2x, sp2y, sp2z], ecc, lambda1, lambda2, inclination, phi_ref, distance, deltaF, f_min, f_max, waveFlags, approximant)
-        hp_new = plus_new
-    else:
-        [plus_new, cross_new]=lalsimulation.SimInspiralChooseFDWaveform(mass1, mass2, sp1x, sp1y, sp1z, sp2x, sp2y, sp2z, distance, inclination, phi_ref, 0, ecc, 0, deltaF, f_min, f_max, 0, waveFlags, approximant)
-        hp_new = plus_new.data.data
-        hp_new = hp_new[numpy.int(f_min/deltaF):numpy.int(f_max/deltaF)]
-        
+    hp_new = generate_a_waveform_from_paramspoint(paramspoints[arg_newbasis], distance, deltaF, f_min, f_max, approximant, waveFlags=waveFlags)
     hp_quad_new = (numpy.absolute(hp_new))**2
     basis_quad_new = gram_schmidt(known_quad_bases, hp_quad_new)    
-    return numpy.array([basis_quad_new, paramspoints[arg_newbasis], modula[arg_newbasis]]) # elements, masses&spins, residual mod
+    return basis_quad_new, paramspoints[arg_newbasis], modula[arg_newbasis] # elements, masses&spins, residual mod
+
+# Shared basis matrices ###
+# Process workers evaluating residual modula get a SharedBases handle instead of the (k x L) basis matrix:
+# they map the file of the matrix once, in shared memory (/dev/shm) where available, and read its first k rows
+# in place, so an iteration sends them only the number of bases. New bases are written in place between iterations.
+
+# Basis matrices mapped by this (worker) process, by file
+attached_bases = {}
+
+class SharedBases(object):
+    """
+    The first count rows of the (capacity x L) basis matrix in the file path.
+    """
+    def __init__(self, path, shape, dtype, count):
+        self.path = path
+        self.shape = shape
+        self.dtype = dtype
+        self.count = count
+
+    def array(self):
+        if self.path not in attached_bases:
+            # the files of outgrown matrices have been removed by the parent
+            attached_bases.clear()
+            attached_bases[self.path] = numpy.memmap(self.path, dtype=self.dtype, mode='r', shape=self.shape)
+        return attached_bases[self.path][:self.count]
+
+# Empty matrix mapped to a new file in shared memory, returns the file and the matrix.
+# The file is removed at the latest when the matrix is garbage collected or this process exits.
+def shared_matrix(shape, dtype):
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    fd, path = tempfile.mkstemp(prefix='pyroq_bases_', suffix='.dat', dir=directory)
+    os.close(fd)
+    matrix = numpy.memmap(path, dtype=dtype, mode='w+', shape=shape)
+    weakref.finalize(matrix, remove_shared_matrix, path)
+    return path, matrix
+
+# The mappings of a removed file stay valid until they are garbage collected
+def remove_shared_matrix(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+# end shared basis matrices ###
+
+class BasisStore(object):
+    """
+    Bases found by the greedy search, with their parameters and residual modula.
+    Rows are kept in a preallocated buffer whose capacity doubles when it is full,
+    so adding a basis does not copy the whole (k x L) matrix.
+    dtype sets the storage precision of the bases (e.g. numpy.complex64, numpy.float32).
+    With shared=1 the buffer is a file in shared memory (see SharedBases), removed by close().
+    """
+    def __init__(self, known_bases, params, residual_modula, capacity=None, dtype=None, shared=0):
+        known_bases = numpy.asarray(known_bases)
+        params = numpy.asarray(params)
+        if dtype is None: dtype = known_bases.dtype
+        self.count = len(known_bases)
+        if capacity is None: capacity = 2*self.count
+        capacity = max(capacity, self.count, 1)
+        self._shared_path = None
+        if shared:
+            self._shared_path, self._bases = shared_matrix((capacity, known_bases.shape[1]), dtype)
+        else:
+            self._bases = numpy.empty((capacity, known_bases.shape[1]), dtype=dtype)
+        self._params = numpy.empty((capacity,)+params.shape[1:], dtype=params.dtype)
+        self._residual_modula = numpy.empty(capacity)
+        self._bases[:self.count] = known_bases
+        self._params[:self.count] = params
+        self._residual_modula[:self.count] = residual_modula
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def capacity(self):
+        return len(self._bases)
+
+    @property
+    def bases(self):
+        return self._bases[:self.count]
+
+    @property
+    def params(self):
+        return self._params[:self.count]
+
+    @property
+    def residual_modula(self):
+        return self._residual_modula[:self.count]
+
+    def _grow(self, capacity):
+        old_path = self._shared_path
+        for name in ('_bases', '_params', '_residual_modula'):
+            old = getattr(self, name)
+            if name == '_bases' and old_path is not None:
+                self._shared_path, new = shared_matrix((capacity,)+old.shape[1:], old.dtype)
+            else:
+                new = numpy.empty((capacity,)+old.shape[1:], dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+        if old_path is not None: remove_shared_matrix(old_path)
+
+    # handle of the bases for the process workers, None if they are not in shared memory
+    def shared_bases(self):
+        if self._shared_path is None: return None
+        return SharedBases(self._shared_path, self._bases.shape, self._bases.dtype, self.count)
+
+    # moves the bases out of shared memory
+    def close(self):
+        if self._shared_path is None: return
+        self._bases = numpy.array(self._bases)
+        remove_shared_matrix(self._shared_path)
+        self._shared_path = None
+
+    def append(self, basis, params, residual_modulus):
+        if self.count == self.capacity: self._grow(2*self.capacity)
+        self._bases[self.count] = basis
+        self._params[self.count] = params
+        self._residual_modula[self.count] = residual_modulus
+        self.count += 1
+
+    def save(self, bases_file, params_file):
+        numpy.save(bases_file, self.bases)
+        numpy.save(params_file, self.params)
+
+# Iteration counter of the greedy searches: nbases-1 iterations, unbounded if nbases is None
+def greedy_iterations(nbases, start=0):
+    k = start
+    while nbases is None or k < nbases-1:
+        yield k
+        k += 1
+
+def greedy_capacity(known_bases, nbases):
+    if nbases is None: return None
+    return len(known_bases)+nbases-1
+
+# Tolerance-driven stopping: the search ends once the largest residual modulus (greedy error) is below greedy_tolerance
+# Every iteration is reported to the instrumentation, see Instrumentation
+def greedy_converged(rm_new, greedy_tolerance, label, nbases_found):
+    record_event('greedy_iteration', search=label, nbases=nbases_found, greedy_error=rm_new)
+    if greedy_tolerance is None or rm_new >= greedy_tolerance: return False
+    print(label, "greedy error", rm_new, "is below", greedy_tolerance, "with", nbases_found, "basis elements")
+    return True
 
-def bases_searching_results_unnormalized(parallel, nprocesses, npts, nparams, nbases, known_bases, basis_waveforms, params, residual_modula, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant):
+# Reduced-precision bases (see BasisStore) are rounded after every Gram-Schmidt step, so they are only orthonormal to
+# their own precision. Reports the largest greedy error, on the waveforms (|h+|^2 if quad=1) of npoints points of the
+# parameter space, with the stored bases and with the same bases orthonormalized again in double precision, and warns if
+# the rounding adds more than greedy_tolerance. Returns the two errors, None for double-precision bases.
+def report_precision_error(bases, label, nparams, params_low, params_high, distance, deltaF, f_min, f_max, approximant, quad=0, waveFlags=None, greedy_tolerance=None, npoints=10):
+    if numpy.finfo(bases.dtype).eps <= numpy.finfo(numpy.float64).eps: return None
+    hps = numpy.array([generate_a_waveform_from_paramspoint(paramspoint, distance, deltaF, f_min, f_max, approximant, waveFlags=waveFlags) for paramspoint in pilot_points(nparams, params_low, params_high, npoints)])
+    if quad: hps = numpy.absolute(hps)**2
+    stored = numpy.asarray(bases, dtype=numpy.result_type(bases.dtype, numpy.float64))
+    orthonormal = numpy.transpose(numpy.linalg.qr(numpy.transpose(stored))[0])
+    error = numpy.max(numpy.linalg.norm(project_out(orthonormal, hps), axis=1))
+    error_stored = numpy.max(numpy.linalg.norm(project_out(stored, hps), axis=1))
+    print("Storing the", label, "bases as", bases.dtype.name, "changes the greedy error on", npoints, "points from", error, "to", error_stored)
+    record_event('precision_error', search=label, dtype=bases.dtype.name, greedy_error=error, greedy_error_stored=error_stored)
+    if greedy_tolerance is not None and error_stored - error > greedy_tolerance:
+        warnings.warn("The "+label+" bases in "+bases.dtype.name+" add more than the greedy tolerance "+str(greedy_tolerance)+" to the greedy error, store them in double precision.")
+    return error, error_stored
+
+# Checkpoints of the greedy searches ###
+# A checkpoint is a single .npz file with the bases, their parameters and residual modula, the number of
+# completed iterations, the state of numpy's random generator and, for training-set searches, the training
+# points and their residuals. It is written under a temporary name and renamed, so a job killed while
+# writing leaves the previous checkpoint intact.
+# On-disk training residuals are not copied, the checkpoint records their file instead. The bases found since
+# the previous checkpoint are projected out of that file only after the checkpoint is written, and a resumed
+# search projects all the checkpoint bases out of it again: this completes an interrupted update and
+# leaves a finished one unchanged.
+
+def greedy_state(store, iteration, training=None, suffix=''):
+    state = {'bases'+suffix: store.bases, 'params'+suffix: store.params, 'residual_modula'+suffix: store.residual_modula, 'iteration'+suffix: iteration}
+    if training is not None:
+        state['training_points'] = training.points
+        if training.storage is None:
+            training.flush()
+            state['training_residuals'+suffix] = training.residuals
+        else:
+            state['training_storage'+suffix] = training.storage
+    return state
+
+# trainings are the training sets of the state, whose pending bases are written back once the checkpoint is saved
+def save_checkpoint(checkpoint, state, *trainings):
+    rng_name, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = numpy.random.get_state()
+    tmp_checkpoint = checkpoint+'.tmp'
+    with open(tmp_checkpoint, 'wb') as f:
+        numpy.savez(f, rng_keys=rng_keys, rng_pos=rng_pos, rng_has_gauss=rng_has_gauss, rng_cached_gaussian=rng_cached_gaussian, **state)
+    os.replace(tmp_checkpoint, checkpoint)
+    for training in trainings:
+        if training is not None: training.flush()
+
+# Returns the saved state as a dict and restores numpy's random generator, None if there is no checkpoint
+def load_checkpoint(checkpoint):
+    if checkpoint is None or not os.path.exists(checkpoint): return None
+    with numpy.load(checkpoint) as data:
+        state = {name: data[name] for name in data.files}
+    numpy.random.set_state(('MT19937', state.pop('rng_keys'), int(state.pop('rng_pos')), int(state.pop('rng_has_gauss')), float(state.pop('rng_cached_gaussian'))))
+    return state
+
+# Training set saved in a checkpoint state, None if there is none
+def training_from_checkpoint(state, suffix='', memory_budget=2**30, max_pending=1):
+    if 'training_residuals'+suffix in state:
+        training_residuals = state['training_residuals'+suffix]
+    elif 'training_storage'+suffix in state:
+        training_residuals = open_training_matrix(str(state['training_storage'+suffix]), mode='r+')
+    else:
+        return None
+    training = TrainingSet(state['training_points'], training_residuals, memory_budget, max_pending)
+    if training.storage is not None: training.project_out(state['bases'+suffix])
+    return training
+
+# end checkpoints ###
+
+# parallel=1 evaluates the waveforms on a pool of nprocesses processes, parallel=2 of threads, parallel='auto' chooses
+# among serial, processes and threads from the cost of a pilot batch (see execution_plan), on up to nprocesses (None: all) cores.
+# training_set=1 draws npts points once and keeps their residuals (fixed training set),
+# otherwise npts new points are drawn and generated at every iteration.
+# training_points overrides the random draw of the training set.
+# The training residuals are kept in memory, or in the file training_storage (.npy or .h5, see open_training_matrix),
+# and processed in blocks of at most memory_budget bytes.
+# dtype is the storage precision of the bases (see BasisStore) and of the training residuals, e.g. numpy.complex64
+# (numpy.float32 for the quadratic bases). The projections and the greedy selection are still done in double precision.
+# The search stops when the greedy error falls below greedy_tolerance, or after nbases-1 iterations (no cap if nbases is None).
+# If checkpoint is a file name, the search state is saved there every checkpoint_every iterations and at the end;
+# calling again with the same arguments and resume=1 continues from the last checkpoint.
+# With an MPI communicator comm the training set is spread over its ranks (training_set=1 only, see DistributedTrainingSet).
+def bases_searching_results_unnormalized(parallel, nprocesses, npts, nparams, nbases, known_bases, basis_waveforms, params, residual_modula, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant, chunksize=None, training_set=0, training_points=None, dtype=None, greedy_tolerance=None, checkpoint=None, checkpoint_every=10, resume=0, training_storage=None, memory_budget=2**30, comm=None):
+    check_distributed(comm, training_set, checkpoint)
     if nparams == 10: print("The parameters are Mc, q, s1(mag, theta, phi), s2(mag, theta, phi), iota, and phiRef\n")
     if nparams == 11: print("The parameters are Mc, q, s1(mag, theta, phi), s2(mag, theta, phi), iota, phiRef, and eccentricity\n")
     if nparams == 12: print("The parameters are Mc, q, s1(mag, theta, phi), s2(mag, theta, phi), iota, phiRef, lambda1, and lambda2\n") 
-    for k in numpy.arange(0,nbases-1):
-        paramspoints = generate_params_points(npts, nparams, params_low, params_high)
-        basis_new, params_new, rm_new = least_match_waveform_unnormalized(parallel, nprocesses, paramspoints, known_bases, distance, deltaF, f_min, f_max, waveFlags, approximant)
-        print("Linear Iter: ", k+1, "and new basis waveform", params_new)
-        known_bases= numpy.append(known_bases, numpy.array([basis_new]), axis=0)
-        params = numpy.append(params, numpy.array([params_new]), axis = 0)
-        residual_modula = numpy.append(residual_modula, rm_new)
-    numpy.save('./linearbases.npy',known_bases)
-    numpy.save('./linearbasiswaveformparams.npy',params)
-    return known_bases, params, residual_modula
-
-def bases_searching_quadratic_results_unnormalized(parallel, nprocesses, npts, nparams, nbases_quad, known_quad_bases, basis_waveforms, params_quad, residual_modula, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant):
-    for k in numpy.arange(0,nbases_quad-1):
-        print("Quadratic Iter: ", k+1)
-        paramspoints = generate_params_points(npts, nparams, params_low, params_high)
-        basis_new, params_new, rm_new= least_match_quadratic_waveform_unnormalized(parallel, nprocesses, paramspoints, known_quad_bases, distance, deltaF, f_min, f_max, waveFlags, approximant)
-        known_quad_bases= numpy.append(known_quad_bases, numpy.array([basis_new]), axis=0)
-        params_quad = numpy.append(params_quad, numpy.array([params_new]), axis = 0)
-        residual_modula = numpy.append(residual_modula, rm_new)
-    numpy.save('./quadraticbases.npy',known_quad_bases)
-    numpy.save('./quadraticbasiswaveformparams.npy',params_quad)
-    return known_quad_bases, params_quad, residual_modula
+    start, state, training = 0, None, None
+    max_pending = training_max_pending(training_storage, checkpoint, checkpoint_every)
+    if resume == 1: state = load_checkpoint(checkpoint)
+    if state is not None:
+        known_bases, params, residual_modula, start = state['bases'], state['params'], state['residual_modula'], int(state['iteration'])
+        training = training_from_checkpoint(state, '', memory_budget, max_pending)
+        print("Resuming linear greedy search from", checkpoint, "after", start, "iterations")
+    if parallel == 'auto': parallel, nprocesses, chunksize = build_execution_plan(training_set, npts, nparams, params_low, params_high, known_bases, nbases, distance, deltaF, f_min, f_max, approximant, nprocesses=nprocesses, chunksize=chunksize)
+    # process workers searching new points read the bases from shared memory
+    store = BasisStore(known_bases, params, residual_modula, capacity=greedy_capacity(known_bases, nbases), dtype=dtype, shared=parallel == 1 and training_set != 1)
+    known_bases = store.bases
+    pool = start_pool(nprocesses, approximant, parallel == 2) if parallel in (1, 2) else None
+    try:
+        if training_set == 1 and training is None:
+            if training_points is None: training_points = broadcast_params_points(npts, nparams, params_low, params_high, comm)
+            training = build_training_set(parallel, nprocesses, training_points, known_bases, distance, deltaF, f_min, f_max, approximant, pool=pool, chunksize=chunksize, training_storage=training_storage, memory_budget=memory_budget, max_pending=max_pending, dtype=dtype, comm=comm, waveFlags=waveFlags)
+        iteration = start
+        for k in greedy_iterations(nbases, start):
+            if training_set == 1:
+                basis_new, params_new, rm_new = least_match_training_set(training, known_bases, greedy_tolerance)
+            else:
+                paramspoints = generate_params_points(npts, nparams, params_low, params_high)
+                basis_new, params_new, rm_new = least_match_waveform_unnormalized(parallel, nprocesses, paramspoints, known_bases, distance, deltaF, f_min, f_max, waveFlags, approximant, pool=pool, chunksize=chunksize, shared_bases=store.shared_bases())
+            if greedy_converged(rm_new, greedy_tolerance, "Linear", len(store)): break
+            print("Linear Iter: ", k+1, "and new basis waveform", params_new)
+            store.append(basis_new, params_new, rm_new)
+            known_bases = store.bases
+            iteration = k+1
+            if checkpoint is not None and iteration % checkpoint_every == 0:
+                save_checkpoint(checkpoint, greedy_state(store, iteration, training), training)
+        if checkpoint is not None: save_checkpoint(checkpoint, greedy_state(store, iteration, training), training)
+    finally:
+        stop_pool(pool)
+        store.close()
+        if training is not None: training.close()
+    if mpi_root(comm):
+        report_precision_error(store.bases, "linear", nparams, params_low, params_high, distance, deltaF, f_min, f_max, approximant, waveFlags=waveFlags, greedy_tolerance=greedy_tolerance)
+        store.save('./linearbases.npy', './linearbasiswaveformparams.npy')
+    return store.bases, store.params, store.residual_modula
+
+def bases_searching_quadratic_results_unnormalized(parallel, nprocesses, npts, nparams, nbases_quad, known_quad_bases, basis_waveforms, params_quad, residual_modula, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant, chunksize=None, training_set=0, training_points=None, dtype=None, greedy_tolerance=None, checkpoint=None, checkpoint_every=10, resume=0, training_storage=None, memory_budget=2**30, comm=None):
+    check_distributed(comm, training_set, checkpoint)
+    start, state, training = 0, None, None
+    max_pending = training_max_pending(training_storage, checkpoint, checkpoint_every)
+    if resume == 1: state = load_checkpoint(checkpoint)
+    if state is not None:
+        known_quad_bases, params_quad, residual_modula, start = state['bases'], state['params'], state['residual_modula'], int(state['iteration'])
+        training = training_from_checkpoint(state, '', memory_budget, max_pending)
+        print("Resuming quadratic greedy search from", checkpoint, "after", start, "iterations")
+    if parallel == 'auto': parallel, nprocesses, chunksize = build_execution_plan(training_set, npts, nparams, params_low, params_high, known_quad_bases, nbases_quad, distance, deltaF, f_min, f_max, approximant, quad=1, nprocesses=nprocesses, chunksize=chunksize)
+    store = BasisStore(known_quad_bases, params_quad, residual_modula, capacity=greedy_capacity(known_quad_bases, nbases_quad), dtype=dtype, shared=parallel == 1 and training_set != 1)
+    known_quad_bases = store.bases
+    pool = start_pool(nprocesses, approximant, parallel == 2) if parallel in (1, 2) else None
+    try:
+        if training_set == 1 and training is None:
+            if training_points is None: training_points = broadcast_params_points(npts, nparams, params_low, params_high, comm)
+            training = build_training_set(parallel, nprocesses, training_points, known_quad_bases, distance, deltaF, f_min, f_max, approximant, quad=1, pool=pool, chunksize=chunksize, training_storage=training_storage, memory_budget=memory_budget, max_pending=max_pending, dtype=dtype, comm=comm, waveFlags=waveFlags)
+        iteration = start
+        for k in greedy_iterations(nbases_quad, start):
+            print("Quadratic Iter: ", k+1)
+            if training_set == 1:
+                basis_new, params_new, rm_new = least_match_training_set(training, known_quad_bases, greedy_tolerance)
+            else:
+                paramspoints = generate_params_points(npts, nparams, params_low, params_high)
+                basis_new, params_new, rm_new= least_match_quadratic_waveform_unnormalized(parallel, nprocesses, paramspoints, known_quad_bases, distance, deltaF, f_min, f_max, waveFlags, approximant, pool=pool, chunksize=chunksize, shared_bases=store.shared_bases())
+            if greedy_converged(rm_new, greedy_tolerance, "Quadratic", len(store)): break
+            store.append(basis_new, params_new, rm_new)
+            known_quad_bases = store.bases
+            iteration = k+1
+            if checkpoint is not None and iteration % checkpoint_every == 0:
+                save_checkpoint(checkpoint, greedy_state(store, iteration, training), training)
+        if checkpoint is not None: save_checkpoint(checkpoint, greedy_state(store, iteration, training), training)
+    finally:
+        stop_pool(pool)
+        store.close()
+        if training is not None: training.close()
+    if mpi_root(comm):
+        report_precision_error(store.bases, "quadratic", nparams, params_low, params_high, distance, deltaF, f_min, f_max, approximant, quad=1, waveFlags=waveFlags, greedy_tolerance=greedy_tolerance)
+        store.save('./quadraticbases.npy', './quadraticbasiswaveformparams.npy')
+    return store.bases, store.params, store.residual_modula
+
+# Linear and quadratic bases from a single training set: every training waveform h is generated once
+# and feeds both the linear (h) and the quadratic (|h|^2) greedy searches, which stop independently
+# (nbases, greedy_tolerance and nbases_quad, greedy_tolerance_quad). Saves the same files as the separate linear and quadratic builders.
+# checkpoint, checkpoint_every, resume, training_storage and memory_budget work as in bases_searching_results_unnormalized,
+# the |h|^2 residuals are stored next to training_storage (see quad_storage_name). comm spreads the training set over MPI ranks.
+def bases_searching_joint_results_unnormalized(parallel, nprocesses, npts, nparams, nbases, nbases_quad, known_bases, known_quad_bases, params, params_quad, residual_modula, residual_modula_quad, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant, chunksize=None, training_points=None, dtype=None, dtype_quad=None, greedy_tolerance=None, greedy_tolerance_quad=None, checkpoint=None, checkpoint_every=10, resume=0, training_storage=None, memory_budget=2**30, comm=None):
+    check_distributed(comm, 1, checkpoint)
+    start, start_quad, state = 0, 0, None
+    max_pending = training_max_pending(training_storage, checkpoint, checkpoint_every)
+    if resume == 1: state = load_checkpoint(checkpoint)
+    if state is not None:
+        known_bases, params, residual_modula, start = state['bases'], state['params'], state['residual_modula'], int(state['iteration'])
+        known_quad_bases, params_quad, residual_modula_quad, start_quad = state['bases_quad'], state['params_quad'], state['residual_modula_quad'], int(state['iteration_quad'])
+        training = training_from_checkpoint(state, '', memory_budget, max_pending)
+        training_quad = training_from_checkpoint(state, '_quad', memory_budget, max_pending)
+        print("Resuming joint greedy search from", checkpoint, "after", start, "linear and", start_quad, "quadratic iterations")
+    store = BasisStore(known_bases, params, residual_modula, capacity=greedy_capacity(known_bases, nbases), dtype=dtype)
+    store_quad = BasisStore(known_quad_bases, params_quad, residual_modula_quad, capacity=greedy_capacity(known_quad_bases, nbases_quad), dtype=dtype_quad)
+    if state is None:
+        if training_points is None: training_points = broadcast_params_points(npts, nparams, params_low, params_high, comm)
+        shard = slice(None) if comm is None else mpi_shard(len(training_points), comm)
+        training_storage = mpi_storage_name(training_storage, comm)
+        if parallel == 'auto': parallel, nprocesses, chunksize = build_execution_plan(1, len(training_points), nparams, params_low, params_high, store.bases, nbases, distance, deltaF, f_min, f_max, approximant, nprocesses=nprocesses, chunksize=chunksize)
+        pool = start_pool(nprocesses, approximant, parallel == 2) if parallel in (1, 2) else None
+        try:
+            training_waveforms = generate_training_waveforms(parallel, nprocesses, training_points[shard], distance, deltaF, f_min, f_max, approximant, pool=pool, chunksize=chunksize, storage=training_storage, dtype=dtype, waveFlags=waveFlags)
+        finally:
+            stop_pool(pool)
+        training_quad = make_training_set(training_points, squared_training_matrix(training_waveforms, quad_storage_name(training_storage), memory_budget, numpy.float64 if dtype_quad is None else dtype_quad), memory_budget, max_pending, comm)
+        training_quad.project_out(store_quad.bases)
+        training = make_training_set(training_points, training_waveforms, memory_budget, max_pending, comm)
+        training.project_out(store.bases)
+        del training_waveforms
+    def joint_state(iteration, iteration_quad):
+        state = greedy_state(store, iteration, training)
+        state.update(greedy_state(store_quad, iteration_quad, training_quad, suffix='_quad'))
+        return state
+    # the linear residuals are dropped from the checkpoints once the linear search is over
+    iteration, iteration_quad = start, start_quad
+    try:
+        if training is not None:
+            for k in greedy_iterations(nbases, start):
+                basis_new, params_new, rm_new = least_match_training_set(training, store.bases, greedy_tolerance)
+                if greedy_converged(rm_new, greedy_tolerance, "Linear", len(store)): break
+                print("Linear Iter: ", k+1, "and new basis waveform", params_new)
+                store.append(basis_new, params_new, rm_new)
+                iteration = k+1
+                if checkpoint is not None and iteration % checkpoint_every == 0: save_checkpoint(checkpoint, joint_state(iteration, iteration_quad), training, training_quad)
+            training.close()
+            training = None
+            if checkpoint is not None: save_checkpoint(checkpoint, joint_state(iteration, iteration_quad), training_quad)
+        for k in greedy_iterations(nbases_quad, start_quad):
+            print("Quadratic Iter: ", k+1)
+            basis_new, params_new, rm_new = least_match_training_set(training_quad, store_quad.bases, greedy_tolerance_quad)
+            if greedy_converged(rm_new, greedy_tolerance_quad, "Quadratic", len(store_quad)): break
+            store_quad.append(basis_new, params_new, rm_new)
+            iteration_quad = k+1
+            if checkpoint is not None and iteration_quad % checkpoint_every == 0: save_checkpoint(checkpoint, joint_state(iteration, iteration_quad), training_quad)
+        if checkpoint is not None: save_checkpoint(checkpoint, joint_state(iteration, iteration_quad), training_quad)
+    finally:
+        for remaining in (training, training_quad):
+            if remaining is not None: remaining.close()
+    if mpi_root(comm):
+        report_precision_error(store.bases, "linear", nparams, params_low, params_high, distance, deltaF, f_min, f_max, approximant, waveFlags=waveFlags, greedy_tolerance=greedy_tolerance)
+        report_precision_error(store_quad.bases, "quadratic", nparams, params_low, params_high, distance, deltaF, f_min, f_max, approximant, quad=1, waveFlags=waveFlags, greedy_tolerance=greedy_tolerance_quad)
+        store.save('./linearbases.npy', './linearbasiswaveformparams.npy')
+        store_quad.save('./quadraticbases.npy', './quadraticbasiswaveformparams.npy')
+    return (store.bases, store.params, store.residual_modula), (store_quad.bases, store_quad.params, store_quad.residual_modula)
 
 def massrange(mc_low, mc_high, q_low, q_high):
     mmin = get_m1m2_from_mcq(mc_low,q_high)[1]
     mmax = get_m1m2_from_mcq(mc_high,q_high)[0]
     return [mmin, mmax]
 
+# Parameter space of the approximant (see WaveformGenerator.extra_params) and the first basis waveform
 def initial_basis(mc_low, mc_high, q_low, q_high, s1sphere_low, s1sphere_high, s2sphere_low, s2sphere_high, ecc_low, ecc_high, lambda1_low, lambda1_high, lambda2_low, lambda2_high, iota_low, iota_high, phiref_low, phiref_high, distance, deltaF, f_min, f_max, waveFlags, approximant):
+    extra_params = waveform_generator(approximant).extra_params
+    extra_low = {'ecc': ecc_low, 'lambda1': lambda1_low, 'lambda2': lambda2_low}
+    extra_high = {'ecc': ecc_high, 'lambda1': lambda1_high, 'lambda2': lambda2_high}
+    nparams = 10 + len(extra_params)
+    params_low = [mc_low, q_low, s1sphere_low[0], s1sphere_low[1], s1sphere_low[2], s2sphere_low[0], s2sphere_low[1], s2sphere_low[2], iota_low, phiref_low] + [extra_low[name] for name in extra_params]
+    params_high = [mc_high, q_high, s1sphere_high[0], s1sphere_high[1], s1sphere_high[2], s2sphere_high[0], s2sphere_high[1], s2sphere_high[2], iota_high, phiref_high] + [extra_high[name] for name in extra_params]
+    params_start = numpy.array([[mc_low, q_low, s1sphere_low[0], s1sphere_low[1], s1sphere_low[2], s2sphere_low[0], s2sphere_low[1], s2sphere_low[2], 0.33333*np.pi, 1.5*np.pi] + [extra_low[name] for name in extra_params]])
+    ecc, lambda1, lambda2 = [extra_low[name] if name in extra_params else 0 for name in ('ecc', 'lambda1', 'lambda2')]
     try:
-        if approximant==lalsimulation.IMRPhenomPv2:
-            nparams = 10
-            params_low = [mc_low, q_low, s1sphere_low[0], s1sphere_low[1], s1sphere_low[2], s2sphere_low[0], s2sphere_low[1], s2sphere_low[2], iota_low, phiref_low] 
-            params_high = [mc_high, q_high, s1sphere_high[0], s1sphere_high[1], s1sphere_high[2], s2sphere_high[0], s2sphere_high[1], s2sphere_high[2], iota_high, phiref_high]
-            params_start = numpy.array([[mc_low, q_low, s1sphere_low[0], s1sphere_low[1], s1sphere_low[2], s2sphere_low[0], s2sphere_low[1], s2sphere_low[2], 0.33333*np.pi, 1.5*np.pi]])
-            hp1 = generate_a_waveform_from_mcq(mc_low, q_low, spherical_to_cartesian(s1sphere_low), spherical_to_cartesian(s2sphere_low), 0, 0, 0, iota_low, phiref_low, distance, deltaF, f_min, f_max, waveFlags, approximant)
+        hp1 = generate_a_waveform_from_mcq(mc_low, q_low, spherical_to_cartesian(s1sphere_low), spherical_to_cartesian(s2sphere_low), ecc, lambda1, lambda2, iota_low, phiref_low, distance, deltaF, f_min, f_max, waveFlags, approximant)
     except AttributeError: 
         raise Exception("Waveform call failed with error: {}.".format(traceback.print_exc()))
-    try:
-        if approximant==lalsimulation.IMRPhenomPv3:
-            nparams = 10
-            params_low = [mc_low, q_low, s1sphere_low[0], s1sphere_low[1], s1sphere_low[2], s2sphere_low[0], s2sphere_low[1], s2sphere_low[2], iota_low, phiref_low] 
-            params_high = [mc_high, q_high, s1sphere_high[0], s1sphere_high[1], s1sphere_high[2], s2sphere_high[0], s2sphere_high[1], s2sphere_high[2], iota_high, phiref_high]
-            params_start = numpy.array([[mc_low, q_low, s1sphere_low[0], s1sphere_low[1], s1sphere_low[2], s2sphere_low[0], s2sphere_low[1], s2sphere_low[2], 0.33333*np.pi, 1.5*np.pi]])
-            hp1 = generate_a_waveform_from_mcq(mc_low, q_low, spherical_to_cartesian(s1sphere_low), spherical_to_cartesian(s2sphere_low), 0, 0, 0, iota_low, phiref_low, distance, deltaF, f_min, f_max, waveFlags, approximant)
-    except AttributeError: 
-        raise Exception("Waveform call failed with error: {}.".format(traceback.print_exc()))
-    try:
-        if approximant==lalsimulation.IMRPhenomPv3HM:
-            nparams = 10
-            params_low = [mc_low, q_low, s1sphere_low[0], s1sphere_low[1], s1sphere_low[2], s2sphere_low[0], s2sphere_low[1], s2sphere_low[2], iota_low, phiref_low] 
-            params_high = [mc_high, q_high, s1sphere_high[0], s1sphere_high[1], s1sphere_high[2], s2sphere_high[0], s2sphere_high[1], s2sphere_high[2], iota_high, phiref_high]
-            params_start = numpy.array([[mc_low, q_low, s1sphere_low[0], s1sphere_low[1], s1sphere_low[2], s2sphere_low[0], s2sphere_low[1], s2sphere_low[2], 0.33333*np.pi, 1.5*np.pi]])
-            hp1 = generate_a_waveform_from_mcq(mc_low, q_low, spherical_to_cartesian(s1sphere_low), spherical_to_cartesian(s2sphere_low), 0, 0, 0, iota_low, phiref_low, distance, deltaF, f_min, f_max, waveFlags, approximant)
-    except AttributeError: 
-        raise Exception("Waveform call failed with error: {}.".format(traceback.print_exc()))
-    try:
-        if approximant==lalsimulation.IMRPhenomXHM:
-            nparams = 10
-            params_low = [mc_low, q_low, s1sphere_low[0], s1sphere_low[1], s1sphere_low[2], s2sphere_low[0], s2sphere_low[1], s2sphere_low[2], iota_low, phiref_low] 
-            params_high = [mc_high, q_high, s1sphere_high[0], s1sphere_high[1], s1sphere_high[2], s2sphere_high[0], s2sphere_high[1], s2sphere_high[2], iota_high, phiref_high]
-            params_start = numpy.array([[mc_low, q_low, s1sphere_low[0], s1sphere_low[1], s1sphere_low[2], s2sphere_low[0], s2sphere_low[1], s2sphere_low[2], 0.33333*np.pi, 1.5*np.pi]])
-            hp1 = generate_a_waveform_from_mcq(mc_low, q_low, spherical_to_cartesian(s1sphere_low), spherical_to_cartesian(s2sphere_low), 0, 0, 0, iota_low, phiref_low, distance, deltaF, f_min, f_max, waveFlags, approximant)
-    except AttributeError: 
-        raise Exception("Waveform call failed with error: {}.".format(traceback.print_exc()))
-    try:
-        if approximant==lalsimulation.TaylorF2Ecc:
-            nparams = 11
-            params_low = [mc_low, q_low, s1sphere_low[0], s1sphere_low[1], s1sphere_low[2], s2sphere_low[0], s2sphere_low[1], s2sphere_low[2], iota_low, phiref_low, ecc_low] 
-            params_high = [mc_high, q_high, s1sphere_high[0], s1sphere_high[1], s1sphere_high[2], s2sphere_high[0], s2sphere_high[1], s2sphere_high[2], iota_high, phiref_high, ecc_high]
-            params_start = numpy.array([[mc_low, q_low, s1sphere_low[0], s1sphere_low[1], s1sphere_low[2], s2sphere_low[0], s2sphere_low[1], s2sphere_low[2], 0.33333*np.pi, 1.5*np.pi, ecc_low]])
-            hp1 = generate_a_waveform_from_mcq(mc_low, q_low, spherical_to_cartesian(s1sphere_low), spherical_to_cartesian(s2sphere_low), ecc_low, 0, 0, iota_low, phiref_low, distance, deltaF, f_min, f_max, waveFlags, approximant)
-    except AttributeError: 
-        raise Exception("Waveform call failed with error: {}.".format(traceback.print_exc()))
-    try:    
-        if approximant==lalsimulation.IMRPhenomPv2_NRTidal:
-            nparams = 12
-            params_low = [mc_low, q_low, s1sphere_low[0], s1sphere_low[1], s1sphere_low[2], s2sphere_low[0], s2sphere_low[1], s2sphere_low[2], iota_low, phiref_low, lambda1_low, lambda2_low]
-            params_high = [mc_high, q_high, s1sphere_high[0], s1sphere_high[1], s1sphere_high[2], s2sphere_high[0], s2sphere_high[1], s2sphere_high[2], iota_high, phiref_high, lambda1_high, lambda2_high]
-            params_start = numpy.array([[mc_low, q_low, s1sphere_low[0], s1sphere_low[1], s1sphere_low[2], s2sphere_low[0], s2sphere_low[1], s2sphere_low[2], 0.33333*np.pi, 1.5*np.pi, lambda1_low, lambda2_low]])
-
-            hp1 = generate_a_waveform_from_mcq(mc_low, q_low, spherical_to_cartesian(s1sphere_low), spherical_to_cartesian(s2sphere_low), 0, lambda1_low, lambda2_low, iota_low, phiref_low, distance, deltaF, f_min, f_max, waveFlags, approximant) 
-    except AttributeError: 
-        raise Exception("Waveform call failed with error: {}.".format(traceback.print_exc()))
-    try:
-        if approximant==lalsimulation.IMRPhenomNSBH:
-            nparams = 12
-            params_low = [mc_low, q_low, s1sphere_low[0], s1sphere_low[1], s1sphere_low[2], s2sphere_low[0], s2sphere_low[1], s2sphere_low[2], iota_low, phiref_low, lambda1_low, lambda2_low]
-            params_high = [mc_high, q_high, s1sphere_high[0], s1sphere_high[1], s1sphere_high[2], s2sphere_high[0], s2sphere_high[1], s2sphere_high[2], iota_high, phiref_high, lambda1_high, lambda2_high]
-            params_start = numpy.array([[mc_low, q_low, s1sphere_low[0], s1sphere_low[1], s1sphere_low[2], s2sphere_low[0], s2sphere_low[1], s2sphere_low[2], 0.33333*np.pi, 1.5*np.pi, lambda1_low, lambda2_low]])
-            hp1 = generate_a_waveform_from_mcq(mc_low, q_low, spherical_to_cartesian(s1sphere_low), spherical_to_cartesian(s2sphere_low), 0, lambda1_low, lambda2_low, iota_low, phiref_low, distance, deltaF, f_min, f_max, waveFlags, approximant) 
-    except AttributeError: 
-        raise Exception("Waveform call failed with error: {}.".format(traceback.print_exc()))
-    try:
-        if approximant in TEOBResumS_version:
-            nparams = 12
-            print('\n\nTHIS IS ALIGNED SPIN, PARAMETERS ARE LESS THAN 12?\n\n')
-            params_low = [mc_low, q_low, s1sphere_low[0], s1sphere_low[1], s1sphere_low[2], s2sphere_low[0], s2sphere_low[1], s2sphere_low[2], iota_low, phiref_low, lambda1_low, lambda2_low]
-            params_high = [mc_high, q_high, s1sphere_high[0], s1sphere_high[1], s1sphere_high[2], s2sphere_high[0], s2sphere_high[1], s2sphere_high[2], iota_high, phiref_high, lambda1_high, lambda2_high]
-            params_start = numpy.array([[mc_low, q_low, s1sphere_low[0], s1sphere_low[1], s1sphere_low[2], s2sphere_low[0], s2sphere_low[1], s2sphere_low[2], 0.33333*np.pi, 1.5*np.pi, lambda1_low, lambda2_low]])
-            hp1 = generate_a_waveform_from_mcq(mc_low, q_low, spherical_to_cartesian(s1sphere_low), spherical_to_cartesian(s2sphere_low), 0, lambda1_low, lambda2_low, iota_low, phiref_low, distance, deltaF, f_min, f_max, waveFlags, approximant) 
-    except AttributeError: 
-        raise Exception("Waveform call failed with error: {}.".format(traceback.print_exc()))
-    return numpy.array([nparams, params_low, params_high, params_start, hp1])
-
-def empnodes(ndim, known_bases): # Here known_bases is the full copy known_bases_copy. Its length is equal to or longer than ndim.
-    emp_nodes = numpy.arange(0,ndim)*100000000
-    emp_nodes[0] = numpy.argmax(numpy.absolute(known_bases[0]))
-    c1 = known_bases[1,emp_nodes[0]]/known_bases[0,1]
-    interp1 = numpy.multiply(c1,known_bases[0])
-    diff1 = interp1 - known_bases[1]
-    r1 = numpy.absolute(diff1)
-    if ndim > 1:
-        emp_nodes[1] = numpy.argmax(r1)
-    else:
+    return numpy.array([nparams, params_low, params_high, params_start, hp1], dtype=object)
+
+# Empirical interpolation nodes of the first ndim_max bases, all selected in a single pass.
+# The k-th node is where the k-th basis is worst interpolated by the previous bases on the previous nodes.
+# The interpolation is done on the normalized residuals q_j = r_j/r_j[node_j], for which the interpolation
+# matrix q_j[node_i] is unit lower triangular, so each new node costs a triangular solve instead of a pinv.
+# The node sets are nested: the first ndim nodes are the nodes of the ndim-dimensional interpolant.
+@instrumented()
+def eim_nodes(known_bases, ndim_max=None):
+    if ndim_max is None: ndim_max = len(known_bases)
+    dtype = numpy.result_type(known_bases.dtype, numpy.float64)
+    nodes = numpy.zeros(ndim_max, dtype=int)
+    residual_bases = numpy.empty((ndim_max, known_bases.shape[1]), dtype=dtype)
+    T = numpy.zeros((ndim_max, ndim_max), dtype=dtype) # T[i,j] = residual_bases[j,nodes[i]]
+    for k in numpy.arange(0, ndim_max):
+        residual = numpy.asarray(known_bases[k], dtype=dtype)
+        if k > 0:
+            Ci = scipy.linalg.solve_triangular(T[:k,:k], residual[nodes[:k]], lower=True, unit_diagonal=True)
+            residual = residual - numpy.dot(Ci, residual_bases[:k])
+        nodes[k] = numpy.argmax(numpy.absolute(residual))
+        residual_bases[k] = residual/residual[nodes[k]]
+        T[k,:k+1] = residual_bases[:k+1,nodes[k]]
+    return nodes
+
+# nodes are the nested nodes from eim_nodes, computed here if not given
+@instrumented()
+def empnodes(ndim, known_bases, nodes=None): # Here known_bases is the full copy known_bases_copy. Its length is equal to or longer than ndim.
+    if ndim < 2:
         raise ValueError("The minimum number of bases has to be larger than 1.")
-    for k in numpy.arange(2,ndim):
-        emp_tmp = emp_nodes[0:k]
-        Vtmp = numpy.transpose(known_bases[0:k,emp_tmp])
-        inverse_Vtmp = numpy.linalg.pinv(Vtmp)
-        e_to_interp = known_bases[k]
-        Ci = numpy.dot(inverse_Vtmp, e_to_interp[emp_tmp])
-        interpolantA = numpy.zeros(len(known_bases[k]))+numpy.zeros(len(known_bases[k]))*1j
-        for j in numpy.arange(0, k):
-            tmp = numpy.multiply(Ci[j], known_bases[j])
-            interpolantA += tmp
-        diff = interpolantA - known_bases[k]
-        r = numpy.absolute(diff)
-        emp_nodes[k] = numpy.argmax(r)
-        emp_nodes = sorted(emp_nodes)
-    u, c = numpy.unique(emp_nodes, return_counts=True)
-    dup = u[c > 1]
-    #print(len(emp_nodes), "\nDuplicates indices:", dup)
-    emp_nodes = numpy.unique(emp_nodes)
-    ndim = len(emp_nodes)
-    #print(len(emp_nodes), "\n", emp_nodes)
-    V = numpy.transpose(known_bases[0:ndim, emp_nodes])
-    inverse_V = numpy.linalg.pinv(V)
-    return numpy.array([ndim, inverse_V, emp_nodes])
+    if nodes is None: nodes = eim_nodes(known_bases, ndim)
+    emp_nodes = numpy.sort(nodes[0:ndim])
+    V = numpy.transpose(numpy.asarray(known_bases[0:ndim, emp_nodes], dtype=numpy.result_type(known_bases.dtype, numpy.float64)))
+    inverse_V = numpy.linalg.inv(V)
+    return ndim, inverse_V, emp_nodes
+
+# Random test points and their waveforms (|h+|^2 if quad=1), generated once and reused
+# for every candidate basis size. A saved (test_points, test_waveforms) pair can be passed instead.
+# waveFlags must be those of the bases, the defaults of approximant are used if None.
+# The test waveforms are written to the file storage if given (see open_training_matrix), in precision dtype.
+# With an MPI communicator comm, test_points are all the test points and test_waveforms the shard of this rank (see mpi_shard).
+def generate_validation_set(nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, approximant, quad=0, parallel=0, nprocesses=1, chunksize=None, storage=None, dtype=None, comm=None, waveFlags=None):
+    test_points = broadcast_params_points(nts, nparams, params_low, params_high, comm)
+    shard = slice(None) if comm is None else mpi_shard(nts, comm)
+    test_waveforms = generate_training_waveforms(parallel, nprocesses, test_points[shard], distance, deltaF, f_min, f_max, approximant, quad=quad, chunksize=chunksize, storage=mpi_storage_name(storage, comm), dtype=dtype, waveFlags=waveFlags)
+    return test_points, test_waveforms
+
+# Surrogate errors (1-overlap)*deltaF of the interpolants of all test waveforms (rows of test_waveforms),
+# where b is the (L x ndim) interpolation matrix, as saved in B_linear.npy/B_quadratic.npy transposed.
+# The interpolants of a block of block_size waveforms are one matrix product, b.h[emp_nodes];
+# by default a block holds as many waveforms as fit in memory_budget bytes, so test_waveforms can be on disk.
+# With early_exit=1 the evaluation stops after the first block with an error above tolerance,
+# the errors of the points that were not evaluated are nan. The default blocks then hold at most
+# early_exit_block waveforms, a single one would usually cover the whole validation set.
+early_exit_block = 64
+
+@instrumented()
+def surrogate_errors(b, emp_nodes, test_waveforms, deltaF, tolerance=None, early_exit=0, block_size=None, memory_budget=2**30):
+    nts = len(test_waveforms)
+    if block_size is None:
+        block_size = block_rows(test_waveforms, memory_budget)
+        if early_exit == 1: block_size = min(block_size, early_exit_block)
+    errors = numpy.full(nts, numpy.nan)
+    for start in numpy.arange(0, nts, block_size):
+        block = test_waveforms[start:min(start+block_size, nts)]
+        block = numpy.asarray(block, dtype=numpy.result_type(block.dtype, numpy.float64))
+        interpolants = numpy.dot(block[:,emp_nodes], numpy.transpose(b))
+        overlaps = numpy.real(numpy.sum(numpy.conj(block)*interpolants, axis=1))/(numpy.linalg.norm(block, axis=1)*numpy.linalg.norm(interpolants, axis=1))
+        errors[start:start+block_size] = (1-overlaps)*deltaF
+        if early_exit == 1 and numpy.any(errors[start:start+block_size] > tolerance): break
+    return errors
 
 def surroerror(ndim, inverse_V, emp_nodes, known_bases, test_mc, test_q, test_s1, test_s2, test_ecc, test_lambda1, test_lambda2, test_iota, test_phiref, distance, deltaF, f_min, f_max, waveFlags, approximant):
     hp_test = generate_a_waveform_from_mcq(test_mc, test_q, test_s1, test_s2, test_ecc, test_lambda1, test_lambda2, test_iota, test_phiref, distance, deltaF, f_min, f_max, waveFlags, approximant)
     Ci = numpy.dot(inverse_V, hp_test[emp_nodes])
-    interpolantA = numpy.zeros(len(hp_test))+numpy.zeros(len(hp_test))*1j
-    #ndim = len(known_bases)
-    for j in numpy.arange(0, ndim):
-        tmp = numpy.multiply(Ci[j], known_bases[j])
-        interpolantA += tmp
+    interpolantA = numpy.dot(Ci, known_bases[0:ndim])
     surro = (1-overlap_of_two_waveforms(hp_test, interpolantA))*deltaF
     return surro
 
-def surros(tolerance, ndim, inverse_V, emp_nodes, known_bases, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant): # Here known_bases is known_bases_copy
-    test_points = generate_params_points(nts, nparams, params_low, params_high)
-    surros = numpy.zeros(nts)
-    count = 0
-    for i in numpy.arange(0,nts):
-        test_mc =  test_points[i,0]
-        test_q = test_points[i,1]
-        test_s1 = spherical_to_cartesian(test_points[i,2:5])
-        test_s2 = spherical_to_cartesian(test_points[i,5:8])
-        test_iota = test_points[i,8]
-        test_phiref = test_points[i,9]
-        test_ecc = 0
-        test_lambda1 = 0
-        test_lambda2 = 0
-        if nparams == 11: test_ecc = test_points[i,10]
-        if nparams == 12: 
-            test_lambda1 = test_points[i,10]
-            test_lambda2 = test_points[i,11]
-        surros[i] = surroerror(ndim, inverse_V, emp_nodes, known_bases[0:ndim], test_mc, test_q, test_s1, test_s2, test_ecc, test_lambda1, test_lambda2, test_iota, test_phiref, distance, deltaF, f_min, f_max, waveFlags, approximant)
-        if (surros[i] > tolerance):
-            count = count+1
+# validation_set is the (test_points, test_waveforms) pair of generate_validation_set, drawn here if None
+# curve, if given, is a dict in which the largest surrogate error is recorded under ndim, if every test point was evaluated
+# With an MPI communicator comm, validation_set is sharded over its ranks, see generate_validation_set.
+@instrumented()
+def surros(tolerance, ndim, inverse_V, emp_nodes, known_bases, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant, validation_set=None, early_exit=0, curve=None, comm=None): # Here known_bases is known_bases_copy
+    if validation_set is None: validation_set = generate_validation_set(nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, approximant, comm=comm, waveFlags=waveFlags)
+    test_points, test_waveforms = validation_set
+    b = numpy.dot(numpy.transpose(known_bases[0:ndim]), inverse_V)
+    errors = gather_errors(surrogate_errors(b, emp_nodes, test_waveforms, deltaF, tolerance=tolerance, early_exit=early_exit), comm)
+    if curve is not None and not numpy.any(numpy.isnan(errors)): curve[int(ndim)] = float(numpy.max(errors))
+    count = numpy.sum(errors > tolerance)
     print(ndim, "basis elements gave", count, "bad points of surrogate error > ", tolerance)
     if count == 0: val =0
     else: val = 1
     return val
 
-def roqs(tolerance, freq,  ndimlow, ndimhigh, ndimstepsize, known_bases_copy, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant):
-    flag = 0
-    for num in np.arange(ndimlow, ndimhigh, ndimstepsize):
-        ndim, inverse_V, emp_nodes = empnodes(num, known_bases_copy)
-        if surros(tolerance, ndim, inverse_V, emp_nodes, known_bases_copy, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant)==0:
-            b_linear = numpy.dot(numpy.transpose(known_bases_copy[0:ndim]),inverse_V)
-            f_linear = freq[emp_nodes]
-            numpy.save('./B_linear.npy',numpy.transpose(b_linear))
-            numpy.save('./fnodes_linear.npy',f_linear)
-            print("Number of linear basis elements is ", ndim, "and the linear ROQ data are saved in B_linear.npy")
-            flag = 1
-            break
-    if not flag: raise Exception('Could not find a basis to correctly represent the model within the given tolerance and maximum dimension selected.\nTry increasing the allowed basis size or decreasing the tolerance.')
-    return
+# Index of the smallest candidate in ndims for which passes(ndim) is True, None if there is none.
+# search='linear' checks the candidates in order. search='bisection' relies on the surrogate error
+# decreasing with the basis size: it gallops ahead by 1, 2, 4, ... candidates until one passes, then
+# bisects between the last failing and the first passing one, in O(log n) validation rounds.
+def search_basis_size(ndims, passes, search='linear'):
+    if search == 'linear':
+        for i in numpy.arange(0, len(ndims)):
+            if passes(ndims[i]): return i
+        return None
+    if search != 'bisection': raise ValueError("Unknown search strategy {}.".format(search))
+    if len(ndims) == 0: return None
+    low, i, step = -1, 0, 1
+    while not passes(ndims[i]):
+        low = i
+        if i == len(ndims)-1: return None
+        i = min(i+step, len(ndims)-1)
+        step *= 2
+    high = i
+    while high-low > 1:
+        mid = (low+high)//2
+        if passes(ndims[mid]): high = mid
+        else: low = mid
+    return high
+
+# The interpolation matrix b rounded to b_dtype, for saving it in reduced precision. Reports how much the rounding
+# changes the largest surrogate error on the test waveforms, and warns if the rounded one exceeds tolerance.
+def rounded_interpolant(b, b_dtype, emp_nodes, test_waveforms, deltaF, tolerance, name, comm=None):
+    b_rounded = b.astype(b_dtype)
+    error = numpy.max(gather_errors(surrogate_errors(b, emp_nodes, test_waveforms, deltaF), comm))
+    error_rounded = numpy.max(gather_errors(surrogate_errors(b_rounded, emp_nodes, test_waveforms, deltaF), comm))
+    print("Saving", name, "as", numpy.dtype(b_dtype).name, "changes the largest surrogate error from", error, "to", error_rounded)
+    if error_rounded > tolerance: warnings.warn(name+" in "+numpy.dtype(b_dtype).name+" exceeds the tolerance "+str(tolerance)+", save it in double precision.")
+    return b_rounded
+
+# search is the strategy over the candidate sizes, see search_basis_size.
+# b_dtype (e.g. numpy.complex64) is the precision in which B_linear.npy is saved, see rounded_interpolant.
+# The ROQ data are saved in the directory outdir, by rank 0 of the MPI communicator comm if the validation is distributed.
+# Returns the largest surrogate error measured at each basis size that was validated on all the test points,
+# sizes rejected by an early exit are left out.
+@instrumented()
+def roqs(tolerance, freq,  ndimlow, ndimhigh, ndimstepsize, known_bases_copy, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant, validation_set=None, early_exit=0, parallel=0, nprocesses=1, search='linear', b_dtype=None, outdir='.', comm=None):
+    if validation_set is None: validation_set = generate_validation_set(nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, approximant, parallel=parallel, nprocesses=nprocesses, comm=comm, waveFlags=waveFlags)
+    ndims = np.arange(ndimlow, min(ndimhigh, len(known_bases_copy)+1), ndimstepsize)
+    nodes = eim_nodes(known_bases_copy, ndims[-1]) if len(ndims) else None
+    curve = {}
+    def passes(num):
+        ndim, inverse_V, emp_nodes = empnodes(num, known_bases_copy, nodes)
+        return surros(tolerance, ndim, inverse_V, emp_nodes, known_bases_copy, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant, validation_set=validation_set, early_exit=early_exit, curve=curve, comm=comm)==0
+    i = search_basis_size(ndims, passes, search)
+    if i is None: raise Exception('Could not find a basis to correctly represent the model within the given tolerance and maximum dimension selected.\nTry increasing the allowed basis size or decreasing the tolerance.')
+    ndim, inverse_V, emp_nodes = empnodes(ndims[i], known_bases_copy, nodes)
+    b_linear = numpy.dot(numpy.transpose(known_bases_copy[0:ndim]),inverse_V)
+    if b_dtype is not None: b_linear = rounded_interpolant(b_linear, b_dtype, emp_nodes, validation_set[1], deltaF, tolerance, 'B_linear', comm)
+    f_linear = freq[emp_nodes]
+    if mpi_root(comm):
+        numpy.save(os.path.join(outdir, 'B_linear.npy'),numpy.transpose(b_linear))
+        numpy.save(os.path.join(outdir, 'fnodes_linear.npy'),f_linear)
+    print("Number of linear basis elements is ", ndim, "and the linear ROQ data are saved in B_linear.npy")
+    return dict(sorted(curve.items()))
 
 def testrep(b_linear, emp_nodes, test_mc, test_q, test_s1, test_s2, test_ecc, test_lambda1, test_lambda2, test_iota, test_phiref, distance, deltaF, f_min, f_max, waveFlags, approximant):
     hp_test = generate_a_waveform_from_mcq(test_mc, test_q, test_s1, test_s2, test_ecc, test_lambda1, test_lambda2, test_iota, test_phiref, distance, deltaF, f_min, f_max, waveFlags, approximant)
@@ -594,89 +1844,57 @@ def testrep(b_linear, emp_nodes, test_mc, test_q, test_s1, test_s2, test_ecc, te
     plt.savefig('./testrep.png')
     return
 
-def empnodes_quad(ndim_quad, known_quad_bases):
-    emp_nodes_quad = numpy.arange(0,ndim_quad)*100000000
-    emp_nodes_quad[0] = numpy.argmax(numpy.absolute(known_quad_bases[0]))
-    c1_quad = known_quad_bases[1,emp_nodes_quad[0]]/known_quad_bases[0,1]
-    interp1_quad = numpy.multiply(c1_quad,known_quad_bases[0])
-    diff1_quad = interp1_quad - known_quad_bases[1]
-    r1_quad = numpy.absolute(diff1_quad)
-    emp_nodes_quad[1] = numpy.argmax(r1_quad)
-    for k in numpy.arange(2,ndim_quad):
-        emp_tmp_quad = emp_nodes_quad[0:k]
-        Vtmp_quad = numpy.transpose(known_quad_bases[0:k,emp_tmp_quad])
-        inverse_Vtmp_quad = numpy.linalg.pinv(Vtmp_quad)
-        e_to_interp_quad = known_quad_bases[k]
-        Ci_quad = numpy.dot(inverse_Vtmp_quad, e_to_interp_quad[emp_tmp_quad])
-        interpolantA_quad = numpy.zeros(len(known_quad_bases[k]))+numpy.zeros(len(known_quad_bases[k]))*1j
-        for j in numpy.arange(0, k):
-            tmp_quad = numpy.multiply(Ci_quad[j], known_quad_bases[j])
-            interpolantA_quad += tmp_quad
-        diff_quad = interpolantA_quad - known_quad_bases[k]
-        r_quad = numpy.absolute(diff_quad)
-        emp_nodes_quad[k] = numpy.argmax(r_quad)
-        emp_nodes_quad = sorted(emp_nodes_quad)
-    u_quad, c_quad = numpy.unique(emp_nodes_quad, return_counts=True)
-    dup_quad = u_quad[c_quad > 1]
-    #print(len(emp_nodes_quad), "\nduplicates quad indices:", dup_quad)
-    emp_nodes_quad = numpy.unique(emp_nodes_quad)
-    ndim_quad = len(emp_nodes_quad)
-    #print(len(emp_nodes_quad), "\n", emp_nodes_quad)
-    V_quad = numpy.transpose(known_quad_bases[0:ndim_quad,emp_nodes_quad])
-    inverse_V_quad = numpy.linalg.pinv(V_quad)
-    return numpy.array([ndim_quad, inverse_V_quad, emp_nodes_quad])
+@instrumented()
+def empnodes_quad(ndim_quad, known_quad_bases, nodes_quad=None):
+    if ndim_quad < 2:
+        raise ValueError("The minimum number of bases has to be larger than 1.")
+    if nodes_quad is None: nodes_quad = eim_nodes(known_quad_bases, ndim_quad)
+    emp_nodes_quad = numpy.sort(nodes_quad[0:ndim_quad])
+    V_quad = numpy.transpose(numpy.asarray(known_quad_bases[0:ndim_quad, emp_nodes_quad], dtype=numpy.result_type(known_quad_bases.dtype, numpy.float64)))
+    inverse_V_quad = numpy.linalg.inv(V_quad)
+    return ndim_quad, inverse_V_quad, emp_nodes_quad
 
 def surroerror_quad(ndim_quad, inverse_V_quad, emp_nodes_quad, known_quad_bases, test_mc_quad, test_q_quad, test_s1_quad, test_s2_quad, test_ecc_quad, test_lambda1_quad, test_lambda2_quad, test_iota_quad, test_phiref_quad, distance, deltaF, f_min, f_max, waveFlags, approximant):
     hp_test_quad = (numpy.absolute(generate_a_waveform_from_mcq(test_mc_quad, test_q_quad, test_s1_quad, test_s2_quad, test_ecc_quad, test_lambda1_quad, test_lambda2_quad, test_iota_quad, test_phiref_quad, distance, deltaF, f_min, f_max, waveFlags, approximant)))**2
     Ci_quad = numpy.dot(inverse_V_quad, hp_test_quad[emp_nodes_quad])
-    interpolantA_quad = numpy.zeros(len(hp_test_quad))+numpy.zeros(len(hp_test_quad))*1j    
-    #ndim_quad = len(known_quad_bases)
-    for j in numpy.arange(0, ndim_quad):
-        tmp_quad = numpy.multiply(Ci_quad[j], known_quad_bases[j])
-        interpolantA_quad += tmp_quad
+    interpolantA_quad = numpy.dot(Ci_quad, known_quad_bases[0:ndim_quad])
     surro_quad = (1-overlap_of_two_waveforms(hp_test_quad, interpolantA_quad))*deltaF
     return surro_quad
 
-def surros_quad(tolerance_quad, ndim_quad, inverse_V_quad, emp_nodes_quad, known_quad_bases, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant):
-    test_points = generate_params_points(nts, nparams, params_low, params_high)
-    surros = numpy.zeros(nts)
-    count = 0
-    for i in numpy.arange(0,nts):
-        test_mc_quad =  test_points[i,0]
-        test_q_quad = test_points[i,1]
-        test_s1_quad = spherical_to_cartesian(test_points[i,2:5])
-        test_s2_quad = spherical_to_cartesian(test_points[i,5:8])
-        test_iota_quad = test_points[i,8]
-        test_phiref_quad = test_points[i,9]
-        test_ecc_quad = 0
-        test_lambda1_quad = 0
-        test_lambda2_quad = 0
-        if nparams == 11: test_ecc_quad = test_points[i,10]
-        if nparams == 12: 
-            test_lambda1_quad = test_points[i,10]
-            test_lambda2_quad = test_points[i,11]
-        surros[i] = surroerror_quad(ndim_quad, inverse_V_quad, emp_nodes_quad, known_quad_bases[0:ndim_quad], test_mc_quad, test_q_quad, test_s1_quad, test_s2_quad, test_ecc_quad, test_lambda1_quad, test_lambda2_quad, test_iota_quad, test_phiref_quad, distance, deltaF, f_min, f_max, waveFlags, approximant)
-        if (surros[i] > tolerance_quad):
-            count = count+1
+@instrumented()
+def surros_quad(tolerance_quad, ndim_quad, inverse_V_quad, emp_nodes_quad, known_quad_bases, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant, validation_set=None, early_exit=0, curve=None, comm=None):
+    if validation_set is None: validation_set = generate_validation_set(nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, approximant, quad=1, comm=comm, waveFlags=waveFlags)
+    test_points, test_waveforms_quad = validation_set
+    b_quad = numpy.dot(numpy.transpose(known_quad_bases[0:ndim_quad]), inverse_V_quad)
+    errors = gather_errors(surrogate_errors(b_quad, emp_nodes_quad, test_waveforms_quad, deltaF, tolerance=tolerance_quad, early_exit=early_exit), comm)
+    if curve is not None and not numpy.any(numpy.isnan(errors)): curve[int(ndim_quad)] = float(numpy.max(errors))
+    count = numpy.sum(errors > tolerance_quad)
     print(ndim_quad, "basis elements gave", count, "bad points of surrogate error > ", tolerance_quad)
     if count == 0: val =0
     else: val = 1
     return val
 
-def roqs_quad(tolerance_quad, freq,  ndimlow_quad, ndimhigh_quad, ndimstepsize_quad, known_quad_bases_copy, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant):
-    flag = 0
-    for num in np.arange(ndimlow_quad, ndimhigh_quad, ndimstepsize_quad):
-        ndim_quad, inverse_V_quad, emp_nodes_quad = empnodes_quad(num, known_quad_bases_copy)
-        if surros_quad(tolerance_quad, ndim_quad, inverse_V_quad, emp_nodes_quad, known_quad_bases_copy, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant)==0:
-            b_quad = numpy.dot(numpy.transpose(known_quad_bases_copy[0:ndim_quad]), inverse_V_quad)
-            f_quad = freq[emp_nodes_quad]
-            numpy.save('./B_quadratic.npy', numpy.transpose(b_quad))
-            numpy.save('./fnodes_quadratic.npy', f_quad)
-            print("Number of quadratic basis elements is ", ndim_quad, "and the linear ROQ data save in B_quadratic.npy")
-            flag = 1
-            break
-    if not flag: raise Exception('Could not find a basis to correctly represent the model within the given tolerance and maximum dimension selected.\nTry increasing the allowed basis size or decreasing the tolerance.')
-    return
+# validation_set holds |h+|^2 test waveforms here, b_dtype would be numpy.float32
+@instrumented()
+def roqs_quad(tolerance_quad, freq,  ndimlow_quad, ndimhigh_quad, ndimstepsize_quad, known_quad_bases_copy, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant, validation_set=None, early_exit=0, parallel=0, nprocesses=1, search='linear', b_dtype=None, outdir='.', comm=None):
+    if validation_set is None: validation_set = generate_validation_set(nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, approximant, quad=1, parallel=parallel, nprocesses=nprocesses, comm=comm, waveFlags=waveFlags)
+    ndims_quad = np.arange(ndimlow_quad, min(ndimhigh_quad, len(known_quad_bases_copy)+1), ndimstepsize_quad)
+    nodes_quad = eim_nodes(known_quad_bases_copy, ndims_quad[-1]) if len(ndims_quad) else None
+    curve_quad = {}
+    def passes(num):
+        ndim_quad, inverse_V_quad, emp_nodes_quad = empnodes_quad(num, known_quad_bases_copy, nodes_quad)
+        return surros_quad(tolerance_quad, ndim_quad, inverse_V_quad, emp_nodes_quad, known_quad_bases_copy, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant, validation_set=validation_set, early_exit=early_exit, curve=curve_quad, comm=comm)==0
+    i = search_basis_size(ndims_quad, passes, search)
+    if i is None: raise Exception('Could not find a basis to correctly represent the model within the given tolerance and maximum dimension selected.\nTry increasing the allowed basis size or decreasing the tolerance.')
+    ndim_quad, inverse_V_quad, emp_nodes_quad = empnodes_quad(ndims_quad[i], known_quad_bases_copy, nodes_quad)
+    b_quad = numpy.dot(numpy.transpose(known_quad_bases_copy[0:ndim_quad]), inverse_V_quad)
+    if b_dtype is not None: b_quad = rounded_interpolant(b_quad, b_dtype, emp_nodes_quad, validation_set[1], deltaF, tolerance_quad, 'B_quadratic', comm)
+    f_quad = freq[emp_nodes_quad]
+    if mpi_root(comm):
+        numpy.save(os.path.join(outdir, 'B_quadratic.npy'), numpy.transpose(b_quad))
+        numpy.save(os.path.join(outdir, 'fnodes_quadratic.npy'), f_quad)
+    print("Number of quadratic basis elements is ", ndim_quad, "and the linear ROQ data save in B_quadratic.npy")
+    return dict(sorted(curve_quad.items()))
 
 def testrep_quad(b_quad, emp_nodes_quad, test_mc_quad, test_q_quad, test_s1_quad, test_s2_quad, test_ecc_quad, test_lambda1_quad, test_lambda2_quad, test_iota_quad, test_phiref_quad, distance, deltaF, f_min, f_max, waveFlags, approximant):
     hp_test_quad = (numpy.absolute(generate_a_waveform_from_mcq(test_mc_quad, test_q_quad, test_s1_quad, test_s2_quad, test_ecc_quad, test_lambda1_quad, test_lambda2_quad, test_iota_quad, test_phiref_quad, distance, deltaF, f_min, f_max, waveFlags, approximant)))**2
@@ -692,31 +1910,225 @@ def testrep_quad(b_quad, emp_nodes_quad, test_mc_quad, test_q_quad, test_s1_quad
     plt.savefig('./testrepquad.png')
     return
 
-def surros_of_test_samples(nsamples, nparams, params_low, params_high, tolerance, b_linear, emp_nodes, distance, deltaF, f_min, f_max, waveFlags, approximant):
+def surros_of_test_samples(nsamples, nparams, params_low, params_high, tolerance, b_linear, emp_nodes, distance, deltaF, f_min, f_max, waveFlags, approximant, validation_set=None):
     nts=nsamples
-    ndim = len(emp_nodes)
-    test_points = generate_params_points(nts, nparams, params_low, params_high)
-    surros = numpy.zeros(nts)
-    for i in numpy.arange(0,nts):
-        test_mc =  test_points[i,0]
-        test_q = test_points[i,1]
-        test_s1 = spherical_to_cartesian(test_points[i,2:5])
-        test_s2 = spherical_to_cartesian(test_points[i,5:8])
-        test_iota = test_points[i,8]
-        test_phiref = test_points[i,9]
-        test_ecc = 0
-        test_lambda1 = 0
-        test_lambda2 = 0
-        if nparams == 11: test_ecc = test_points[i,10]
-        if nparams == 12: 
-            test_lambda1 = test_points[i,10]
-            test_lambda2 = test_points[i,11]
-        hp_test = generate_a_waveform_from_mcq(test_mc, test_q, test_s1, test_s2, test_ecc, test_lambda1, test_lambda2, test_iota, test_phiref, distance, deltaF, f_min, f_max, waveFlags, approximant)
-        hp_test_emp = hp_test[emp_nodes]
-        hp_rep = numpy.dot(b_linear,hp_test_emp) 
-        surros[i] = (1-overlap_of_two_waveforms(hp_test, hp_rep))*deltaF
-    if (surros[i] > tolerance):
+    if validation_set is None: validation_set = generate_validation_set(nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, approximant, waveFlags=waveFlags)
+    test_points, test_waveforms = validation_set
+    surros = surrogate_errors(b_linear, emp_nodes, test_waveforms, deltaF)
+    for i in numpy.flatnonzero(surros > tolerance):
         print("iter", i, surros[i], test_points[i])
-    if i%100==0:
-        print("iter", i, surros[i])
     return surros
+
+# Parameter-space partitioning ###
+# Wide parameter ranges need large bases, hence many nodes in the likelihood. partition_roq splits the
+# params_low/params_high box in two along one parameter, recursively, until the greedy search of every patch
+# converges within nbases linear and nbases_quad quadratic bases. The patches are built concurrently, each saves
+# its ROQ data (see roqs and roqs_quad) in its own directory, and index.json maps the boxes to these directories.
+# A patch is named by its path in the tree of splits: '0' is the whole box, '01' the upper half of its lower half...
+
+# Random generator of a patch, seeded from its name so a patch gets the same points whatever the order of the builds
+def patch_random_state(patch_id, seed=0):
+    return numpy.random.RandomState((zlib.crc32(patch_id.encode()) + seed) % 2**32)
+
+# Uniform points of the box, see generate_params_points
+def patch_points(npts, params_low, params_high, random_state):
+    paramspoints = random_state.uniform(params_low, params_high, size=(npts, len(params_low)))
+    return paramspoints.round(decimals=6)
+
+# Greedy search on a fixed training set, starting from its first waveform, stopped at greedy_tolerance or nbases bases
+# (at least 2, for the empirical interpolation). Returns the bases and the residual modula of the training points.
+def patch_bases(training, nbases, greedy_tolerance, label):
+    first = training.residual(0)
+    store = BasisStore(numpy.array([first/numpy.linalg.norm(first)]), training.points[:1], [0.0], capacity=nbases)
+    training.project_out(store.bases)
+    for k in greedy_iterations(nbases):
+        basis_new, params_new, rm_new = least_match_training_set(training, store.bases, greedy_tolerance if len(store) > 1 else None)
+        if len(store) > 1 and greedy_converged(rm_new, greedy_tolerance, label, len(store)): break
+        store.append(basis_new, params_new, rm_new)
+    return store.bases, training.modula()
+
+# Largest surrogate error of the interpolant built on all the bases, see surrogate_errors
+def patch_surrogate_error(bases, test_waveforms, deltaF):
+    ndim, inverse_V, emp_nodes = empnodes(len(bases), bases)
+    b = numpy.dot(numpy.transpose(bases), inverse_V)
+    return numpy.max(surrogate_errors(b, emp_nodes, test_waveforms, deltaF))
+
+# Mismatch 1-|<h1|h2>|/(|h1||h2|) of two waveforms, minimized over their constant phase difference
+def mismatch(h1, h2):
+    return 1 - numpy.absolute(numpy.vdot(h1, h2))/(numpy.linalg.norm(h1)*numpy.linalg.norm(h2))
+
+# Parameter along which the box is split: the one whose range spans the most distinguishable waveforms, which the bases
+# need most elements for. This is measured by the mismatch between the waveforms at each of paramspoints and after a step
+# of a fraction step of the parameter range, i.e. by g_ii (high_i-low_i)^2 with g the overlap metric.
+# Parameters with an empty range are never split.
+def split_parameter(paramspoints, params_low, params_high, distance, deltaF, f_min, f_max, approximant, step=1e-3):
+    params_low, params_high = numpy.array(params_low), numpy.array(params_high)
+    span = params_high - params_low
+    scores = numpy.zeros(len(span))
+    for paramspoint in paramspoints:
+        hp = generate_a_waveform_from_paramspoint(paramspoint, distance, deltaF, f_min, f_max, approximant)
+        for i in numpy.flatnonzero(span > 0):
+            shifted = numpy.array(paramspoint)
+            shifted[i] += step*span[i] if shifted[i]+step*span[i] <= params_high[i] else -step*span[i]
+            scores[i] += mismatch(hp, generate_a_waveform_from_paramspoint(shifted, distance, deltaF, f_min, f_max, approximant))
+    if not numpy.any(scores > 0): raise ValueError("No parameter of the box can be split.")
+    return int(numpy.argmax(scores))
+
+def build_patch(patch_id, params_low, params_high, nbases, nbases_quad, npts, nts, greedy_tolerance, greedy_tolerance_quad, tolerance, tolerance_quad, distance, deltaF, f_min, f_max, approximant, outdir, seed=0, nsplit=4):
+    """
+    Builds the ROQ of one patch, serially (the patches are the parallel tasks, see partition_roq).
+    If the greedy searches converge within nbases and nbases_quad bases and their interpolants meet tolerance and
+    tolerance_quad on nts validation waveforms, the ROQ data are saved in outdir/patch_<patch_id>.
+    Otherwise the parameter to split, measured at nsplit training points, is returned (see split_parameter).
+    """
+    random_state = patch_random_state(patch_id, seed)
+    training_points = patch_points(npts, params_low, params_high, random_state)
+    training_waveforms = generate_training_waveforms(0, 1, training_points, distance, deltaF, f_min, f_max, approximant)
+    training_waveforms_quad = squared_training_matrix(training_waveforms)
+    bases, modula = patch_bases(TrainingSet(training_points, training_waveforms), nbases, greedy_tolerance, "Patch "+patch_id+" linear")
+    quad_bases, modula_quad = patch_bases(TrainingSet(training_points, training_waveforms_quad), nbases_quad, greedy_tolerance_quad, "Patch "+patch_id+" quadratic")
+    patch = {'id': patch_id, 'params_low': list(params_low), 'params_high': list(params_high), 'converged': False}
+    converged = numpy.max(modula) < greedy_tolerance and numpy.max(modula_quad) < greedy_tolerance_quad
+    if converged:
+        test_points = patch_points(nts, params_low, params_high, random_state)
+        test_waveforms = generate_training_waveforms(0, 1, test_points, distance, deltaF, f_min, f_max, approximant)
+        test_waveforms_quad = squared_training_matrix(test_waveforms)
+        converged = patch_surrogate_error(bases, test_waveforms, deltaF) <= tolerance and patch_surrogate_error(quad_bases, test_waveforms_quad, deltaF) <= tolerance_quad
+    if not converged:
+        patch['split'] = split_parameter(training_points[:nsplit], params_low, params_high, distance, deltaF, f_min, f_max, approximant)
+        return patch
+    # the interpolants on all the bases pass, so the searches below find the smallest bases that do
+    directory = 'patch_'+patch_id
+    os.makedirs(os.path.join(outdir, directory), exist_ok=True)
+    freq = numpy.arange(f_min, f_max, deltaF)
+    waveFlags = waveform_generator(approximant).waveflags(approximant)
+    nparams = len(params_low)
+    roqs(tolerance, freq, 2, len(bases)+1, 1, bases, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant, validation_set=(test_points, test_waveforms), search='bisection', outdir=os.path.join(outdir, directory))
+    roqs_quad(tolerance_quad, freq, 2, len(quad_bases)+1, 1, quad_bases, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant, validation_set=(test_points, test_waveforms_quad), search='bisection', outdir=os.path.join(outdir, directory))
+    patch.update({'converged': True, 'directory': directory,
+                  'nbases': len(numpy.load(os.path.join(outdir, directory, 'fnodes_linear.npy'))),
+                  'nbases_quad': len(numpy.load(os.path.join(outdir, directory, 'fnodes_quadratic.npy')))})
+    return patch
+
+# Lower and upper halves of a box along parameter i
+def split_box(params_low, params_high, i):
+    middle = 0.5*(params_low[i]+params_high[i])
+    lower_high, upper_low = list(params_high), list(params_low)
+    lower_high[i], upper_low[i] = middle, middle
+    return (list(params_low), lower_high), (upper_low, list(params_high))
+
+def partition_roq(nbases, nbases_quad, npts, nts, params_low, params_high, greedy_tolerance, greedy_tolerance_quad, tolerance, tolerance_quad, distance, deltaF, f_min, f_max, approximant, outdir='roq_patches', parallel=1, nprocesses=None, max_depth=8, seed=0):
+    """
+    Partitions the params_low/params_high box into patches whose ROQs need at most nbases linear and nbases_quad
+    quadratic bases, see build_patch. With parallel=1 (2) the patches are built on a pool of nprocesses processes (threads),
+    the two halves of a patch are submitted as soon as it is found to need a split. Patches are not split beyond
+    max_depth, those that still miss the targets are listed in the index without ROQ data.
+    Returns the index, also saved in outdir/index.json, see find_patch.
+    """
+    if nbases < 2 or nbases_quad < 2: raise ValueError("The patches need at least 2 linear and 2 quadratic bases.")
+    os.makedirs(outdir, exist_ok=True)
+    task = functools.partial(build_patch, nbases=nbases, nbases_quad=nbases_quad, npts=npts, nts=nts, greedy_tolerance=greedy_tolerance, greedy_tolerance_quad=greedy_tolerance_quad,
+                             tolerance=tolerance, tolerance_quad=tolerance_quad, distance=distance, deltaF=deltaF, f_min=f_min, f_max=f_max, approximant=approximant, outdir=outdir, seed=seed)
+    results = queue.Queue()
+    pool = start_pool(nprocesses, approximant, parallel == 2) if parallel in (1, 2) else None
+    def submit(patch_id, low, high):
+        if pool is None: results.put(task(patch_id, low, high))
+        else: pool.apply_async(task, (patch_id, low, high), callback=results.put, error_callback=results.put)
+    patches = []
+    try:
+        submit('0', list(params_low), list(params_high))
+        pending = 1
+        while pending:
+            patch = results.get()
+            pending -= 1
+            if isinstance(patch, BaseException): raise patch
+            record_event('patch', **patch)
+            if patch['converged']:
+                print("Patch", patch['id'], "has", patch['nbases'], "linear and", patch['nbases_quad'], "quadratic bases")
+            elif len(patch['id']) > max_depth:
+                warnings.warn("Patch "+patch['id']+" misses the basis size targets at the maximum depth "+str(max_depth)+", it has no ROQ data.")
+            else:
+                print("Patch", patch['id'], "is split along parameter", patch['split'])
+                for half, (low, high) in enumerate(split_box(patch['params_low'], patch['params_high'], patch['split'])):
+                    submit(patch['id']+str(half), low, high)
+                    pending += 1
+                continue
+            patches.append(patch)
+    finally:
+        stop_pool(pool)
+    index = {'params_low': list(params_low), 'params_high': list(params_high), 'deltaF': deltaF, 'f_min': f_min, 'f_max': f_max, 'approximant': approximant,
+             'tolerance': tolerance, 'tolerance_quad': tolerance_quad, 'patches': sorted(patches, key=lambda patch: patch['id'])}
+    with open(os.path.join(outdir, 'index.json'), 'w') as f: json.dump(index, f, indent=1)
+    return index
+
+# Patch of the index (a dict, or the directory of index.json) containing paramspoint, None if it is outside the box.
+# The ROQ data of the patch are in its directory relative to that of the index, e.g.
+# weights.roq_weights(data, psd, deltaF, f_min, directory=os.path.join(outdir, patch['directory'])).
+def find_patch(index, paramspoint):
+    if not isinstance(index, dict):
+        with open(os.path.join(index, 'index.json')) as f: index = json.load(f)
+    for patch in index['patches']:
+        if numpy.all(numpy.array(patch['params_low']) <= paramspoint) and numpy.all(paramspoint <= numpy.array(patch['params_high'])): return patch
+    return None
+
+# end parameter-space partitioning ###
+
+# ROQ likelihood ###
+# The point of the ROQ: a likelihood evaluation needs the waveform at the linear and quadratic nodes only,
+# and the weights of PyROQ.weights.
+
+# Waveform (h+) at a point of the sampled parameter space, at the given frequencies only (e.g. the ROQ nodes).
+# Generators that support node sampling evaluate it there directly, the others sample the full-band waveform.
+def generate_a_waveform_at_frequencies(paramspoint, frequencies, distance, deltaF, f_min, f_max, approximant, waveFlags=None):
+    return waveform_generator(approximant).generate([paramspoint], distance, deltaF, f_min, f_max, approximant, waveFlags=waveFlags, frequencies=frequencies)[0]
+
+@instrumented()
+def _node_waveforms_chunk(item, frequencies, deltaF, f_min, f_max, approximant):
+    start, paramspoints, distances = item
+    record_count('waveforms', len(paramspoints))
+    return start, waveform_generator(approximant).generate(paramspoints, distances, deltaF, f_min, f_max, approximant, frequencies=frequencies)
+
+@instrumented()
+def generate_node_waveforms(paramspoints, fnodes_linear, fnodes_quadratic, distance, deltaF, f_min, f_max, approximant, parallel=0, nprocesses=1, pool=None, chunksize=None):
+    """
+    Waveforms of the parameter samples (one per row of paramspoints) at the linear and at the quadratic nodes,
+    generated once per sample at the union of the nodes. distance is one value or one per sample.
+    The samples are handed to the waveform generator as one batch, or in batches of chunksize samples to the workers
+    if parallel=1 (processes) or 2 (threads); parallel='auto' chooses from the cost of a pilot batch (see execution_plan).
+    """
+    paramspoints = numpy.atleast_2d(paramspoints)
+    distances = numpy.broadcast_to(distance, (len(paramspoints),))
+    frequencies, node_index = numpy.unique(numpy.concatenate([fnodes_linear, fnodes_quadratic]), return_inverse=True)
+    if parallel == 'auto' and pool is not None: parallel = 1
+    if parallel == 'auto': parallel, nprocesses, chunksize = execution_plan(paramspoints[:5], len(paramspoints), distances[0], deltaF, f_min, f_max, approximant, nprocesses=nprocesses, chunksize=chunksize, frequencies=frequencies)
+    if parallel not in (0, 1, 2): raise ValueError("parallel must be 0, 1, 2 or 'auto', got "+str(parallel)+".")
+    task = functools.partial(_node_waveforms_chunk, frequencies=frequencies, deltaF=deltaF, f_min=f_min, f_max=f_max, approximant=approximant)
+    node_waveforms = numpy.empty((len(paramspoints), len(frequencies)), dtype=numpy.complex128)
+    if parallel in (1, 2):
+        own_pool = pool is None
+        if own_pool: pool = start_pool(nprocesses, approximant, parallel == 2)
+        if chunksize is None: chunksize = pool_chunksize(len(paramspoints), nprocesses)
+        items = [(start, paramspoints[start:start+chunksize], distances[start:start+chunksize]) for start in range(0, len(paramspoints), chunksize)]
+        try:
+            for start, hps in pool.imap_unordered(task, items): node_waveforms[start:start+len(hps)] = hps
+        finally:
+            if own_pool: stop_pool(pool)
+    else:
+        start, node_waveforms[:] = task((0, paramspoints, distances))
+    return node_waveforms[:, node_index[:len(fnodes_linear)]], node_waveforms[:, node_index[len(fnodes_linear):]]
+
+# ROQ log-likelihoods <d|h> - <h|h>/2 of the waveforms at the linear and quadratic nodes, one row per sample.
+# w_linear may hold one row of weights per time shift (see weights.linear_weights), the result then has one column per time shift.
+def roq_log_likelihood_from_nodes(h_linear, h_quadratic, w_linear, w_quadratic):
+    d_h = numpy.real(numpy.dot(h_linear, numpy.transpose(w_linear)))
+    h_h = numpy.dot((numpy.absolute(h_quadratic))**2, w_quadratic)
+    if numpy.ndim(w_linear) == 2: h_h = h_h[:, numpy.newaxis]
+    return d_h - 0.5*h_h
+
+# ROQ log-likelihoods of a batch of parameter samples (rows of paramspoints, see paramspoint_to_parameters),
+# for the weights of one detector. The waveforms are only generated at the nodes, see generate_node_waveforms.
+def roq_log_likelihood(paramspoints, fnodes_linear, fnodes_quadratic, w_linear, w_quadratic, distance, deltaF, f_min, f_max, approximant, parallel=0, nprocesses=1, pool=None, chunksize=None):
+    h_linear, h_quadratic = generate_node_waveforms(paramspoints, fnodes_linear, fnodes_quadratic, distance, deltaF, f_min, f_max, approximant, parallel=parallel, nprocesses=nprocesses, pool=pool, chunksize=chunksize)
+    return roq_log_likelihood_from_nodes(h_linear, h_quadratic, w_linear, w_quadratic)
+
+# end ROQ likelihood ###
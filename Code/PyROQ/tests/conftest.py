@@ -0,0 +1,21 @@
+import numpy
+import pytest
+
+from PyROQ import pyroq
+from .problem import APPROXIMANT, DELTAF, F_MIN, F_MAX, DISTANCE, waveflags, narrow_patch
+
+@pytest.fixture
+def patch_setup():
+    return narrow_patch()
+
+# Builds linear greedy bases of the narrow patch on a training set of npts points drawn with seed.
+# The builders save their results in the working directory, so the tests run in tmp_path.
+@pytest.fixture
+def build_linear_bases(patch_setup, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    setup = patch_setup
+    def build(nbases, npts=200, seed=1, **kwargs):
+        numpy.random.seed(seed)
+        training_points = pyroq.generate_params_points(npts, setup['nparams'], setup['params_low'], setup['params_high'])
+        return pyroq.bases_searching_results_unnormalized(0, 1, npts, setup['nparams'], nbases, setup['known_bases'], None, setup['params_start'], numpy.array([0.]), setup['params_low'], setup['params_high'], DISTANCE, DELTAF, F_MIN, F_MAX, waveflags(), APPROXIMANT, training_set=1, training_points=training_points, **kwargs)
+    return build
@@ -0,0 +1,28 @@
+import os
+import sys
+import numpy
+
+from PyROQ import pyroq
+from .problem import APPROXIMANT, DELTAF, F_MIN, F_MAX, DISTANCE, narrow_patch
+
+# Linear and joint greedy bases, validation set and ROQ data of the narrow patch, built serially if comm is None
+# and distributed over the ranks of comm otherwise. The ROQ data are saved in the working directory, by the root rank.
+def build(comm=None):
+    setup = narrow_patch()
+    nparams, params_low, params_high, params_start = setup['nparams'], setup['params_low'], setup['params_high'], setup['params_start']
+    numpy.random.seed(1)
+    linear = pyroq.bases_searching_results_unnormalized(0, 1, 301, nparams, 30, setup['known_bases'], None, params_start, numpy.array([0.]), params_low, params_high, DISTANCE, DELTAF, F_MIN, F_MAX, {}, APPROXIMANT, training_set=1, comm=comm)
+    # |h+|^2 of the leading-order amplitude spans a single direction, the quadratic residuals after the first basis are roundoff
+    joint_linear, joint_quad = pyroq.bases_searching_joint_results_unnormalized(0, 1, 257, nparams, 20, 4, setup['known_bases'], setup['known_quad_bases'], params_start, params_start, numpy.array([0.]), numpy.array([0.]), params_low, params_high, DISTANCE, DELTAF, F_MIN, F_MAX, {}, APPROXIMANT, greedy_tolerance_quad=1e-50, comm=comm)
+    validation_set = pyroq.generate_validation_set(150, nparams, params_low, params_high, DISTANCE, DELTAF, F_MIN, F_MAX, APPROXIMANT, comm=comm)
+    freq = numpy.arange(F_MIN, F_MAX, DELTAF)
+    curve = pyroq.roqs(1e-3, freq, 5, 31, 1, linear[0], 150, nparams, params_low, params_high, DISTANCE, DELTAF, F_MIN, F_MAX, {}, APPROXIMANT, validation_set=validation_set, comm=comm)
+    return dict(bases=linear[0], params=linear[1], residual_modula=linear[2], joint_bases=joint_linear[0], joint_quad_bases=joint_quad[0], curve=numpy.array(list(curve.items())))
+
+# mpiexec -n <ranks> python -m PyROQ.tests.mpi_build <directory> saves the results of the distributed build in <directory>/results.npz
+if __name__ == '__main__':
+    comm = pyroq.MPI.COMM_WORLD
+    directory = sys.argv[1]
+    os.chdir(directory)
+    results = build(comm)
+    if pyroq.mpi_root(comm): numpy.savez('results.npz', **results)
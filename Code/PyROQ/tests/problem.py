@@ -0,0 +1,18 @@
+import numpy
+
+from PyROQ import pyroq
+
+# A narrow patch of the tidal TaylorF2 analytic backend, fast enough for tests without LAL.
+APPROXIMANT = 'analytic-TaylorF2-tidal'
+DELTAF, F_MIN, F_MAX = 1/4., 20, 256
+DISTANCE = 100*pyroq.LAL_PC_SI*1e6
+
+def waveflags():
+    return {}
+
+def narrow_patch():
+    nparams, params_low, params_high, params_start, hp1 = pyroq.initial_basis(1.2, 1.202, 1, 1.5, [0,0,0], [0.05,0,0], [0,0,0], [0.05,0,0], 0, 0, 0, 1000, 0, 1000, 0, numpy.pi, 0, 2*numpy.pi, DISTANCE, DELTAF, F_MIN, F_MAX, waveflags(), APPROXIMANT)
+    known_bases = numpy.array([hp1/numpy.linalg.norm(hp1)])
+    hp1_quad = numpy.absolute(hp1)**2
+    known_quad_bases = numpy.array([hp1_quad/numpy.linalg.norm(hp1_quad)])
+    return dict(nparams=nparams, params_low=params_low, params_high=params_high, params_start=params_start, known_bases=known_bases, known_quad_bases=known_quad_bases)
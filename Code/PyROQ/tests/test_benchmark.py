@@ -0,0 +1,10 @@
+from PyROQ import benchmark
+
+def test_stages_count_their_own_waveforms(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    results = benchmark.run_configuration(1, 6, npts=30, nts=20, f_max=128)
+    assert set(results) == set(benchmark.stages)
+    # the greedy stage selects on the training set of the waveforms stage
+    assert results['waveforms']['waveforms'] == 30
+    assert results['greedy']['waveforms'] == 0
+    assert all(result['peak_memory_mb'] > 0 for result in results.values())
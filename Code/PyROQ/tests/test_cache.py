@@ -0,0 +1,46 @@
+import os
+import numpy
+
+from PyROQ import pyroq
+from .problem import APPROXIMANT, DELTAF, F_MIN, F_MAX, DISTANCE
+
+def waveform(i, n=100):
+    return numpy.full(n, i, dtype=numpy.complex128)
+
+def test_memory_and_disk_tiers(tmp_path):
+    cache = pyroq.WaveformCache(str(tmp_path), max_memory=3*waveform(0).nbytes)
+    keys = [pyroq.WaveformCache.key(APPROXIMANT, {}, [i], F_MIN, F_MAX, DELTAF) for i in range(5)]
+    for i, key in enumerate(keys): cache.put(key, waveform(i))
+    assert len(cache._memory) == 3
+    # the first waveforms left the memory tier, they are read back from disk, also by another cache on the directory
+    assert numpy.array_equal(cache.get(keys[0]), waveform(0))
+    assert numpy.array_equal(pyroq.WaveformCache(str(tmp_path)).get(keys[1]), waveform(1))
+    assert cache.get(pyroq.WaveformCache.key(APPROXIMANT, {}, [9], F_MIN, F_MAX, DELTAF)) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_disk_eviction_keeps_the_size_bounded(tmp_path):
+    cache = pyroq.WaveformCache(str(tmp_path), max_memory=0, max_disk=4000)
+    for i in range(20):
+        key = pyroq.WaveformCache.key(APPROXIMANT, {}, [i], F_MIN, F_MAX, DELTAF)
+        cache.put(key, waveform(i))
+        cache.put(key, waveform(i)) # overwriting counts once
+    files = [entry for entry in os.scandir(str(tmp_path)) if entry.name.endswith('.npy')]
+    assert 0 < len(files) < 20
+    assert cache._disk_size == sum(entry.stat().st_size for entry in files) <= 4000
+
+# the entries rewritten for every waveform do not identify the model, the others do
+def test_key_depends_on_the_model_flags():
+    key = lambda flags: pyroq.WaveformCache.key('teobresums-giotto-FD', flags, [1.2, 1.], F_MIN, F_MAX, DELTAF)
+    assert key({'use_tidal': 1, 'M': 2.7}) == key({'use_tidal': 1, 'M': 3.})
+    assert key({'use_tidal': 1}) != key({'use_tidal': 0})
+
+def test_unreadable_flags_are_not_cached(tmp_path):
+    assert pyroq.WaveformCache.key(APPROXIMANT, object(), [1.2, 1.], F_MIN, F_MAX, DELTAF) is None
+    cache = pyroq.WaveformCache(str(tmp_path))
+    pyroq.set_waveform_cache(cache)
+    try:
+        hp = pyroq.generate_a_waveform_from_mcq(1.2, 1.1, [0, 0, 0], [0, 0, 0], 0, 0, 0, 0.3, 0., DISTANCE, DELTAF, F_MIN, F_MAX, object(), APPROXIMANT)
+    finally:
+        pyroq.set_waveform_cache(None)
+    assert len(hp) == (F_MAX - F_MIN)/DELTAF
+    assert (cache.hits, cache.misses) == (0, 0) and os.listdir(str(tmp_path)) == []
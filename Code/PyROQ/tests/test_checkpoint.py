@@ -0,0 +1,14 @@
+import numpy
+import pytest
+
+# A search stopped after a checkpoint and resumed from it finds the same bases as an uninterrupted one.
+@pytest.mark.parametrize('training_storage', [None, 'training.npy', 'training.h5'])
+def test_resumed_search_matches_uninterrupted(build_linear_bases, training_storage):
+    reference = build_linear_bases(20)
+    build_linear_bases(11, training_storage=training_storage, memory_budget=200000, checkpoint='checkpoint.npz', checkpoint_every=4)
+    # the training points come from the checkpoint, a different seed must not change them
+    resumed = build_linear_bases(20, seed=2, training_storage=training_storage, memory_budget=200000, checkpoint='checkpoint.npz', checkpoint_every=4, resume=1)
+    assert len(resumed[0]) == 20
+    assert numpy.allclose(resumed[0], reference[0])
+    assert numpy.array_equal(resumed[1], reference[1])
+    assert numpy.allclose(resumed[2], reference[2])
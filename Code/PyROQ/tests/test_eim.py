@@ -0,0 +1,35 @@
+import numpy
+
+from PyROQ import pyroq
+
+# Textbook empirical interpolation: the k-th node is where the k-th basis differs most from
+# its interpolant on the first k bases and nodes, with the interpolation matrix inverted by pinv.
+def reference_eim_nodes(known_bases, ndim):
+    nodes = [numpy.argmax(numpy.absolute(known_bases[0]))]
+    for k in numpy.arange(1, ndim):
+        V = numpy.transpose(known_bases[0:k, nodes])
+        Ci = numpy.dot(numpy.linalg.pinv(V), known_bases[k, nodes])
+        residual = numpy.dot(Ci, known_bases[0:k]) - known_bases[k]
+        nodes.append(numpy.argmax(numpy.absolute(residual)))
+    return numpy.array(nodes)
+
+def test_eim_nodes_match_reference_on_greedy_bases(build_linear_bases):
+    known_bases = build_linear_bases(12)[0]
+    assert len(known_bases) == 12
+    nodes = pyroq.eim_nodes(known_bases)
+    assert numpy.array_equal(nodes, reference_eim_nodes(known_bases, len(known_bases)))
+    # nested: fewer nodes are a prefix of more
+    assert numpy.array_equal(pyroq.eim_nodes(known_bases, 7), nodes[:7])
+
+def test_eim_nodes_match_reference_on_random_bases():
+    rng = numpy.random.default_rng(3)
+    known_bases = numpy.linalg.qr(rng.normal(size=(300, 20)) + 1j*rng.normal(size=(300, 20)))[0].T
+    assert numpy.array_equal(pyroq.eim_nodes(known_bases), reference_eim_nodes(known_bases, 20))
+    quad_bases = numpy.linalg.qr(rng.uniform(size=(300, 20)))[0].T
+    assert numpy.array_equal(pyroq.eim_nodes(quad_bases), reference_eim_nodes(quad_bases, 20))
+
+def test_empnodes_interpolates_the_bases(build_linear_bases):
+    known_bases = build_linear_bases(12)[0]
+    ndim, inverse_V, emp_nodes = pyroq.empnodes(10, known_bases)
+    assert numpy.array_equal(emp_nodes, numpy.sort(reference_eim_nodes(known_bases, 10)))
+    assert numpy.allclose(numpy.dot(inverse_V, numpy.transpose(known_bases[0:10, emp_nodes])), numpy.eye(10), atol=1e-8)
@@ -0,0 +1,50 @@
+import multiprocessing.pool
+import pytest
+
+from PyROQ import pyroq
+from .problem import APPROXIMANT, DELTAF, F_MIN, F_MAX, DISTANCE
+
+def test_thread_pool_for_thread_safe_generators():
+    pool = pyroq.start_pool(2, APPROXIMANT, threads=1)
+    try:
+        assert isinstance(pool, multiprocessing.pool.ThreadPool)
+    finally:
+        pyroq.stop_pool(pool)
+
+# generators writing each waveform's parameters into the shared waveFlags get processes even with parallel=2
+def test_threads_fall_back_to_processes_for_unsafe_generators():
+    with pytest.warns(UserWarning, match="processes"):
+        pool = pyroq.start_pool(2, 'teobresums-giotto-FD', threads=1)
+    try:
+        assert not isinstance(pool, multiprocessing.pool.ThreadPool)
+    finally:
+        pyroq.stop_pool(pool)
+
+def plan_events(monkeypatch, plan):
+    events = []
+    monkeypatch.setattr(pyroq, 'available_cores', lambda: 4)
+    pyroq.set_instrumentation(pyroq.Instrumentation(callbacks=[events.append]))
+    try:
+        plan()
+    finally:
+        pyroq.set_instrumentation(None)
+    return [event for event in events if event['event'] == 'execution_plan']
+
+# the automatic plan only times thread pools for thread-safe generators
+@pytest.mark.parametrize('thread_safe', [True, False])
+def test_auto_plan_threads_only_for_thread_safe_generators(patch_setup, monkeypatch, thread_safe):
+    setup = patch_setup
+    monkeypatch.setattr(pyroq.waveform_generator(APPROXIMANT), 'thread_safe', thread_safe)
+    points = pyroq.pilot_points(setup['nparams'], setup['params_low'], setup['params_high'])
+    plan, = plan_events(monkeypatch, lambda: pyroq.execution_plan(points, 100, DISTANCE, DELTAF, F_MIN, F_MAX, APPROXIMANT))
+    modes = set(plan_name.split()[0] for plan_name in plan['estimates'])
+    assert ('threads' in modes) == thread_safe and 'processes' in modes
+    if not thread_safe: assert plan['execution'] != 'threads'
+
+# process workers of searches without a training set read the bases from shared memory, only their handle is pickled
+def test_build_plan_charges_the_shared_bases_handle(patch_setup, monkeypatch):
+    setup = patch_setup
+    points = pyroq.pilot_points(setup['nparams'], setup['params_low'], setup['params_high'])
+    shipped, = plan_events(monkeypatch, lambda: pyroq.execution_plan(points, 1000, DISTANCE, DELTAF, F_MIN, F_MAX, APPROXIMANT, nbases=500, evaluations=999))
+    shared, = plan_events(monkeypatch, lambda: pyroq.build_execution_plan(0, 1000, setup['nparams'], setup['params_low'], setup['params_high'], setup['known_bases'], 1000, DISTANCE, DELTAF, F_MIN, F_MAX, APPROXIMANT))
+    assert shared['task_time'] < 0.1*shipped['task_time']
@@ -0,0 +1,31 @@
+import numpy
+
+from PyROQ import pyroq
+
+# With greedy_tolerance the search stops at the first basis whose greedy error is below it,
+# the bases found until then are those of the search without a tolerance.
+def test_greedy_tolerance_stops_the_search(build_linear_bases):
+    reference = build_linear_bases(20)
+    greedy_tolerance = 0.5*(reference[2][10] + reference[2][11])
+    bases, params, residual_modula = build_linear_bases(20, greedy_tolerance=greedy_tolerance)
+    assert len(bases) == 11
+    assert numpy.allclose(bases, reference[0][:11])
+    assert numpy.all(residual_modula[1:] >= greedy_tolerance)
+
+# Bases stored in single precision come with a report of the greedy error they add over a double-precision
+# re-orthonormalization of the same bases
+def test_reduced_precision_bases_report_their_error(build_linear_bases):
+    events = []
+    pyroq.set_instrumentation(pyroq.Instrumentation(callbacks=[events.append]))
+    try:
+        bases = build_linear_bases(12, dtype=numpy.complex64)[0]
+    finally:
+        pyroq.set_instrumentation(None)
+    reports = [event for event in events if event['event'] == 'precision_error']
+    assert len(reports) == 1
+    assert reports[0]['search'] == 'linear' and reports[0]['dtype'] == 'complex64'
+    assert bases.dtype == numpy.complex64
+    assert reports[0]['greedy_error_stored'] >= reports[0]['greedy_error'] > 0
+
+def test_double_precision_bases_are_not_reported(build_linear_bases):
+    assert pyroq.report_precision_error(build_linear_bases(4)[0], "linear", 0, None, None, None, None, None, None, None) is None
@@ -0,0 +1,59 @@
+import json
+import pickle
+import numpy
+import pytest
+
+from PyROQ import pyroq
+from .problem import APPROXIMANT, DELTAF, F_MIN, F_MAX, DISTANCE
+
+@pytest.fixture
+def instrumentation(tmp_path):
+    events = []
+    instr = pyroq.Instrumentation(log=str(tmp_path/'events.jsonl'), callbacks=[events.append])
+    pyroq.set_instrumentation(instr)
+    yield instr, events
+    pyroq.set_instrumentation(None)
+
+def test_greedy_search_timings_counters_and_events(build_linear_bases, instrumentation, tmp_path):
+    instr, events = instrumentation
+    build_linear_bases(8, npts=50)
+    iterations = [event for event in events if event['event'] == 'greedy_iteration']
+    assert [event['nbases'] for event in iterations] == list(range(1, 8))
+    assert all(event['search'] == 'Linear' and event['greedy_error'] > 0 for event in iterations)
+    assert instr.timings['least_match_training_set']['calls'] == 7
+    assert instr.timings['generate_training_waveforms']['calls'] == 1
+    timing = instr.timings['project_out']
+    assert timing['calls'] > 0 and 0 < timing['max'] <= timing['total']
+    assert instr.counters['projections'] > 0
+    summary = instr.close()
+    assert summary['event'] == 'summary' and summary['counters'] == dict(instr.counters)
+    with open(str(tmp_path/'events.jsonl')) as f: logged = [json.loads(line) for line in f]
+    assert [record['event'] for record in logged] == [event['event'] for event in events]
+    assert all('time' in record and 'pid' in record for record in logged)
+
+def test_waveform_counters_and_cache_hits(instrumentation):
+    instr, events = instrumentation
+    pyroq.set_waveform_cache(pyroq.WaveformCache())
+    try:
+        for i in range(3): pyroq.generate_a_waveform_from_mcq(1.2, 1.2, [0,0,0], [0,0,0], 0, 0, 0, 0, 0, DISTANCE, DELTAF, F_MIN, F_MAX, {}, APPROXIMANT)
+    finally:
+        pyroq.set_waveform_cache(None)
+    assert instr.counters['waveforms'] == 1 and instr.counters['cache_hits'] == 2
+    assert instr.timings['generate_waveform']['calls'] == 1
+
+def test_calls_are_logged_on_request():
+    events = []
+    pyroq.set_instrumentation(pyroq.Instrumentation(callbacks=[events.append], log_calls=1))
+    try:
+        pyroq.project_out(numpy.eye(3)[:1], numpy.ones((2, 3)))
+    finally:
+        pyroq.set_instrumentation(None)
+    assert [(event['event'], event['name']) for event in events] == [('call', 'project_out')]
+
+# pool workers get the instrumentation without the callbacks and with their own timings and counters
+def test_workers_copy_drops_callbacks_and_records(instrumentation):
+    instr, events = instrumentation
+    instr.count('waveforms', 5)
+    copy = pickle.loads(pickle.dumps(instr))
+    assert copy.callbacks == [] and copy.timings == {} and copy.counters['waveforms'] == 0
+    assert copy.log == instr.log
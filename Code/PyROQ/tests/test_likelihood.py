@@ -0,0 +1,51 @@
+import numpy
+import pytest
+
+from PyROQ import pyroq, weights
+from .problem import APPROXIMANT, DELTAF, F_MIN, F_MAX, DISTANCE
+
+FREQUENCIES = numpy.arange(F_MIN, F_MAX, DELTAF)
+PSD = 1e-46*(1 + (50/FREQUENCIES)**4)
+
+# B matrices and nodes of the empirical interpolants of the greedy bases and of the quadratic bases.
+# |h+|^2 of the analytic amplitude is f^(-7/3) times a constant, the quadratic interpolant of that direction and f^(-2) is exact.
+@pytest.fixture
+def roq_data(patch_setup, build_linear_bases):
+    known_bases = build_linear_bases(40)[0]
+    ndim, inverse_V, emp_nodes = pyroq.empnodes(40, known_bases)
+    B_linear = numpy.transpose(numpy.dot(numpy.transpose(known_bases), inverse_V))
+    quad_bases = numpy.array([patch_setup['known_quad_bases'][0], pyroq.gram_schmidt(patch_setup['known_quad_bases'], FREQUENCIES**-2.)])
+    ndim_quad, inverse_V_quad, emp_nodes_quad = pyroq.empnodes_quad(2, quad_bases)
+    B_quadratic = numpy.transpose(numpy.dot(numpy.transpose(quad_bases), inverse_V_quad))
+    return B_linear, FREQUENCIES[emp_nodes], B_quadratic, FREQUENCIES[emp_nodes_quad]
+
+def direct_log_likelihood(data, hp):
+    return 4*DELTAF*numpy.sum(numpy.real(numpy.conj(data)*hp)/PSD) - 0.5*4*DELTAF*numpy.sum(numpy.absolute(hp)**2/PSD)
+
+def test_roq_log_likelihood_matches_direct_sums(patch_setup, roq_data):
+    B_linear, fnodes_linear, B_quadratic, fnodes_quadratic = roq_data
+    numpy.random.seed(5)
+    paramspoints = pyroq.generate_params_points(20, patch_setup['nparams'], patch_setup['params_low'], patch_setup['params_high'])
+    data = pyroq.generate_a_waveform_from_paramspoint(paramspoints[0], DISTANCE, DELTAF, F_MIN, F_MAX, APPROXIMANT)
+    time_shifts, w_linear = weights.linear_weights(B_linear, data, PSD, DELTAF, F_MIN, time_shifts=[0.])
+    w_quadratic = weights.quadratic_weights(B_quadratic, PSD, DELTAF)
+    log_likelihood = pyroq.roq_log_likelihood(paramspoints, fnodes_linear, fnodes_quadratic, w_linear[0], w_quadratic, DISTANCE, DELTAF, F_MIN, F_MAX, APPROXIMANT)
+    direct = numpy.array([direct_log_likelihood(data, pyroq.generate_a_waveform_from_paramspoint(paramspoint, DISTANCE, DELTAF, F_MIN, F_MAX, APPROXIMANT)) for paramspoint in paramspoints])
+    snr2 = 4*DELTAF*numpy.sum(numpy.absolute(data)**2/PSD)
+    assert numpy.allclose(log_likelihood, direct, rtol=0, atol=1e-6*snr2)
+    # and at one time shift per weight row
+    h_linear, h_quadratic = pyroq.generate_node_waveforms(paramspoints, fnodes_linear, fnodes_quadratic, DISTANCE, DELTAF, F_MIN, F_MAX, APPROXIMANT)
+    time_shifts, w_linear = weights.linear_weights(B_linear, data, PSD, DELTAF, F_MIN, time_shifts=weights.time_shift_grid(1024, DELTAF)[[0, 5]], nfft=1024)
+    shifted = pyroq.roq_log_likelihood_from_nodes(h_linear, h_quadratic, w_linear, w_quadratic)
+    assert shifted.shape == (20, 2)
+    assert numpy.allclose(shifted[:, 0], log_likelihood)
+
+@pytest.mark.parametrize('parallel', [2, 'auto'])
+def test_node_waveforms_parallel(patch_setup, roq_data, parallel):
+    B_linear, fnodes_linear, B_quadratic, fnodes_quadratic = roq_data
+    paramspoints = pyroq.generate_params_points(30, patch_setup['nparams'], patch_setup['params_low'], patch_setup['params_high'])
+    serial = pyroq.generate_node_waveforms(paramspoints, fnodes_linear, fnodes_quadratic, DISTANCE, DELTAF, F_MIN, F_MAX, APPROXIMANT)
+    pooled = pyroq.generate_node_waveforms(paramspoints, fnodes_linear, fnodes_quadratic, DISTANCE, DELTAF, F_MIN, F_MAX, APPROXIMANT, parallel=parallel, nprocesses=2)
+    assert numpy.allclose(serial[0], pooled[0]) and numpy.allclose(serial[1], pooled[1])
+    with pytest.raises(ValueError):
+        pyroq.generate_node_waveforms(paramspoints, fnodes_linear, fnodes_quadratic, DISTANCE, DELTAF, F_MIN, F_MAX, APPROXIMANT, parallel=3)
@@ -0,0 +1,34 @@
+import os
+import shutil
+import subprocess
+import sys
+import numpy
+import pytest
+
+pytest.importorskip('mpi4py')
+
+from . import mpi_build
+
+NRANKS = 3
+
+# The distributed build shards the training and validation sets over the ranks. The greedy picks
+# agree with the serial build up to roundoff in the projections, which differs from shard to shard.
+@pytest.mark.skipif(shutil.which('mpiexec') is None, reason="mpiexec not found")
+def test_distributed_build_matches_serial(tmp_path, monkeypatch):
+    code_directory = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(mpi_build.__file__))))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([code_directory, os.environ.get('PYTHONPATH', '')]),
+               OMPI_ALLOW_RUN_AS_ROOT='1', OMPI_ALLOW_RUN_AS_ROOT_CONFIRM='1', OMPI_MCA_rmaps_base_oversubscribe='1')
+    (tmp_path/'mpi').mkdir()
+    subprocess.run(['mpiexec', '-n', str(NRANKS), sys.executable, '-m', 'PyROQ.tests.mpi_build', str(tmp_path/'mpi')], env=env, check=True, timeout=600)
+    distributed = numpy.load(tmp_path/'mpi'/'results.npz')
+    (tmp_path/'serial').mkdir()
+    monkeypatch.chdir(tmp_path/'serial')
+    serial = mpi_build.build()
+    for name in ('bases', 'joint_bases', 'joint_quad_bases'):
+        assert distributed[name].shape == serial[name].shape, name
+        assert numpy.allclose(distributed[name], serial[name], atol=1e-8), name
+    assert numpy.allclose(numpy.load(tmp_path/'mpi'/'B_linear.npy'), numpy.load('B_linear.npy'), atol=1e-8)
+    assert numpy.array_equal(numpy.load(tmp_path/'mpi'/'fnodes_linear.npy'), numpy.load('fnodes_linear.npy'))
+    assert numpy.allclose(distributed['params'], serial['params'])
+    assert numpy.allclose(distributed['residual_modula'], serial['residual_modula'], rtol=1e-6)
+    assert numpy.allclose(distributed['curve'], serial['curve'], rtol=1e-6, atol=1e-12)
@@ -0,0 +1,50 @@
+import os
+import numpy
+import pytest
+
+from PyROQ import pyroq
+from .problem import DELTAF, F_MIN, DISTANCE
+
+# A box too wide for 16 linear bases, split into patches of 2 and 3 levels
+APPROXIMANT, F_MAX = 'analytic-TaylorF2', 128
+NPTS, NTS, TOLERANCE = 100, 50, 1e-4
+
+@pytest.fixture(scope='module')
+def box():
+    nparams, params_low, params_high, params_start, hp1 = pyroq.initial_basis(1.2, 1.21, 1, 2, [0,0,0], [0.05,0,0], [0,0,0], [0.05,0,0], 0, 0, 0, 0, 0, 0, 0, numpy.pi, 0, 2*numpy.pi, DISTANCE, DELTAF, F_MIN, F_MAX, {}, APPROXIMANT)
+    hp = pyroq.generate_a_waveform_from_paramspoint(params_start[0], DISTANCE, DELTAF, F_MIN, F_MAX, APPROXIMANT)
+    return params_low, params_high, 1e-3*numpy.linalg.norm(hp), 1e-3*numpy.linalg.norm(numpy.absolute(hp)**2)
+
+def partition(box, outdir, parallel):
+    params_low, params_high, greedy_tolerance, greedy_tolerance_quad = box
+    return pyroq.partition_roq(16, 4, NPTS, NTS, params_low, params_high, greedy_tolerance, greedy_tolerance_quad, TOLERANCE, TOLERANCE, DISTANCE, DELTAF, F_MIN, F_MAX, APPROXIMANT, outdir=str(outdir), parallel=parallel, nprocesses=2, max_depth=4)
+
+def contains(patch, paramspoint):
+    return numpy.all(numpy.array(patch['params_low']) <= paramspoint) and numpy.all(paramspoint <= numpy.array(patch['params_high']))
+
+@pytest.mark.parametrize('parallel', [0, 1])
+def test_patches_cover_the_box_once(box, tmp_path, parallel):
+    index = partition(box, tmp_path, parallel)
+    patches = index['patches']
+    assert len(patches) > 1 and all(patch['converged'] for patch in patches)
+    for paramspoint in numpy.random.RandomState(3).uniform(box[0], box[1], size=(500, len(box[0]))):
+        owners = [patch['id'] for patch in patches if contains(patch, paramspoint)]
+        assert len(owners) == 1
+        assert pyroq.find_patch(str(tmp_path), paramspoint)['id'] == owners[0]
+    assert pyroq.find_patch(index, numpy.array(box[1]) + 1) is None
+
+# The saved interpolants of every patch meet the tolerance on its validation points, which the patch draws
+# from its own random generator after its training points
+def test_patches_meet_their_tolerance(box, tmp_path):
+    index = partition(box, tmp_path, 0)
+    freq = numpy.arange(F_MIN, F_MAX, DELTAF)
+    for patch in index['patches']:
+        random_state = pyroq.patch_random_state(patch['id'])
+        pyroq.patch_points(NPTS, patch['params_low'], patch['params_high'], random_state)
+        test_points = pyroq.patch_points(NTS, patch['params_low'], patch['params_high'], random_state)
+        test_waveforms = pyroq.generate_training_waveforms(0, 1, test_points, DISTANCE, DELTAF, F_MIN, F_MAX, APPROXIMANT)
+        for name, waveforms in (('linear', test_waveforms), ('quadratic', pyroq.squared_training_matrix(test_waveforms))):
+            directory = os.path.join(str(tmp_path), patch['directory'])
+            b = numpy.transpose(numpy.load(os.path.join(directory, 'B_'+name+'.npy')))
+            emp_nodes = numpy.searchsorted(freq, numpy.load(os.path.join(directory, 'fnodes_'+name+'.npy')))
+            assert numpy.max(pyroq.surrogate_errors(b, emp_nodes, waveforms, DELTAF)) <= TOLERANCE
@@ -0,0 +1,36 @@
+import os
+import numpy
+
+from PyROQ import pyroq
+from .problem import APPROXIMANT, DELTAF, F_MIN, F_MAX, DISTANCE
+
+def test_handle_follows_the_grown_store():
+    rows = numpy.random.RandomState(0).normal(size=(5, 7))
+    store = pyroq.BasisStore(rows[:1], numpy.zeros((1, 2)), [0.0], capacity=2, shared=1)
+    try:
+        first = store.shared_bases()
+        for row in rows[1:]: store.append(row, numpy.zeros(2), 0.0)
+        handle = store.shared_bases()
+        assert store.capacity == 8 and handle.path != first.path
+        assert not os.path.exists(first.path)
+        assert numpy.array_equal(handle.array(), rows)
+    finally:
+        store.close()
+    assert not os.path.exists(handle.path)
+
+# Without a training set and with nbases=None the store starts with room for 2 bases and grows while the
+# process workers read the bases through their handle, the bases found are those of the serial search
+def test_process_search_with_growing_shared_bases(patch_setup, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    setup = patch_setup
+    hp = pyroq.generate_a_waveform_from_paramspoint(setup['params_start'][0], DISTANCE, DELTAF, F_MIN, F_MAX, APPROXIMANT)
+    results = []
+    for parallel in (0, 1):
+        numpy.random.seed(4)
+        results.append(pyroq.bases_searching_results_unnormalized(parallel, 2, 50, setup['nparams'], None, setup['known_bases'], None, setup['params_start'], numpy.array([0.]), setup['params_low'], setup['params_high'], DISTANCE, DELTAF, F_MIN, F_MAX, {}, APPROXIMANT, greedy_tolerance=0.2*numpy.linalg.norm(hp)))
+    (serial, serial_params, serial_modula), (shared, shared_params, shared_modula) = results
+    assert len(serial) > 4
+    assert len(shared) == len(serial)
+    assert numpy.allclose(shared, serial)
+    assert numpy.array_equal(shared_params, serial_params)
+    assert numpy.allclose(shared_modula, serial_modula)
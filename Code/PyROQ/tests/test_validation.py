@@ -0,0 +1,37 @@
+import numpy
+
+from PyROQ import pyroq
+
+def random_problem(nts=300, L=200, ndim=6):
+    rng = numpy.random.default_rng(2)
+    known_bases = numpy.linalg.qr(rng.normal(size=(L, ndim)) + 1j*rng.normal(size=(L, ndim)))[0].T
+    test_waveforms = rng.normal(size=(nts, ndim)).dot(known_bases) + 1e-3*rng.normal(size=(nts, L))
+    return known_bases, test_waveforms
+
+def test_blocked_errors_match_one_by_one():
+    known_bases, test_waveforms = random_problem()
+    ndim, inverse_V, emp_nodes = pyroq.empnodes(6, known_bases)
+    b = numpy.dot(numpy.transpose(known_bases), inverse_V)
+    errors = pyroq.surrogate_errors(b, emp_nodes, test_waveforms, 0.25, block_size=7)
+    expected = [(1-pyroq.overlap_of_two_waveforms(h, numpy.dot(b, h[emp_nodes])))*0.25 for h in test_waveforms]
+    assert numpy.allclose(errors, expected, rtol=1e-8, atol=1e-15)
+
+# the default blocks of an early exit are small enough to skip most of the validation set
+def test_early_exit_stops_after_a_small_block():
+    known_bases, test_waveforms = random_problem()
+    ndim, inverse_V, emp_nodes = pyroq.empnodes(6, known_bases)
+    b = numpy.dot(numpy.transpose(known_bases), inverse_V)
+    errors = pyroq.surrogate_errors(b, emp_nodes, test_waveforms, 0.25, tolerance=0., early_exit=1)
+    assert numpy.sum(~numpy.isnan(errors)) == pyroq.early_exit_block
+    assert not numpy.any(numpy.isnan(pyroq.surrogate_errors(b, emp_nodes, test_waveforms, 0.25, tolerance=1., early_exit=1)))
+
+# the curve only records the largest error of sizes validated on all the points
+def test_curve_leaves_out_early_exits():
+    known_bases, test_waveforms = random_problem()
+    ndim, inverse_V, emp_nodes = pyroq.empnodes(6, known_bases)
+    validation_set = (numpy.zeros((len(test_waveforms), 10)), test_waveforms)
+    curve = {}
+    assert pyroq.surros(0., ndim, inverse_V, emp_nodes, known_bases, 300, 10, None, None, 1, 0.25, 20, 70, {}, None, validation_set=validation_set, early_exit=1, curve=curve) == 1
+    assert curve == {}
+    pyroq.surros(0., ndim, inverse_V, emp_nodes, known_bases, 300, 10, None, None, 1, 0.25, 20, 70, {}, None, validation_set=validation_set, curve=curve)
+    assert curve[6] > 0
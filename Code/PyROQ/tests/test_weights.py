@@ -0,0 +1,55 @@
+import numpy
+import pytest
+
+from PyROQ import weights
+
+DELTAF, F_MIN, F_MAX = 1/4., 20, 60
+
+# Leading-order chirp of chirp mass mc (in solar masses) with phase offset phi
+def chirp(mc, phi, frequencies):
+    x = numpy.pi*mc*4.925491e-6*frequencies
+    return 1e-23*frequencies**(-7/6.)*numpy.exp(1j*(3/128.*x**(-5/3.) + phi))
+
+def direct_linear_weights(B, data, psd, deltaF, f_min, time_shifts):
+    frequencies = f_min + deltaF*numpy.arange(B.shape[1])
+    phases = numpy.exp(-2j*numpy.pi*numpy.outer(time_shifts, frequencies))
+    return 4*deltaF*numpy.dot(phases*numpy.conj(data)/psd, numpy.transpose(B))
+
+@pytest.fixture
+def roq_data():
+    frequencies = numpy.arange(F_MIN, F_MAX, DELTAF)
+    strains = numpy.array([chirp(mc, 0.2, frequencies) for mc in (1.2, 1.15, 1.3, 1.1, 1.18)])
+    # orthonormal rows spanning the strains stand in for B, only the sums over frequencies matter here
+    B = numpy.linalg.qr(numpy.transpose(strains))[0].T
+    data = chirp(1.19, 1., frequencies)
+    psd = 1e-46*(1 + (50/frequencies)**4)
+    return B, data, psd
+
+def test_linear_weights_match_direct_sum(roq_data):
+    B, data, psd = roq_data
+    time_shifts, w = weights.linear_weights(B, data, psd, DELTAF, F_MIN)
+    assert numpy.allclose(time_shifts, weights.time_shift_grid(len(time_shifts), DELTAF))
+    expected = direct_linear_weights(B, data, psd, DELTAF, F_MIN, time_shifts)
+    assert numpy.allclose(w, expected, rtol=1e-10, atol=1e-12*numpy.abs(expected).max())
+
+def test_linear_weights_selected_shifts_and_blocks(roq_data):
+    B, data, psd = roq_data
+    nfft = 512
+    grid = weights.time_shift_grid(nfft, DELTAF)
+    time_shifts = grid[[0, 3, 100, 511]]
+    _, w = weights.linear_weights(B, data, psd, DELTAF, F_MIN, time_shifts=time_shifts, nfft=nfft, memory_budget=1)
+    expected = direct_linear_weights(B, data, psd, DELTAF, F_MIN, time_shifts)
+    assert numpy.allclose(w, expected, rtol=1e-10, atol=1e-12*numpy.abs(expected).max())
+    with pytest.raises(ValueError):
+        weights.linear_weights(B, data, psd, DELTAF, F_MIN, time_shifts=[0.5/(nfft*DELTAF)], nfft=nfft)
+
+def test_linear_weights_detectors(roq_data):
+    B, data, psd = roq_data
+    _, w = weights.linear_weights(B, {'H1': data, 'L1': 2*data}, {'H1': psd, 'L1': psd}, DELTAF, F_MIN)
+    assert numpy.allclose(w['L1'], 2*w['H1'])
+
+def test_quadratic_weights_match_direct_sum(roq_data):
+    B, data, psd = roq_data
+    B_quadratic = numpy.absolute(B)
+    q = weights.quadratic_weights(B_quadratic, psd, DELTAF, memory_budget=64)
+    assert numpy.allclose(q, 4*DELTAF*numpy.sum(B_quadratic/psd, axis=1), rtol=1e-12)
@@ -0,0 +1,99 @@
+import numpy
+import scipy.fft
+import os
+
+# ROQ likelihood weights ###
+# For a waveform h known at the linear nodes F_j and the quadratic nodes G_k,
+#   <d|h> = Re sum_j w_j h(F_j)          with w_j = 4 deltaF sum_f conj(d(f)) B_j(f)/S(f)
+#   <h|h> = sum_k q_k |h(G_k)|^2         with q_k = 4 deltaF sum_f B'_k(f)/S(f)
+# where B and B' are the rows of B_linear.npy and B_quadratic.npy, and d and S the strain data and the PSD on
+# the frequency grid of the bases, f = f_min + n deltaF. data and psd can be dicts of detector name -> series,
+# the weights of all detectors are then computed while reading B once and returned in dicts with the same keys.
+
+# B matrices and frequency nodes saved by roqs and roqs_quad. The B matrices are memory-mapped, the weights below read them in blocks.
+def load_roq_data(directory='.'):
+    B_linear = numpy.load(os.path.join(directory, 'B_linear.npy'), mmap_mode='r')
+    fnodes_linear = numpy.load(os.path.join(directory, 'fnodes_linear.npy'))
+    B_quadratic = numpy.load(os.path.join(directory, 'B_quadratic.npy'), mmap_mode='r')
+    fnodes_quadratic = numpy.load(os.path.join(directory, 'fnodes_quadratic.npy'))
+    return B_linear, fnodes_linear, B_quadratic, fnodes_quadratic
+
+def _detector_lists(B, data, psd):
+    if isinstance(psd, dict):
+        detectors = list(psd.keys())
+        psd = [numpy.asarray(psd[detector], dtype=numpy.float64) for detector in detectors]
+        if data is not None: data = [numpy.asarray(data[detector]) for detector in detectors]
+    else:
+        detectors = None
+        psd = [numpy.asarray(psd, dtype=numpy.float64)]
+        if data is not None: data = [numpy.asarray(data)]
+    for series in psd + (data or []):
+        if len(series) != B.shape[1]:
+            raise ValueError("Strain and PSD must have one value per frequency of the B matrix ("+str(B.shape[1])+"), got "+str(len(series))+".")
+    return detectors, data, psd
+
+def _detector_results(detectors, results):
+    if detectors is None: return results[0]
+    return dict(zip(detectors, results))
+
+# Time shifts tc = k/(nfft deltaF), k = 0...nfft-1, of the FFT in linear_weights. They are periodic with period 1/deltaF,
+# shifts past half the period stand for the negative ones.
+def time_shift_grid(nfft, deltaF):
+    return numpy.arange(nfft)/(nfft*deltaF)
+
+def linear_weights(B_linear, data, psd, deltaF, f_min, time_shifts=None, nfft=None, memory_budget=2**28):
+    """
+    Linear ROQ weights w_j(tc) = 4 deltaF sum_f conj(d(f)) B_j(f) exp(-2 pi i f tc)/S(f), such that <d|h> = Re sum_j w_j(tc) h(F_j)
+    for the waveform h shifted in time by tc. As exp(-2 pi i f tc) = exp(-2 pi i f_min tc) exp(-2 pi i n k/nfft) for tc = k/(nfft deltaF),
+    the weights at all nfft time shifts come from one FFT per basis, nfft is the smallest fast FFT length >= L by default.
+    time_shifts selects shifts on this grid (see time_shift_grid), all nfft of them are returned if None.
+    Every basis needs the whole band for its FFT, so B_linear is processed in blocks of bases within memory_budget bytes.
+    Returns the time shifts and the (ntime_shifts x ndim) weights (a dict of them if data and psd are dicts).
+    """
+    detectors, data, psd = _detector_lists(B_linear, data, psd)
+    ndim, L = B_linear.shape
+    if nfft is None: nfft = scipy.fft.next_fast_len(L)
+    if nfft < L: raise ValueError("nfft must be at least the number of frequencies "+str(L)+".")
+    if time_shifts is None:
+        time_shifts = time_shift_grid(nfft, deltaF)
+    time_shifts = numpy.atleast_1d(numpy.asarray(time_shifts, dtype=numpy.float64))
+    k = time_shifts*nfft*deltaF
+    if not numpy.allclose(k, numpy.round(k), rtol=0, atol=1e-6):
+        raise ValueError("The time shifts must be multiples of 1/(nfft*deltaF) = "+str(1/(nfft*deltaF))+" s.")
+    k = numpy.round(k).astype(int) % nfft
+    weighted_data = [numpy.conj(d)/S for d, S in zip(data, psd)]
+    weights = [numpy.empty((len(k), ndim), dtype=numpy.complex128) for d in data]
+    rows = max(1, int(memory_budget//(3*nfft*16)))
+    for start in range(0, ndim, rows):
+        stop = min(start+rows, ndim)
+        block = numpy.asarray(B_linear[start:stop], dtype=numpy.complex128)
+        for x, w in zip(weighted_data, weights):
+            w[:, start:stop] = numpy.transpose(scipy.fft.fft(block*x, n=nfft, axis=1)[:, k])
+    phases = 4*deltaF*numpy.exp(-2j*numpy.pi*f_min*time_shifts)
+    return time_shifts, _detector_results(detectors, [w*phases[:, numpy.newaxis] for w in weights])
+
+def quadratic_weights(B_quadratic, psd, deltaF, memory_budget=2**28):
+    """
+    Quadratic ROQ weights q_k = 4 deltaF sum_f B'_k(f)/S(f), such that <h|h> = sum_k q_k |h(G_k)|^2.
+    The sums run over blocks of frequencies within memory_budget bytes, for all detectors at once.
+    """
+    detectors, data, psd = _detector_lists(B_quadratic, None, psd)
+    ndim, L = B_quadratic.shape
+    inverse_psd = numpy.transpose(1/numpy.array(psd)) # (L x ndetectors)
+    weights = numpy.zeros((ndim, len(psd)))
+    columns = max(1, int(memory_budget//(2*ndim*8)))
+    for start in range(0, L, columns):
+        stop = min(start+columns, L)
+        weights += numpy.dot(numpy.asarray(B_quadratic[:, start:stop], dtype=numpy.float64), inverse_psd[start:stop])
+    return _detector_results(detectors, list(4*deltaF*numpy.transpose(weights)))
+
+# Linear and quadratic weights of the ROQ data in directory (see load_roq_data), see linear_weights and quadratic_weights
+def roq_weights(data, psd, deltaF, f_min, directory='.', time_shifts=None, nfft=None, memory_budget=2**28):
+    B_linear, fnodes_linear, B_quadratic, fnodes_quadratic = load_roq_data(directory)
+    if len(fnodes_linear) != len(B_linear) or len(fnodes_quadratic) != len(B_quadratic):
+        raise ValueError("The frequency nodes in "+directory+" do not match the B matrices.")
+    time_shifts, w_linear = linear_weights(B_linear, data, psd, deltaF, f_min, time_shifts=time_shifts, nfft=nfft, memory_budget=memory_budget)
+    w_quadratic = quadratic_weights(B_quadratic, psd, deltaF, memory_budget=memory_budget)
+    return time_shifts, w_linear, w_quadratic
+
+# end ROQ likelihood weights ###
@@ -41,10 +41,15 @@ approximant = 'teobresums-giotto-FD' #'mlgw-bns'
 run_tag = 'test_freqs'
 if not os.path.exists(run_tag): os.makedirs(run_tag)
 # Computing parameters
-parallel = 0 # The parallel=1 will turn on multiprocesses to search for a new basis. To turn it off, set it to be 0.
-             # Do not turn it on if the waveform generation is not slow compared to data reading and writing to files.
-             # This is more useful when each waveform takes larger than 0.01 sec to generate.
-nprocesses = 4 # Set the number of parallel processes when searching for a new basis.  nprocesses=mp.cpu_count()
+parallel = 'auto' # 'auto' times a few waveforms and the cost of shipping data to the workers, then runs serially,
+                  # on a process pool or on a thread pool, whichever is estimated fastest.
+                  # parallel=1 forces multiprocesses to search for a new basis and parallel=0 turns it off. parallel=2 uses threads,
+                  # for thread-safe generators only such as the analytic ones: TEOBResumS and LAL waveforms run on processes instead.
+                  # Do not turn it on if the waveform generation is not slow compared to data reading and writing to files.
+                  # This is more useful when each waveform takes larger than 0.01 sec to generate.
+nprocesses = None # Set the number of parallel processes when searching for a new basis, None uses all available cores with parallel='auto'.
+waveform_cache_dir = os.path.join(run_tag, 'waveform_cache') # Waveforms are stored here and reused by later stages and runs. Set to None to disable.
+instrumentation_log = os.path.join(run_tag, 'instrumentation.jsonl') # Timings, counters and greedy iterations of the run are logged here as JSON lines. Set to None to disable.
 
 # Interpolants construction parameters
 nts = 123 # Number of random test waveforms
@@ -58,17 +63,24 @@ npts = 80 # Specify the number of points for each search for a new basis element
           # It also depends on the parameter space and the signal length. 
         
 nbases = 30 # Specify the number of linear basis elements. Put your estimation here for the chunk of parameter space.
+greedy_tolerance = None # Stop the linear greedy search once the largest residual modulus falls below this value; nbases is then only a cap.
 ndimlow = 20 # Your estimation of fewest basis elements needed for this chunk of parameter space.
 ndimhigh = nbases+1 
 ndimstepsize = 1 # Number of linear basis elements increment to check if the basis satisfies the tolerance.
 tolerance = 1e-4 # Surrogage error threshold for linear basis elements
 
 nbases_quad = 30 # Specify the number of quadratic basis elements, depending on the tolerance_quad, usually two thirds of that for linear basis
+greedy_tolerance_quad = None
 ndimlow_quad = 20
 ndimhigh_quad = nbases_quad+1
 ndimstepsize_quad = 1
 tolerance_quad = 1e-5 # Surrogage error threshold for quadratic basis elements
 
+joint_bases = 1 # Build the linear and quadratic bases together from one training set of npts waveforms, each waveform is generated once.
+                # Set to 0 to run the linear and quadratic greedy searches separately.
+single_precision = 0 # Store the bases, the training residuals and the B matrices in complex64/float32, halving their memory and file size.
+                     # The extra surrogate error of the single precision B matrices is printed and checked against the tolerances.
+
 plot_only = 0
 check_mass_range = 0
 
@@ -80,6 +92,9 @@ check_mass_range = 0
 distance = 10 * LAL_PC_SI * 1.0e6  # 10 Mpc is default 
 
 waveFlags = pyroq.eob_parameters()
+dtype, dtype_quad = (numpy.complex64, numpy.float32) if single_precision else (None, None)
+if waveform_cache_dir is not None: pyroq.set_waveform_cache(pyroq.WaveformCache(waveform_cache_dir))
+if instrumentation_log is not None: pyroq.set_instrumentation(pyroq.Instrumentation(instrumentation_log))
 print("mass-min, mass-max: ", pyroq.massrange(intrinsic_params['mc'][0], intrinsic_params['mc'][1], intrinsic_params['q'][0], intrinsic_params['q'][1]))
 
 if check_mass_range:
@@ -115,11 +130,18 @@ if not plot_only:
     known_bases_start = numpy.array([hp1/numpy.sqrt(numpy.vdot(hp1,hp1))])
     basis_waveforms_start = numpy.array([hp1])
     residual_modula_start = numpy.array([0.0])
-    known_bases, params, residual_modula = pyroq.bases_searching_results_unnormalized(parallel, nprocesses, npts, nparams, nbases, known_bases_start, basis_waveforms_start, params_start, residual_modula_start, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant)
+    if joint_bases:
+        hp1_quad = (numpy.absolute(hp1))**2
+        known_quad_bases_start = numpy.array([hp1_quad/numpy.sqrt(numpy.vdot(hp1_quad,hp1_quad))])
+        (known_bases, params, residual_modula), (known_quad_bases, params_quad, residual_modula_quad) = pyroq.bases_searching_joint_results_unnormalized(parallel, nprocesses, npts, nparams, nbases, nbases_quad, known_bases_start, known_quad_bases_start, params_start, params_start, residual_modula_start, residual_modula_start, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant, greedy_tolerance=greedy_tolerance, greedy_tolerance_quad=greedy_tolerance_quad, dtype=dtype, dtype_quad=dtype_quad)
+    else:
+        known_bases, params, residual_modula = pyroq.bases_searching_results_unnormalized(parallel, nprocesses, npts, nparams, nbases, known_bases_start, basis_waveforms_start, params_start, residual_modula_start, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant, greedy_tolerance=greedy_tolerance, dtype=dtype)
     print(known_bases.shape, residual_modula)
     
+    # The same validation waveforms are used for the linear and the quadratic interpolants
+    validation_set = pyroq.generate_validation_set(nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, approximant, parallel=parallel, nprocesses=nprocesses, waveFlags=waveFlags)
     known_bases = numpy.load('./linearbases.npy')
-    pyroq.roqs(tolerance, freq, ndimlow, ndimhigh, ndimstepsize, known_bases, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant)
+    pyroq.roqs(tolerance, freq, ndimlow, ndimhigh, ndimstepsize, known_bases, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant, validation_set=validation_set, b_dtype=dtype)
     fnodes_linear, b_linear = numpy.load('./fnodes_linear.npy'), numpy.transpose(numpy.load('./B_linear.npy'))
 
     os.system('mv ./linearbases.npy ./linearbasiswaveformparams.npy ./fnodes_linear.npy ./B_linear.npy {}/.'.format(run_tag)) 
@@ -157,14 +179,16 @@ plt.savefig(os.path.join(run_tag,"SurrogateErrorsRandomTestPoints.png"))
 
 if not plot_only:
 
-    hp1_quad = (numpy.absolute(hp1))**2
-    known_quad_bases_start = numpy.array([hp1_quad/numpy.sqrt(numpy.vdot(hp1_quad,hp1_quad))])
-    basis_waveforms_quad_start = numpy.array([hp1_quad])
-    residual_modula_start = numpy.array([0.0])
-    known_quad_bases, params_quad, residual_modula_quad = pyroq.bases_searching_quadratic_results_unnormalized(parallel, nprocesses, npts, nparams, nbases_quad, known_quad_bases_start, basis_waveforms_quad_start, params_start, residual_modula_start, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant)
+    if not joint_bases:
+        hp1_quad = (numpy.absolute(hp1))**2
+        known_quad_bases_start = numpy.array([hp1_quad/numpy.sqrt(numpy.vdot(hp1_quad,hp1_quad))])
+        basis_waveforms_quad_start = numpy.array([hp1_quad])
+        residual_modula_start = numpy.array([0.0])
+        known_quad_bases, params_quad, residual_modula_quad = pyroq.bases_searching_quadratic_results_unnormalized(parallel, nprocesses, npts, nparams, nbases_quad, known_quad_bases_start, basis_waveforms_quad_start, params_start, residual_modula_start, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant, greedy_tolerance=greedy_tolerance_quad, dtype=dtype_quad)
 
     known_quad_bases = numpy.load('./quadraticbases.npy')
-    pyroq.roqs_quad(tolerance_quad, freq, ndimlow_quad, ndimhigh_quad, ndimstepsize_quad, known_quad_bases, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant)
+    validation_set_quad = (validation_set[0], (numpy.absolute(validation_set[1]))**2)
+    pyroq.roqs_quad(tolerance_quad, freq, ndimlow_quad, ndimhigh_quad, ndimstepsize_quad, known_quad_bases, nts, nparams, params_low, params_high, distance, deltaF, f_min, f_max, waveFlags, approximant, validation_set=validation_set_quad, b_dtype=dtype_quad)
 
     fnodes_quad,b_quad = numpy.load('./fnodes_quadratic.npy'), numpy.transpose(numpy.load('./B_quadratic.npy'))
     os.system('mv ./fnodes_quadratic.npy ./B_quadratic.npy ./quadraticbases.npy ./quadraticbasiswaveformparams.npy {}/.'.format(run_tag)) 
@@ -178,3 +202,5 @@ print('Quadratic basis reduction factor: (Original freqs [{}]) / (New freqs [{}]
 
 pyroq.testrep_quad(b_quad, emp_nodes_quad, test_mc, test_q, test_s1, test_s2, test_ecc, test_lambda1, test_lambda2, test_iota, test_phiref, distance, deltaF, f_min, f_max, waveFlags, approximant)
 os.system('mv ./testrep.png ./testrepquad.png {}/.'.format(run_tag)) 
+
+if instrumentation_log is not None: print('Instrumentation summary:', pyroq.instrumentation.close())